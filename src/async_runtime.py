@@ -0,0 +1,214 @@
+import asyncio
+from time import perf_counter_ns, time
+
+import websockets
+
+from latency import LATENCY
+from main import MarketMaker, REQUOTE_STATS_INTERVAL
+from reconnect import AUTH_TIMEOUT, READY_TIMEOUT
+from requote import EVENT
+from ws_msg_parser import parse_msg, BOOK_INVALID
+import ws_protocol
+
+# What ends a connection and has us reconnect.
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, websockets.WebSocketException)
+
+class AsyncMarketMaker(MarketMaker):
+	""" Runs the market maker on a single asyncio event loop. The loop owns the
+		socket and the exchange state: frames are parsed, quotes recomputed and
+		orders sent from the same thread, so nothing is shared across threads.
+	"""
+
+	def __init__(self, conf, config_path=None):
+		super(AsyncMarketMaker, self).__init__(conf, config_path)
+		self.websocket = None
+		self.outbox = None
+		self.authenticated = None
+		self.ready = None
+		self.requote_event = None
+
+	def send(self, msg):
+		""" Queues a message for the sender task. Never blocks. """
+		self.outbox.put_nowait(ws_protocol.encode(msg))
+
+	def place_order(self, order):
+		self.send(ws_protocol.order_msg(order))
+
+	def cancel_order(self, order):
+		self.send(ws_protocol.cancel_order_msg(order))
+
+	def sub_index_price(self, symbols):
+		self.send(ws_protocol.subscribe_msg([ws_protocol.INDEX_VALUES_CHANNEL], symbols))
+
+	def sub_position_states(self):
+		self.send(ws_protocol.subscribe_msg([ws_protocol.POSITION_STATES_CHANNEL], []))
+
+	def sub_orderbook_l2(self, symbol):
+		self.send(ws_protocol.subscribe_msg([ws_protocol.ORDERBOOK_L2_CHANNEL], [symbol]))
+
+	def unsub_orderbook_l2(self, symbol):
+		self.send(ws_protocol.unsubscribe_msg([ws_protocol.ORDERBOOK_L2_CHANNEL], [symbol]))
+
+	def fetch_tradable_symbols(self):
+		self.send(ws_protocol.fetch_msg("fetch_tradable_symbols"))
+
+	def fetch_positions(self):
+		self.send(ws_protocol.fetch_msg("fetch_positions"))
+
+	def fetch_open_orders(self):
+		self.send(ws_protocol.fetch_msg("fetch_open_orders"))
+
+	def fetch_symbols(self):
+		self.send(ws_protocol.fetch_msg("fetch_symbols"))
+
+	def who_am_i(self):
+		self.send(ws_protocol.fetch_msg("whoami"))
+
+	def on_message(self, _, msg):
+		received = perf_counter_ns() if LATENCY.enabled else None
+		self.connection.on_frame()
+		if self.recorder is not None:
+			self.recorder.record(msg)
+		change = parse_msg(self.exchange_state, msg)
+		if change == BOOK_INVALID:
+			self.resync_books()
+		if self.exchange_state.is_authenticated:
+			self.authenticated.set()
+		if not self.ready.is_set() and self.is_ready():
+			self.ready.set()
+		if change:
+			if self.tick_ns is None:
+				self.tick_ns = received
+			self.requote_trigger.notify(change)
+			self.requote_event.set()
+
+	async def _sender(self):
+		while True:
+			frame = await self.outbox.get()
+			await self.websocket.send(frame)
+
+	async def _receiver(self):
+		async for frame in self.websocket:
+			self.on_message(None, frame)
+
+	async def _feed_poller(self):
+		while True:
+			if self.poll_feed():
+				self.requote_event.set()
+			if not self.ready.is_set() and self.is_ready():
+				self.ready.set()
+			await asyncio.sleep(self.feed_poll_s)
+
+	async def _requoter(self):
+		last_stats = time()
+		last_requote = time()
+		while True:
+			# Wake up early when queued orders can go out.
+			timeout = 1
+			backlog_wait = self.scheduler.wait_time()
+			if backlog_wait is not None:
+				timeout = min(timeout, backlog_wait)
+
+			changed = True
+			if self.requote_mode == EVENT:
+				try:
+					await asyncio.wait_for(self.requote_event.wait(), timeout=timeout)
+					# Let the rest of a burst of updates land before requoting.
+					if self.requote_trigger.debounce:
+						await asyncio.sleep(self.requote_trigger.debounce)
+					self.requote_event.clear()
+					self.requote_trigger.wakeups += 1
+				except asyncio.TimeoutError:
+					changed = False
+			else:
+				await asyncio.sleep(timeout)
+				changed = time() - last_requote >= 1
+			if self.connection.is_idle():
+				raise ConnectionError(f"nothing received for {self.connection.idle_timeout}s")
+			self.scheduler.drain()
+			if self.reload_params():
+				changed = True
+			if self.poll_kill_switch():
+				changed = True
+			self.poll_latency_dump()
+			if self.state_cache is not None:
+				self.state_cache.save_if_due(self.exchange_state)
+
+			if time() - last_stats >= REQUOTE_STATS_INTERVAL:
+				self.print_stats()
+				last_stats = time()
+
+			if changed:
+				self.requote()
+				last_requote = time()
+
+	async def _wait_for(self, event, timeout, tasks):
+		""" Waits for the event, giving up early if one of the connection's
+			tasks stopped, e.g. the receiver because the socket closed.
+		"""
+		waiter = asyncio.create_task(event.wait())
+		done, _ = await asyncio.wait(tasks + [waiter], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+		if waiter in done:
+			return
+		waiter.cancel()
+		for task in done:
+			task.result()
+		if done:
+			raise ConnectionError("connection closed")
+		raise asyncio.TimeoutError()
+
+	async def _connection(self):
+		""" Runs one connection until it fails. The auth message and every
+			subscription not needing authentication go out together; our
+			account follows as soon as the exchange accepted the credentials.
+		"""
+		async with websockets.connect(self.conf["ws_url"]) as websocket:
+			self.websocket = websocket
+			self.outbox = asyncio.Queue()
+			self.authenticated.clear()
+			self.ready.clear()
+			self.connection.on_connect()
+			tasks = [
+				asyncio.create_task(self._sender()),
+				asyncio.create_task(self._receiver())]
+			if self.feed is not None:
+				tasks.append(asyncio.create_task(self._feed_poller()))
+			try:
+				self.send(ws_protocol.auth_msg(
+					self.conf["api_key"], self.conf["api_secret"], self.conf["api_passphrase"]))
+				self.subscribe_market_data()
+				await self._wait_for(self.authenticated, AUTH_TIMEOUT, tasks)
+				self.subscribe_account()
+				await self._wait_for(self.ready, READY_TIMEOUT, tasks)
+				self.backoff.reset()
+				self.connection.on_ready()
+				self.on_ready()
+
+				tasks.append(asyncio.create_task(self._requoter()))
+				done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					# Surfaces the exception of whichever task stopped.
+					task.result()
+			finally:
+				for task in tasks:
+					task.cancel()
+
+	async def run(self):
+		self.authenticated = asyncio.Event()
+		self.ready = asyncio.Event()
+		self.requote_event = asyncio.Event()
+		if LATENCY.enabled:
+			LATENCY.dump_on_signal()
+		if self.reloader is not None:
+			self.reloader.reload_on_signal()
+		self.kill_on_signal()
+		self.start_metrics()
+
+		while True:
+			await asyncio.sleep(self.backoff.next())
+			try:
+				await self._connection()
+				reason = "connection closed"
+			except CONNECTION_ERRORS as e:
+				reason = repr(e)
+			self.on_disconnect(reason)
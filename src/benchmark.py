@@ -0,0 +1,561 @@
+""" Micro-benchmarks for the market maker's hot paths.
+
+	Usage: python src/benchmark.py [name filter] [--frames frames.log]
+		[--config config.yaml] [--history benchmarks.jsonl]
+
+	--frames adds benchmarks running a recorded frame log. --history appends
+	the results to a JSON lines file and compares them to the previous run.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from calculators import REFERENCE_PRICE_CALCS
+from convergence import diff_orders
+from dtypes import ExchangeState, OpenOrders, Orderbook, parse_index_value, parse_open_order
+from fixtures import synthetic_deltas, synthetic_frames, synthetic_ladder, synthetic_tradable_symbol, synthetic_trading_params
+from frame_log import read_frames
+from journal import Journal, DEBUG
+from ladder import Ladder, build_ladder
+from shm_feed import FeedPublisher, FeedReader
+from trading_params import TradingParams
+import ws_msg_parser
+
+BENCHMARKS = {}
+
+def benchmark(name):
+	""" Registers a benchmark. The decorated function does the setup and returns
+		a (callable, operations per call) tuple that gets timed.
+	"""
+	def register(fn):
+		BENCHMARKS[name] = fn
+		return fn
+	return register
+
+class OOBTreeOrderbook(object):
+	""" The BTrees based orderbook the array-backed one replaced, kept for
+		comparison.
+	"""
+
+	def __init__(self):
+		from BTrees.OOBTree import OOBTree
+		self.bids = OOBTree()
+		self.asks = OOBTree()
+
+	def apply(self, side, levels):
+		for key, value in levels.items():
+			if value == 0:
+				try:
+					side.__delitem__(int(key))
+				except KeyError:
+					pass
+			else:
+				side[int(key)] = value
+
+	def top(self):
+		return self.bids.items()[-1][0], self.asks.items()[0][0]
+
+@benchmark("orderbook.delta.oobtree")
+def bench_oobtree_deltas():
+	snapshot, deltas = synthetic_deltas(1000)
+	def run():
+		ob = OOBTreeOrderbook()
+		ob.apply(ob.bids, snapshot[0])
+		ob.apply(ob.asks, snapshot[1])
+		for bids, asks in deltas:
+			ob.apply(ob.bids, bids)
+			ob.apply(ob.asks, asks)
+			ob.top()
+	return run, len(deltas)
+
+@benchmark("orderbook.delta.array")
+def bench_array_deltas():
+	snapshot, deltas = synthetic_deltas(1000)
+	def run():
+		ob = Orderbook("kollider")
+		ob.bids.replace(snapshot[0])
+		ob.asks.replace(snapshot[1])
+		for bids, asks in deltas:
+			ob.bids.apply(bids)
+			ob.asks.apply(asks)
+			ob.best_bid(), ob.best_ask()
+	return run, len(deltas)
+
+@benchmark("orderbook.depth10.oobtree")
+def bench_oobtree_depth():
+	snapshot, _ = synthetic_deltas(0)
+	ob = OOBTreeOrderbook()
+	ob.apply(ob.bids, snapshot[0])
+	ob.apply(ob.asks, snapshot[1])
+	def run():
+		bids = list(ob.bids.items())[-10:]
+		asks = list(ob.asks.items())[:10]
+		total = 0
+		for _, size in reversed(bids):
+			total += size
+		for _, size in asks:
+			total += size
+	return run, 1
+
+@benchmark("orderbook.depth10.array")
+def bench_array_depth():
+	snapshot, _ = synthetic_deltas(0)
+	ob = Orderbook("kollider")
+	ob.bids.replace(snapshot[0])
+	ob.asks.replace(snapshot[1])
+	def run():
+		ob.bids.cumulative_size(10)
+		ob.asks.cumulative_size(10)
+	return run, 1
+
+def bench_parse_frames(backend, lazy):
+	setup, frames = synthetic_frames(2000)
+	def run():
+		previous = ws_msg_parser.JSON_BACKEND, ws_msg_parser.LAZY_FILTER
+		ws_msg_parser.set_json_backend(backend)
+		ws_msg_parser.LAZY_FILTER = lazy
+		try:
+			exchange_state = ExchangeState("kollider")
+			exchange_state.book_symbols.add("BTCUSD.PERP")
+			for msg in setup:
+				ws_msg_parser.parse_msg(exchange_state, msg)
+			for msg in frames:
+				ws_msg_parser.parse_msg(exchange_state, msg)
+		finally:
+			ws_msg_parser.set_json_backend(previous[0])
+			ws_msg_parser.LAZY_FILTER = previous[1]
+	return run, len(frames)
+
+@benchmark("parse_msg.frames.stdlib_json")
+def bench_parse_frames_stdlib():
+	return bench_parse_frames("json", lazy=False)
+
+@benchmark("parse_msg.frames.fast_path")
+def bench_parse_frames_fast():
+	return bench_parse_frames(ws_msg_parser.JSON_BACKEND, lazy=True)
+
+def bench_diff(num_levels, per_level_tolerance=False):
+	# The book moved by half a level: every other resting order is still within
+	# tolerance, the rest need amending.
+	relist_tolerance = 0.00005
+	if per_level_tolerance:
+		relist_tolerance = [0.00005 * (1 + level) for level in range(num_levels)]
+	resting = OpenOrders(
+		synthetic_ladder(num_levels, "Bid", 399950, 40) +
+		synthetic_ladder(num_levels, "Ask", 400050, 40, order_id=num_levels))
+	steps = np.arange(num_levels, dtype=np.int64)
+	ladder = Ladder(399970 - 40 * steps, 2 + steps, 400070 + 40 * steps, 2 + steps)
+	def run():
+		diff_orders(resting.bids(), resting.asks(), ladder, relist_tolerance)
+	return run, 1
+
+@benchmark("converge.diff.50_levels")
+def bench_diff_50():
+	return bench_diff(50)
+
+@benchmark("converge.diff.200_levels")
+def bench_diff_200():
+	return bench_diff(200)
+
+@benchmark("converge.diff.50_levels.per_level_tolerance")
+def bench_diff_50_per_level():
+	return bench_diff(50, per_level_tolerance=True)
+
+def bench_ladder(num_levels):
+	tradable_symbol = synthetic_tradable_symbol()
+	trading_params = TradingParams(synthetic_trading_params(num_levels))
+	def run():
+		build_ladder(399960.0, 400040.0, trading_params, tradable_symbol, 100, 100)
+	return run, 1
+
+@benchmark("ladder.build.10_levels")
+def bench_ladder_10():
+	return bench_ladder(10)
+
+@benchmark("ladder.build.100_levels")
+def bench_ladder_100():
+	return bench_ladder(100)
+
+def bench_reference_price(name, num_events=1000):
+	""" Feeds a calculator num_events book (or for index-only calculators,
+		index) events, alternating between two books and index values so that
+		every event moves the price.
+	"""
+	symbol, index_symbol = "BTCUSD.PERP", ".BTCUSD"
+	exchange_state = ExchangeState("kollider")
+	exchange_state.tradable_symbols[symbol] = synthetic_tradable_symbol(symbol)
+	books = []
+	for mid in (400000, 400005):
+		snapshot, _ = synthetic_deltas(0, mid=mid)
+		orderbook = Orderbook("kollider")
+		orderbook.bids.replace(snapshot[0])
+		orderbook.asks.replace(snapshot[1])
+		books.append(orderbook)
+	index_values = [parse_index_value({"value": value, "symbol": index_symbol, "denom": "USD"})
+		for value in (40000.0, 40000.5)]
+	ticks = iter(range(1 << 62))
+	exchange_state.clock = lambda: next(ticks) * 0.001
+
+	calc = REFERENCE_PRICE_CALCS[name](symbol, index_symbol, {})
+	exchange_state.orderbooks[symbol] = books[0]
+	exchange_state.index_values[index_symbol] = index_values[0]
+	calc.update_price(exchange_state)
+	on_event = calc.on_book if calc.book_events else calc.on_index
+	def run():
+		orderbooks = exchange_state.orderbooks
+		indexes = exchange_state.index_values
+		for i in range(num_events):
+			orderbooks[symbol] = books[i & 1]
+			indexes[index_symbol] = index_values[i & 1]
+			on_event(exchange_state)
+	return run, num_events
+
+for _name in REFERENCE_PRICE_CALCS:
+	benchmark(f"reference_price.{_name}.event")(
+		lambda name=_name: bench_reference_price(name))
+
+def feed_books(num_books=2):
+	""" Returns num_books copies of a 50 level book with different mids. """
+	books = []
+	for i in range(num_books):
+		snapshot, _ = synthetic_deltas(0, mid=400000 + 5 * i)
+		orderbook = Orderbook("kollider")
+		orderbook.bids.replace(snapshot[0])
+		orderbook.asks.replace(snapshot[1])
+		orderbook.sequence = i
+		orderbook.is_synced = True
+		books.append(orderbook)
+	return books
+
+def feed_path():
+	directory = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+	return os.path.join(directory, f"kmm_bench_feed_{os.getpid()}")
+
+@benchmark("shm_feed.publish_book")
+def bench_feed_publish():
+	symbol = "BTCUSD.PERP"
+	publisher = FeedPublisher(feed_path(), [symbol])
+	os.unlink(publisher.path)
+	books = feed_books()
+	def run():
+		for i in range(1000):
+			publisher.publish_book(symbol, books[i & 1], i)
+	return run, 1000
+
+@benchmark("shm_feed.sync_book")
+def bench_feed_sync():
+	""" A publish followed by the reader copying the book into its state. """
+	symbol = "BTCUSD.PERP"
+	publisher = FeedPublisher(feed_path(), [symbol])
+	reader = FeedReader(publisher.path)
+	os.unlink(publisher.path)
+	exchange_state = ExchangeState("kollider")
+	books = feed_books()
+	def run():
+		for i in range(1000):
+			publisher.publish_book(symbol, books[i & 1], i)
+			reader.sync(exchange_state, (symbol,))
+	return run, 1000
+
+@benchmark("journal.event.recorded")
+def bench_journal_recorded():
+	""" The producer's side of an event the journal keeps. """
+	journal = Journal()
+	# No writer thread: the run empties the queue itself.
+	journal.thread = False
+	def run():
+		for i in range(1000):
+			journal.info("order", sent="place", order_id=i)
+		journal.queue.clear()
+	return run, 1000
+
+@benchmark("journal.event.filtered")
+def bench_journal_filtered():
+	journal = Journal()
+	def run():
+		for i in range(1000):
+			journal.event("book", DEBUG, symbol="BTCUSD.PERP", delta=i)
+	return run, 1000
+
+def parse_frames_of_type(frames, setup=()):
+	""" Parses the frames into a fresh exchange state, after the setup frames. """
+	exchange_state = ExchangeState("kollider")
+	exchange_state.book_symbols.add("BTCUSD.PERP")
+	for msg in setup:
+		ws_msg_parser.parse_msg(exchange_state, msg)
+	def run():
+		parse_msg = ws_msg_parser.parse_msg
+		for msg in frames:
+			parse_msg(exchange_state, msg)
+	return run, len(frames)
+
+def order_frame(msg_type, order_id, **data):
+	order = {
+		"quantity": 10**9, "order_id": order_id, "price": 399950, "timestamp": "0", "filled": 0,
+		"ext_order_id": f"ext-{order_id}", "order_type": "Limit", "side": "Bid",
+		"symbol": "BTCUSD.PERP", "leverage": 100, "margin_type": "Isolated", "settlement_type": "Delayed"}
+	if msg_type != "open":
+		order = {"order_id": order_id, "symbol": "BTCUSD.PERP"}
+	order.update(data)
+	return json.dumps({"type": msg_type, "data": order})
+
+@benchmark("parse_msg.level2state.snapshot")
+def bench_parse_snapshot():
+	setup, _ = synthetic_frames(0)
+	return parse_frames_of_type(setup * 100)
+
+@benchmark("parse_msg.level2state.delta")
+def bench_parse_delta():
+	setup, frames = synthetic_frames(5000)
+	deltas = [frame for frame in frames if '"update_type": "delta"' in frame and "BTCUSD" in frame]
+	# The sequence numbers only line up once, so every run starts from the snapshot.
+	return parse_frames_of_type(setup + deltas)
+
+@benchmark("parse_msg.index_values")
+def bench_parse_index():
+	frames = [json.dumps({"type": "index_values", "data": {"symbol": ".BTCUSD", "value": 40000 + (i & 1), "denom": "USD"}})
+		for i in range(1000)]
+	return parse_frames_of_type(frames)
+
+@benchmark("parse_msg.open_done")
+def bench_parse_open_done():
+	frames = []
+	for order_id in range(500):
+		frames.append(order_frame("open", order_id))
+		frames.append(order_frame("done", order_id, reason="Cancel"))
+	return parse_frames_of_type(frames)
+
+@benchmark("parse_msg.fill")
+def bench_parse_fill():
+	frames = [order_frame("fill", 1, quantity=1, price=399950, side="Bid", is_maker=True) for _ in range(1000)]
+	return parse_frames_of_type(frames, [order_frame("open", 1)])
+
+@benchmark("parse_msg.position_states")
+def bench_parse_position():
+	frames = [json.dumps({"type": "position_states", "data": {
+		"symbol": "BTCUSD.PERP", "quantity": 10 + (i & 1), "entry_price": "40000.0", "leverage": "100",
+		"liq_price": "0", "open_order_ids": [], "side": "Bid", "timestamp": "0", "upnl": 0, "rpnl": "0"}})
+		for i in range(1000)]
+	return parse_frames_of_type(frames)
+
+@benchmark("parse_msg.ticker.dropped")
+def bench_parse_ticker():
+	_, frames = synthetic_frames(5000)
+	return parse_frames_of_type([frame for frame in frames if '"ticker"' in frame])
+
+@benchmark("reference_price.mid.update_price")
+def bench_mid_update_price():
+	symbol = "BTCUSD.PERP"
+	exchange_state = ExchangeState("kollider")
+	exchange_state.tradable_symbols[symbol] = synthetic_tradable_symbol(symbol)
+	exchange_state.orderbooks[symbol] = feed_books(1)[0]
+	calc = REFERENCE_PRICE_CALCS["mid"](symbol, ".BTCUSD", {})
+	calc.on_book(exchange_state)
+	def run():
+		calc.update_price(exchange_state)
+	return run, 1
+
+@benchmark("main.to_nearest")
+def bench_to_nearest():
+	from main import toNearest
+	def run():
+		toNearest(40012.345, 0.5)
+	return run, 1
+
+def bench_market_maker(num_levels):
+	""" Returns a market maker quoting BTCUSD.PERP whose order messages go
+		nowhere but into its placed list.
+	"""
+	from main import MarketMaker
+	class BenchMarketMaker(MarketMaker):
+		def place_order(self, order):
+			self.placed.append(order)
+		def cancel_order(self, order):
+			pass
+	conf = {
+		"symbol": "BTCUSD.PERP", "index_symbol": ".BTCUSD", "enable_dry_run": False,
+		"check_position_limits": False, "requote_mode": "event",
+		"trading_params": synthetic_trading_params(num_levels)}
+	market_maker = BenchMarketMaker(conf)
+	market_maker.placed = []
+	market_maker.exchange_state.tradable_symbols["BTCUSD.PERP"] = synthetic_tradable_symbol()
+	return market_maker, market_maker.markets["BTCUSD.PERP"]
+
+def rest_placed(market_maker, symbol):
+	""" Turns the orders placed so far into resting orders. """
+	orders = OpenOrders()
+	in_flight = market_maker.exchange_state.in_flight_for(symbol)
+	for order_id, msg in enumerate(market_maker.placed):
+		orders.add(parse_open_order(dict(msg, order_id=order_id)))
+		in_flight.acknowledge_place(msg["ext_order_id"])
+	market_maker.exchange_state.open_orders[symbol] = orders
+	market_maker.placed = []
+
+def bench_create_orders(num_levels):
+	""" Requotes while the book flips between two mids half a tick apart, so
+		every call builds a new ladder and diffs it against the orders resting
+		from the first mid.
+	"""
+	market_maker, market = bench_market_maker(num_levels)
+	books = feed_books()
+	orderbooks = market_maker.exchange_state.orderbooks
+	orderbooks[market.symbol] = books[0]
+	market.on_book(market_maker.exchange_state)
+	market_maker.create_orders(market)
+	rest_placed(market_maker, market.symbol)
+	def run():
+		for i in range(1, 101):
+			orderbooks[market.symbol] = books[i & 1]
+			market.on_book(market_maker.exchange_state)
+			market_maker.create_orders(market)
+		market_maker.placed.clear()
+	return run, 100
+
+for _levels in (2, 10, 50):
+	benchmark(f"main.create_orders.{_levels}_levels")(
+		lambda levels=_levels: bench_create_orders(levels))
+
+def bench_converge_orders(num_existing, num_levels=10):
+	""" Converges a 10 level ladder against num_existing resting orders per
+		side, half of which are within tolerance.
+	"""
+	market_maker, market = bench_market_maker(num_levels)
+	resting = OpenOrders(
+		synthetic_ladder(num_existing, "Bid", 399950, 20) +
+		synthetic_ladder(num_existing, "Ask", 400050, 20, order_id=num_existing))
+	for order in resting.bids() + resting.asks():
+		order.symbol = market.symbol
+		order.settlement_type = "Delayed"
+	market_maker.exchange_state.open_orders[market.symbol] = resting
+	steps = np.arange(num_levels, dtype=np.int64)
+	ladder = Ladder(399950 - 40 * steps, 2 + steps, 400050 + 40 * steps, 2 + steps)
+	def run():
+		market_maker.converge_orders(market, ladder)
+		market_maker.placed.clear()
+	return run, 1
+
+for _existing in (0, 10, 100):
+	benchmark(f"main.converge_orders.{_existing}_existing")(
+		lambda existing=_existing: bench_converge_orders(existing))
+
+@benchmark("risk.check.place")
+def bench_risk_check():
+	""" Checks a place against every limit, with 10 orders resting per side. """
+	from order_scheduler import PLACE
+	market_maker, market = bench_market_maker(10)
+	market.set_trading_params(market.trading_params.replace(risk_max_order_qty=1000,
+		risk_price_band_pct=0.05, risk_max_open_btc=100.0), market_maker.exchange_state)
+	resting = OpenOrders(synthetic_ladder(10, "Bid", 399950, 20) + synthetic_ladder(10, "Ask", 400050, 20, order_id=10))
+	for order in resting.bids() + resting.asks():
+		order.symbol = market.symbol
+	market_maker.exchange_state.open_orders[market.symbol] = resting
+	risk = market_maker.risk
+	risk.max_messages = 1_000_000_000
+	risk.reference_prices[market.symbol] = 400000
+	msg = market_maker.build_order(market, "Bid", 399900, 5).to_dict()
+	def run():
+		risk.check(PLACE, msg)
+	return run, 1
+
+def add_recorded_benchmarks(path, config_path="config.yaml"):
+	""" Registers the benchmarks running the frame log at path. The replay
+		trades with the params of the config.
+	"""
+	frames = [frame for _, frame in read_frames(path)]
+	timed_frames = list(read_frames(path))
+
+	@benchmark("recorded.parse_msg")
+	def bench_recorded_parse():
+		def run():
+			exchange_state = ExchangeState("kollider")
+			exchange_state.book_symbols.add("BTCUSD.PERP")
+			for msg in frames:
+				ws_msg_parser.parse_msg(exchange_state, msg)
+		return run, len(frames)
+
+	@benchmark("recorded.replay")
+	def bench_recorded_replay():
+		import yaml
+		from replay import run_replay
+		with open(config_path) as f:
+			conf = yaml.load(f, Loader=yaml.FullLoader)
+		def run():
+			run_replay(conf, timed_frames)
+		return run, len(timed_frames)
+
+def git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+			capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def load_history(path):
+	if not os.path.exists(path):
+		return []
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+def save_history(path, results):
+	""" Appends a run to the history file. results maps names to seconds per op. """
+	entry = {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"commit": git_commit(),
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"results": results,
+	}
+	with open(path, "a") as f:
+		f.write(json.dumps(entry) + "\n")
+
+def previous_results(history):
+	""" Returns the latest result of each benchmark across the history. """
+	previous = {}
+	for entry in history:
+		previous.update(entry["results"])
+	return previous
+
+def run_benchmark(name, repeat=5):
+	""" Returns the best time per operation in seconds. """
+	fn, ops = BENCHMARKS[name]()
+	timer = timeit.Timer(fn)
+	number, _ = timer.autorange()
+	best = min(timer.repeat(repeat=repeat, number=number)) / number
+	return best / ops
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Time the market maker's hot paths.")
+	parser.add_argument("filter", nargs="?", default="", help="only run benchmarks whose name contains this")
+	parser.add_argument("--frames", help="frame log to run the recorded benchmarks on")
+	parser.add_argument("--config", default="config.yaml", help="trading params of the recorded replay")
+	parser.add_argument("--history", help="JSON lines file to append the results to and compare with")
+	parser.add_argument("--repeat", type=int, default=5)
+	args = parser.parse_args(argv[1:])
+
+	if args.frames:
+		add_recorded_benchmarks(args.frames, args.config)
+	previous = previous_results(load_history(args.history)) if args.history else {}
+
+	results = {}
+	for name in BENCHMARKS:
+		if args.filter not in name:
+			continue
+		per_op = run_benchmark(name, args.repeat)
+		results[name] = per_op
+		line = f"{name:<40} {per_op * 1e6:>10.3f} us/op {1 / per_op:>14,.0f} ops/s"
+		if name in previous:
+			line += f" {(per_op / previous[name] - 1) * 100:>+8.1f}%"
+		print(line)
+
+	if args.history and results:
+		save_history(args.history, results)
+
+if __name__ == "__main__":
+	main(sys.argv)
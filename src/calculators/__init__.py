@@ -1,2 +1,7 @@
+from .reference_price_calc import REFERENCE_PRICE_CALCS, ReferencePriceCalc, create_reference_price, register
 from .index_price_calc import IndexPriceCalc
-from .mid_price_calc import MidPriceCalc
\ No newline at end of file
+from .mid_price_calc import MidPriceCalc
+from .microprice_calc import MicropriceCalc
+from .depth_mid_calc import DepthMidCalc
+from .ewma_mid_calc import EwmaMidCalc
+from .index_basis_calc import IndexBasisCalc
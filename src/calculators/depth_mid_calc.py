@@ -0,0 +1,30 @@
+from operator import mul
+
+from dtypes import ExchangeState
+from .reference_price_calc import ReferencePriceCalc, register, top_of_book
+
+DEFAULT_DEPTH_LEVELS = 5
+
+@register("depth_mid")
+class DepthMidCalc(ReferencePriceCalc):
+	""" The mid of the size weighted average prices of the best depth_levels
+		levels of each side. Costs O(depth_levels) per update, a constant set
+		in the trading params.
+	"""
+	book_events = True
+
+	def __init__(self, symbol, index_symbol, trading_params):
+		super(DepthMidCalc, self).__init__(symbol, index_symbol, trading_params)
+		self.depth_levels = int(trading_params.get("depth_levels", DEFAULT_DEPTH_LEVELS))
+
+	def on_book(self, exchange_state: ExchangeState):
+		orderbook, tradable_symbol = top_of_book(exchange_state, self.symbol)
+		if orderbook is None:
+			return False
+		n = self.depth_levels
+		# Both sides are sorted by ascending price: the best bids are last.
+		bid_prices, bid_sizes = orderbook.bids.prices[-n:], orderbook.bids.sizes[-n:]
+		ask_prices, ask_sizes = orderbook.asks.prices[:n], orderbook.asks.sizes[:n]
+		bid = sum(map(mul, bid_prices, bid_sizes)) / sum(bid_sizes)
+		ask = sum(map(mul, ask_prices, ask_sizes)) / sum(ask_sizes)
+		return self._set(tradable_symbol.from_raw((bid + ask) / 2))
@@ -0,0 +1,28 @@
+from dtypes import ExchangeState
+from .reference_price_calc import ReferencePriceCalc, decay_weight, mid_price, register
+
+DEFAULT_EWMA_HALFLIFE_S = 5.0
+
+@register("ewma_mid")
+class EwmaMidCalc(ReferencePriceCalc):
+	""" A time decayed exponential moving average of the mid, smoothing out
+		flickering quotes. ewma_halflife_s sets how fast it follows the mid.
+	"""
+	book_events = True
+
+	def __init__(self, symbol, index_symbol, trading_params):
+		super(EwmaMidCalc, self).__init__(symbol, index_symbol, trading_params)
+		self.halflife = float(trading_params.get("ewma_halflife_s", DEFAULT_EWMA_HALFLIFE_S))
+		self.last_time = None
+
+	def on_book(self, exchange_state: ExchangeState):
+		mid = mid_price(exchange_state, self.symbol)
+		if mid is None:
+			return False
+		now = exchange_state.clock()
+		if self.price is None:
+			self.last_time = now
+			return self._set(mid)
+		weight = decay_weight(now - self.last_time, self.halflife)
+		self.last_time = now
+		return self._set(self.price + weight * (mid - self.price))
@@ -0,0 +1,47 @@
+from dtypes import ExchangeState
+from .reference_price_calc import ReferencePriceCalc, decay_weight, mid_price, register
+
+DEFAULT_BASIS_HALFLIFE_S = 60.0
+
+@register("index_basis")
+class IndexBasisCalc(ReferencePriceCalc):
+	""" The index price plus the contract's basis to it, a time decayed average
+		of mid minus index over basis_halflife_s. Follows index moves straight
+		away while the slower basis tracks where the contract trades.
+	"""
+	book_events = True
+	index_events = True
+
+	def __init__(self, symbol, index_symbol, trading_params):
+		super(IndexBasisCalc, self).__init__(symbol, index_symbol, trading_params)
+		self.halflife = float(trading_params.get("basis_halflife_s", DEFAULT_BASIS_HALFLIFE_S))
+		self.index = None
+		self.basis = None
+		self.last_time = None
+
+	def on_index(self, exchange_state: ExchangeState):
+		index_price = exchange_state.index_values.get(self.index_symbol)
+		if not index_price:
+			return False
+		self.index = index_price.value
+		return self._update()
+
+	def on_book(self, exchange_state: ExchangeState):
+		if self.index is None:
+			return False
+		mid = mid_price(exchange_state, self.symbol)
+		if mid is None:
+			return False
+		now = exchange_state.clock()
+		if self.basis is None:
+			self.basis = mid - self.index
+		else:
+			weight = decay_weight(now - self.last_time, self.halflife)
+			self.basis += weight * (mid - self.index - self.basis)
+		self.last_time = now
+		return self._update()
+
+	def _update(self):
+		if self.basis is None:
+			return False
+		return self._set(self.index + self.basis)
@@ -0,0 +1,18 @@
+from dtypes import ExchangeState
+from .reference_price_calc import ReferencePriceCalc, register, top_of_book
+
+@register("microprice")
+class MicropriceCalc(ReferencePriceCalc):
+	""" The mid weighted by the size at the top of the book: a bigger bid than
+		ask pulls the price towards the ask, where the next trade is likelier.
+	"""
+	book_events = True
+
+	def on_book(self, exchange_state: ExchangeState):
+		orderbook, tradable_symbol = top_of_book(exchange_state, self.symbol)
+		if orderbook is None:
+			return False
+		bid_size = orderbook.bids.best_size()
+		ask_size = orderbook.asks.best_size()
+		raw_price = (orderbook.best_bid() * ask_size + orderbook.best_ask() * bid_size) / (bid_size + ask_size)
+		return self._set(tradable_symbol.from_raw(raw_price))
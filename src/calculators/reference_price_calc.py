@@ -0,0 +1,103 @@
+from dtypes import ExchangeState
+
+# reference_price_type -> calculator class, filled in by @register.
+REFERENCE_PRICE_CALCS = {}
+
+def register(name):
+	""" Makes a calculator selectable as reference_price_type name. """
+	def add(cls):
+		REFERENCE_PRICE_CALCS[name] = cls
+		cls.name = name
+		return cls
+	return add
+
+def create_reference_price(name, symbol, index_symbol, trading_params):
+	calc = REFERENCE_PRICE_CALCS.get(name)
+	if calc is None:
+		raise Exception(f'Unrecognized reference_price_type {name} for {symbol} in config. \
+			Options are {sorted(REFERENCE_PRICE_CALCS)}.')
+	return calc(symbol, index_symbol, trading_params or {})
+
+class ReferencePriceCalc(object):
+	""" Base of the streaming reference price calculators.
+
+		Calculators are fed every orderbook update of their symbol (on_book)
+		and every change of their index (on_index) and update their price in
+		constant time per event. Both return True when the price changed.
+		book_events and index_events tell which of the two a calculator wants.
+	"""
+	name = None
+	book_events = False
+	index_events = False
+
+	def __init__(self, symbol, index_symbol, trading_params):
+		self.symbol = symbol
+		self.index_symbol = index_symbol
+		self.trading_params = trading_params
+		self.is_done = False
+		self.price = None
+
+	def is_ready(self):
+		""" Returns a boolean indicating if the price is considered stable.
+			This is relevant for pricing models that take multiple prices to
+			get ready.
+		"""
+		return self.is_done
+
+	def get_price(self):
+		""" Returns the current calculated price whether ready or not. Initially,
+			the price is None.
+		"""
+		return self.price
+
+	def on_book(self, exchange_state: ExchangeState):
+		return False
+
+	def on_index(self, exchange_state: ExchangeState):
+		return False
+
+	def update_price(self, exchange_state: ExchangeState):
+		""" Returns the current price. Prices are kept up to date by the events,
+			this only catches up on state that arrived before the calculator was
+			listening.
+		"""
+		if self.price is None and exchange_state is not None:
+			if self.index_events:
+				self.on_index(exchange_state)
+			if self.book_events:
+				self.on_book(exchange_state)
+		return self.price
+
+	def _set(self, price):
+		""" Stores a new price, returning True if it changed. """
+		self.is_done = True
+		if price == self.price:
+			return False
+		self.price = price
+		return True
+
+def top_of_book(exchange_state, symbol):
+	""" Returns the orderbook and tradable symbol of symbol if both sides of
+		the book are quoted and the contract is known, else (None, None).
+	"""
+	orderbook = exchange_state.orderbooks.get(symbol)
+	tradable_symbol = exchange_state.tradable_symbols.get(symbol)
+	if orderbook is None or tradable_symbol is None or not orderbook.bids or not orderbook.asks:
+		return None, None
+	return orderbook, tradable_symbol
+
+def mid_price(exchange_state, symbol):
+	""" Returns the decimal mid price of the symbol, or None. """
+	orderbook, tradable_symbol = top_of_book(exchange_state, symbol)
+	if orderbook is None:
+		return None
+	# Kollider's raw prices are decimal-place-shifted ints
+	return tradable_symbol.from_raw((orderbook.best_bid() + orderbook.best_ask()) / 2)
+
+def decay_weight(elapsed, halflife):
+	""" Returns the weight of a new sample in a time decayed EWMA: the old
+		average loses half its weight every halflife seconds.
+	"""
+	if halflife <= 0:
+		return 1.0
+	return 1.0 - 0.5 ** (max(elapsed, 0.0) / halflife)
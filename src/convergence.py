@@ -0,0 +1,110 @@
+""" Works out the smallest set of order actions that turns our resting orders
+	into the desired quote ladder. Nothing in here talks to the exchange, so it
+	can be tested and benchmarked on plain objects with a price, quantity,
+	filled and order_id attribute for the resting orders and a Ladder for the
+	desired ones.
+
+	Orders we sent but the exchange hasn't acknowledged yet are part of the
+	diff: a place in flight counts as resting and an order whose cancel is in
+	flight as gone. Otherwise a requote running before the acknowledgements of
+	the previous one would place the whole ladder again.
+"""
+
+def remaining_quantity(order):
+	return order.quantity - order.filled
+
+def is_within_tolerance(resting_price, desired_price, relist_tolerance):
+	""" Returns True if a resting order is close enough to the desired price to
+		leave it alone.
+	"""
+	return resting_price == desired_price or \
+		abs((desired_price / resting_price) - 1) <= relist_tolerance
+
+def with_in_flight(resting, pending, cancelling, is_bid):
+	""" Returns the orders of a side as they will be once the exchange handled
+		what is in flight: resting orders less those being cancelled, plus the
+		pending places, best price first.
+	"""
+	if cancelling:
+		resting = [order for order in resting if order.order_id not in cancelling]
+	if pending:
+		sign = -1 if is_bid else 1
+		resting = sorted(list(resting) + list(pending), key=lambda order: sign * order.price)
+	return resting
+
+def diff_side(resting, desired_prices, desired_quantities, relist_tolerance, is_bid, pending=(), cancelling=()):
+	""" Diffs one side of the book. resting holds our orders and the desired
+		prices and quantities the ladder, all sorted best price first (highest
+		first for bids, lowest first for asks).
+
+		Returns (to_create, to_amend, to_cancel). Desired levels are given as
+		(side, price, quantity) tuples and to_amend pairs each resting order
+		with the level it should become.
+
+		relist_tolerance is a single tolerance or a list of one per desired
+		level. Resting orders that already match a desired level (same
+		remaining size, price within the level's tolerance) are kept untouched. The leftovers are paired up
+		best first and amended, and whatever remains on either side is created
+		or cancelled.
+
+		pending holds our places of the side still in flight, as orders with an
+		order_id of None, and cancelling the order_ids of the cancels in
+		flight. Pending orders count as resting but can't be amended or
+		cancelled before the exchange gave them an id. The diff leaves such an
+		order, and the level it would have become, to the requote following its
+		acknowledgement.
+	"""
+	side = "Bid" if is_bid else "Ask"
+	sign = -1 if is_bid else 1
+	if pending or cancelling:
+		resting = with_in_flight(resting, pending, cancelling, is_bid)
+	# Plain ints are much cheaper to compare than numpy scalars.
+	if hasattr(desired_prices, "tolist"):
+		desired_prices = desired_prices.tolist()
+		desired_quantities = desired_quantities.tolist()
+	tolerances = relist_tolerance if isinstance(relist_tolerance, list) else None
+	unmatched_resting = []
+	unmatched_desired = []
+
+	# Both lists are sorted, so matching levels can be found in a single merge pass.
+	i = j = 0
+	n_resting = len(resting)
+	n_desired = len(desired_prices)
+	while i < n_resting and j < n_desired:
+		order = resting[i]
+		price = desired_prices[j]
+		if remaining_quantity(order) == desired_quantities[j] and \
+				is_within_tolerance(order.price, price, relist_tolerance if tolerances is None else tolerances[j]):
+			i += 1
+			j += 1
+		elif order.price * sign < price * sign:
+			unmatched_resting.append(order)
+			i += 1
+		else:
+			unmatched_desired.append((side, price, desired_quantities[j]))
+			j += 1
+	unmatched_resting.extend(resting[i:])
+	unmatched_desired.extend(zip([side] * (n_desired - j), desired_prices[j:], desired_quantities[j:]))
+
+	paired = min(len(unmatched_resting), len(unmatched_desired))
+	to_amend = list(zip(unmatched_resting[:paired], unmatched_desired[:paired]))
+	to_create = unmatched_desired[paired:]
+	to_cancel = unmatched_resting[paired:]
+	if pending:
+		to_amend = [(order, level) for order, level in to_amend if order.order_id is not None]
+		to_cancel = [order for order in to_cancel if order.order_id is not None]
+	return to_create, to_amend, to_cancel
+
+def diff_orders(resting_bids, resting_asks, ladder, relist_tolerance, pending_bids=(), pending_asks=(),
+		cancelling=()):
+	""" Diffs both sides of a symbol against a Ladder, the resting orders sorted
+		best price first and the pending ones in any order. Returns
+		(to_create, to_amend, to_cancel) across both sides.
+	"""
+	bid_create, bid_amend, bid_cancel = diff_side(
+		resting_bids, ladder.bid_prices, ladder.bid_quantities, relist_tolerance, True,
+		pending_bids, cancelling)
+	ask_create, ask_amend, ask_cancel = diff_side(
+		resting_asks, ladder.ask_prices, ladder.ask_quantities, relist_tolerance, False,
+		pending_asks, cancelling)
+	return bid_create + ask_create, bid_amend + ask_amend, bid_cancel + ask_cancel
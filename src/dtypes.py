@@ -1,6 +1,8 @@
 import uuid
-from BTrees.OOBTree import OOBTree
-import copy
+from array import array
+from bisect import bisect_left
+from time import monotonic
+import numpy as np
 
 class ExchangeState(object):
 
@@ -16,8 +18,37 @@ class ExchangeState(object):
         self.orderbooks = {}
         self.venue_name = venue_name
         self.is_authenticated = False
-        self.symbol = None
-        self.index_symbol = None
+        # Symbols we want orderbook updates for. Empty means all of them.
+        self.book_symbols = set()
+        # Bumped whenever our own open orders change.
+        self.orders_version = 0
+        # symbol -> [listener(exchange_state)] called after every orderbook
+        # update of the symbol, and the same per index symbol for index value
+        # changes. A listener returns True if it considers the update a
+        # change to the quotes' inputs.
+        self.book_listeners = {}
+        self.index_listeners = {}
+        # symbol -> [listener(exchange_state, position)] called whenever we
+        # learn our position of the symbol (None once flat), and
+        # [listener(exchange_state, order, quantity)] called per fill of one of
+        # our orders on the symbol.
+        self.position_listeners = {}
+        self.fill_listeners = {}
+        # Symbols whose orderbook went out of sync and needs a fresh snapshot.
+        self.resync_symbols = set()
+        # Seconds on a monotonic clock, for anything that decays over time.
+        # Replays substitute the time of the recording.
+        self.clock = monotonic
+        # Frames received per message type, including those dropped unparsed.
+        self.message_counts = {}
+        # symbol -> InFlightOrders, our order messages not yet answered.
+        self.in_flight = {}
+
+    def in_flight_for(self, symbol):
+        in_flight = self.in_flight.get(symbol)
+        if in_flight is None:
+            in_flight = self.in_flight[symbol] = InFlightOrders()
+        return in_flight
 
     def to_dict(self):
         return {
@@ -28,10 +59,15 @@ class ExchangeState(object):
         }
 
 class IndexValue(object):
-	def __init__(self):
-		self.value = 0
-		self.symbol = ""
-		self.dnom = ""
+    __slots__ = ("value", "symbol", "denom")
+
+    def __init__(self):
+        self.value = 0
+        self.symbol = ""
+        self.denom = ""
+
+    def to_dict(self):
+        return {"symbol": self.symbol, "value": self.value, "denom": self.denom}
 
 def parse_index_value(msg=None):
     index_value = IndexValue()
@@ -80,6 +116,14 @@ class CancelOrder(object):
         }
 
 class TradableSymbol(object):
+    """ Kollider quotes prices as integers: the price shifted by price_dp
+        decimal places. We keep prices in those raw units everywhere and only
+        convert with to_raw/from_raw at the edges.
+    """
+    __slots__ = ("base_margin", "contract_size", "is_inverse_priced", "last_price",
+        "maintenance_margin", "max_leverage", "price", "symbol", "underlying_symbol",
+        "tick_size", "lot_size", "maker_fee", "taker_fee", "price_dp", "raw_tick_size")
+
     def __init__(self):
         self.base_margin = 0
         self.contract_size = 0
@@ -94,6 +138,37 @@ class TradableSymbol(object):
         self.lot_size = 1
         self.maker_fee = 0
         self.taker_fee = 0
+        self.price_dp = 0
+        # The tick size in raw price units.
+        self.raw_tick_size = 1
+
+    def to_raw(self, price):
+        """ Returns the raw integer price of a decimal price. """
+        return round(price * 10**self.price_dp)
+
+    def from_raw(self, raw_price):
+        """ Returns the decimal price of a raw integer price. """
+        return raw_price * 10**-self.price_dp
+
+    def round_to_tick(self, raw_price):
+        """ Rounds a raw price to the nearest tick. Returns an int. """
+        tick = self.raw_tick_size
+        return round(raw_price / tick) * tick
+
+    def to_dict(self):
+        """ The fields parse_tradable_symbols reads. """
+        return {
+            "base_margin": self.base_margin,
+            "contract_size": self.contract_size,
+            "is_inverse_priced": self.is_inverse_priced,
+            "last_price": self.last_price,
+            "maintenance_margin": self.maintenance_margin,
+            "max_leverage": self.max_leverage,
+            "price_dp": self.price_dp,
+            "symbol": self.symbol,
+            "underlying_symbol": self.underlying_symbol,
+            "tick_size": self.tick_size,
+        }
 
 def parse_tradable_symbols(msg=None):
     tradable_symbols = TradableSymbol()
@@ -104,16 +179,23 @@ def parse_tradable_symbols(msg=None):
         tradable_symbols.last_price = float(msg["last_price"])
         tradable_symbols.maintenance_margin = float(msg["maintenance_margin"])
         tradable_symbols.max_leverage = float(msg["max_leverage"])
-        tradable_symbols.price_dp = int(msg["price_dp"])
+        tradable_symbols.price_dp = int(msg["price_dp"] or 0)
         tradable_symbols.symbol = msg["symbol"]
         tradable_symbols.underlying_symbol = msg["underlying_symbol"]
         tradable_symbols.tick_size = float(msg["tick_size"])
+        tradable_symbols.raw_tick_size = max(tradable_symbols.to_raw(tradable_symbols.tick_size), 1)
     return tradable_symbols
 
 class OpenOrder(object):
+    """ An order of ours, resting or about to be sent. price is the raw integer
+        price. The ext_order_id is only generated when first read, so orders
+        built for a requote and then dropped by the diff never pay for one.
+    """
+    __slots__ = ("_ext_order_id", "quantity", "order_id", "price", "timestamp", "filled",
+        "order_type", "side", "symbol", "leverage", "margin_type", "settlement_type")
 
     def __init__(self):
-        self.ext_order_id = str(uuid.uuid4())
+        self._ext_order_id = None
         self.quantity = 0
         self.order_id = 0
         self.price = 0
@@ -126,6 +208,16 @@ class OpenOrder(object):
         self.margin_type = ""
         self.settlement_type = ""
 
+    @property
+    def ext_order_id(self):
+        if self._ext_order_id is None:
+            self._ext_order_id = str(uuid.uuid4())
+        return self._ext_order_id
+
+    @ext_order_id.setter
+    def ext_order_id(self, value):
+        self._ext_order_id = value
+
     def to_dict(self):
         return {
             "quantity": self.quantity,
@@ -142,17 +234,15 @@ class OpenOrder(object):
             "settlement_type": self.settlement_type
         }
 
-def parse_open_order(msg=None, dp=None):
+def parse_open_order(msg=None):
     open_order = OpenOrder()
     if msg:
-        if not dp:
-            dp = 0
         open_order.quantity = int(msg["quantity"])
         open_order.order_id = int(msg["order_id"])
-        open_order.price = float(msg["price"]) * (10**-dp)
+        open_order.price = int(msg["price"])
         open_order.timestamp = msg["timestamp"]
         open_order.filled = int(msg["filled"])
-        open_order.ext_order_id = int(msg["order_id"])
+        open_order.ext_order_id = msg.get("ext_order_id") or int(msg["order_id"])
         open_order.order_type = msg["order_type"]
         open_order.side = msg["side"]
         open_order.symbol = msg["symbol"]
@@ -161,7 +251,197 @@ def parse_open_order(msg=None, dp=None):
         open_order.settlement_type = msg["settlement_type"]
     return open_order
 
+class OpenOrders(object):
+    """ The resting orders of one symbol. Orders are indexed by order_id and
+        ext_order_id, and each side is kept sorted best price first so the
+        convergence step can walk it without sorting.
+
+        The message thread changes the orders while the requote thread walks
+        them, so the sorted lists handed out by bids() and asks() are never
+        changed: adding or removing an order swaps in a new list.
+    """
+
+    def __init__(self, orders=()):
+        self.by_id = {}
+        self.by_ext_id = {}
+        # Parallel lists per side: sort keys and the orders they belong to.
+        self._bid_keys = []
+        self._bid_orders = []
+        self._ask_keys = []
+        self._ask_orders = []
+        # Running totals per side over the unfilled quantity of every order:
+        # contracts, contracts / raw price and contracts * raw price. They
+        # give the value resting on a side without walking the orders.
+        self.bid_quantity = 0
+        self.ask_quantity = 0
+        self.bid_inverse_value = 0.0
+        self.ask_inverse_value = 0.0
+        self.bid_value = 0.0
+        self.ask_value = 0.0
+        for order in orders:
+            self.add(order)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self._bid_orders + self._ask_orders)
+
+    def __contains__(self, order_id):
+        return order_id in self.by_id
+
+    def _side(self, order):
+        if order.side == "Bid":
+            return self._bid_keys, self._bid_orders, (-order.price, order.order_id)
+        return self._ask_keys, self._ask_orders, (order.price, order.order_id)
+
+    def _set_orders(self, side, orders):
+        if side == "Bid":
+            self._bid_orders = orders
+        else:
+            self._ask_orders = orders
+
+    def _account(self, order, quantity):
+        """ Adds quantity contracts of the order (negative to take them off)
+            to the totals of its side.
+        """
+        price = order.price
+        if order.side == "Bid":
+            self.bid_quantity += quantity
+            if self.bid_quantity <= 0:
+                # Start over from exact zeros rather than accumulate float error.
+                self.bid_quantity = 0
+                self.bid_inverse_value = self.bid_value = 0.0
+            elif price:
+                self.bid_inverse_value += quantity / price
+                self.bid_value += quantity * price
+        else:
+            self.ask_quantity += quantity
+            if self.ask_quantity <= 0:
+                self.ask_quantity = 0
+                self.ask_inverse_value = self.ask_value = 0.0
+            elif price:
+                self.ask_inverse_value += quantity / price
+                self.ask_value += quantity * price
+
+    def get(self, order_id, default=None):
+        return self.by_id.get(order_id, default)
+
+    def get_by_ext_id(self, ext_order_id, default=None):
+        return self.by_ext_id.get(ext_order_id, default)
+
+    def add(self, order):
+        """ Adds an order, replacing any order with the same order_id. """
+        if order.order_id in self.by_id:
+            self.remove(order.order_id)
+        keys, orders, key = self._side(order)
+        i = bisect_left(keys, key)
+        keys.insert(i, key)
+        self._set_orders(order.side, orders[:i] + [order] + orders[i:])
+        self.by_id[order.order_id] = order
+        self.by_ext_id[order.ext_order_id] = order
+        self._account(order, order.quantity - order.filled)
+
+    def remove(self, order_id):
+        """ Removes and returns the order, or None if it isn't resting. """
+        order = self.by_id.pop(order_id, None)
+        if order is None:
+            return None
+        self.by_ext_id.pop(order.ext_order_id, None)
+        keys, orders, key = self._side(order)
+        i = bisect_left(keys, key)
+        del keys[i]
+        self._set_orders(order.side, orders[:i] + orders[i + 1:])
+        self._account(order, -max(order.quantity - order.filled, 0))
+        return order
+
+    def fill(self, order_id, quantity):
+        """ Records a fill against a resting order, removing it once it is fully
+            filled. Returns the order, or None if it isn't resting.
+        """
+        order = self.by_id.get(order_id)
+        if order is None:
+            return None
+        self._account(order, -min(quantity, max(order.quantity - order.filled, 0)))
+        order.filled += quantity
+        if order.filled >= order.quantity:
+            self.remove(order_id)
+        return order
+
+    def bids(self):
+        """ Resting bids, highest price first. Do not modify the returned list. """
+        return self._bid_orders
+
+    def asks(self):
+        """ Resting asks, lowest price first. Do not modify the returned list. """
+        return self._ask_orders
+
+# Seconds an order message counts as in flight without an answer. A place the
+# exchange never acknowledged, or a cancel of an order that was gone already,
+# stops counting after this.
+IN_FLIGHT_TIMEOUT_S = 2.0
+
+class InFlightOrders(object):
+    """ Our order messages of one symbol the exchange hasn't answered yet:
+        places by ext_order_id, as orders without an order_id, and cancels by
+        order_id. The requote thread adds to them and the message thread
+        takes the answered ones away, so readers get copies.
+    """
+
+    def __init__(self):
+        # ext_order_id -> (order, sent at) and order_id -> sent at.
+        self.places = {}
+        self.cancels = {}
+        # Messages that went unanswered for IN_FLIGHT_TIMEOUT_S.
+        self.expired = 0
+
+    def __bool__(self):
+        return bool(self.places or self.cancels)
+
+    def on_place(self, order, now):
+        self.places[order.ext_order_id] = (order, now)
+
+    def on_cancel(self, order_id, now):
+        self.cancels[order_id] = now
+
+    def acknowledge_place(self, ext_order_id):
+        """ Returns True if the place was in flight. """
+        return self.places.pop(ext_order_id, None) is not None
+
+    def acknowledge_cancel(self, order_id):
+        return self.cancels.pop(order_id, None) is not None
+
+    def pending(self, side):
+        """ Returns the places of the side in flight. """
+        return [order for order, _ in list(self.places.values()) if order.side == side]
+
+    def cancelling(self):
+        """ Returns the order_ids of the cancels in flight. """
+        return set(list(self.cancels))
+
+    def expire(self, now):
+        """ Forgets the messages that went unanswered for too long. Returns
+            True if there were any.
+        """
+        stale_places = [ext_order_id for ext_order_id, (_, sent_at) in list(self.places.items())
+            if now - sent_at > IN_FLIGHT_TIMEOUT_S]
+        stale_cancels = [order_id for order_id, sent_at in list(self.cancels.items())
+            if now - sent_at > IN_FLIGHT_TIMEOUT_S]
+        for ext_order_id in stale_places:
+            self.places.pop(ext_order_id, None)
+        for order_id in stale_cancels:
+            self.cancels.pop(order_id, None)
+        self.expired += len(stale_places) + len(stale_cancels)
+        return bool(stale_places or stale_cancels)
+
+    def clear(self):
+        self.places.clear()
+        self.cancels.clear()
+
 class Position(object):
+    __slots__ = ("symbol", "quantity", "entry_price", "leverage", "liq_price",
+        "open_order_ids", "side", "timestamp", "upnl", "rpnl")
+
     def __init__(self):
         self.symbol = ""
         self.quantity = 0
@@ -181,6 +461,7 @@ class Position(object):
             "entry_price": self.entry_price,
             "leverage": self.leverage,
             "liq_price": self.liq_price,
+            "open_order_ids": self.open_order_ids,
             "side": self.side,
             "timestamp": self.timestamp,
             "upnl": self.upnl,
@@ -202,10 +483,149 @@ def parse_position(msg=None):
         position.rpnl = float(msg["rpnl"])
     return position
 
+class BookSide(object):
+    """ One side of a price level book keyed by Kollider's integer raw prices.
+        Levels live in two parallel int64 arrays sorted by ascending price on
+        both sides, so the best bid is the last level and the best ask the
+        first one. Deltas search a list copy of the prices: bisecting an array
+        boxes every element it compares, which made applying a delta slower
+        than in the OOBTree this replaced.
+    """
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self.prices = array("q")
+        self.sizes = array("q")
+        self.price_list = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __bool__(self):
+        return len(self.prices) > 0
+
+    def best(self):
+        """ Returns the best raw price or None if the side is empty. """
+        if not self.prices:
+            return None
+        return self.prices[-1] if self.is_bid else self.prices[0]
+
+    def best_size(self):
+        if not self.sizes:
+            return None
+        return self.sizes[-1] if self.is_bid else self.sizes[0]
+
+    def get(self, price, default=None):
+        i = bisect_left(self.price_list, price)
+        if i < len(self.price_list) and self.price_list[i] == price:
+            return self.sizes[i]
+        return default
+
+    def items(self):
+        """ Returns (price, size) pairs in ascending price order. """
+        return list(zip(self.prices, self.sizes))
+
+    def depth(self, n):
+        """ Returns the best n levels as (prices, sizes) numpy arrays, best first. """
+        if self.is_bid:
+            start = max(len(self.prices) - n, 0)
+            prices = np.frombuffer(self.prices[start:], dtype=np.int64)[::-1]
+            sizes = np.frombuffer(self.sizes[start:], dtype=np.int64)[::-1]
+            return prices, sizes
+        return (np.frombuffer(self.prices[:n], dtype=np.int64),
+            np.frombuffer(self.sizes[:n], dtype=np.int64))
+
+    def cumulative_size(self, n=None):
+        """ Returns the running total of size from the best level outwards. """
+        if n is None:
+            n = len(self.sizes)
+        if self.is_bid:
+            start = max(len(self.sizes) - n, 0)
+            return np.frombuffer(self.sizes[start:], dtype=np.int64)[::-1].cumsum()
+        return np.frombuffer(self.sizes[:n], dtype=np.int64).cumsum()
+
+    def replace(self, levels):
+        """ Replaces the side with a {raw_price: size} mapping from a snapshot. """
+        book = sorted((int(price), size) for price, size in levels.items() if size != 0)
+        self.price_list = [price for price, _ in book]
+        self.prices = array("q", self.price_list)
+        self.sizes = array("q", [size for _, size in book])
+
+    def load(self, prices, sizes):
+        """ Replaces the side with int64 sequences of levels in ascending
+            price order.
+        """
+        self.prices = array("q", np.ascontiguousarray(prices, dtype=np.int64).tobytes())
+        self.sizes = array("q", np.ascontiguousarray(sizes, dtype=np.int64).tobytes())
+        self.price_list = self.prices.tolist()
+
+    def apply(self, levels):
+        """ Applies a {raw_price: size} delta, a size of 0 deleting the level.
+            Returns a list of prices that were deleted but not present.
+        """
+        missing = []
+        price_list = self.price_list
+        prices = self.prices
+        sizes = self.sizes
+        n = len(price_list)
+        for price, size in levels.items():
+            price = int(price)
+            i = bisect_left(price_list, price)
+            if i != n and price_list[i] == price:
+                if size:
+                    sizes[i] = size
+                else:
+                    del price_list[i]
+                    del prices[i]
+                    del sizes[i]
+                    n -= 1
+            elif size:
+                price_list.insert(i, price)
+                prices.insert(i, price)
+                sizes.insert(i, size)
+                n += 1
+            else:
+                missing.append(price)
+        return missing
+
 class Orderbook(object):
 
     def __init__(self, venue):
-        self.bids = copy.copy(OOBTree())
-        self.asks = copy.copy(OOBTree())
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
         self.level = "l2"
-        self.venue = venue
\ No newline at end of file
+        self.venue = venue
+        # Sequence number of the last update applied, if the venue sends them.
+        self.sequence = None
+        # False until the first snapshot and from a detected inconsistency
+        # until the snapshot of a resync replaced the book.
+        self.is_synced = False
+        # Monotonic time we last asked for a fresh snapshot, None if we haven't.
+        self.resync_requested = None
+        # Integrity counters: sequence gaps, deletes of levels we don't have,
+        # crossed books, and snapshots that brought the book back in sync.
+        self.gaps = 0
+        self.missing_levels = 0
+        self.crossed = 0
+        self.resyncs = 0
+        # Snapshots and deltas applied.
+        self.updates = 0
+
+    def is_crossed(self):
+        best_bid = self.bids.best()
+        best_ask = self.asks.best()
+        return best_bid is not None and best_ask is not None and best_bid >= best_ask
+
+    def integrity_stats(self):
+        return {
+            "gaps": self.gaps,
+            "missing_levels": self.missing_levels,
+            "crossed": self.crossed,
+            "resyncs": self.resyncs,
+        }
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
@@ -0,0 +1,128 @@
+""" Owns the market data connection for any number of strategy processes on the
+	same host and publishes it into a shared memory feed (see shm_feed.py).
+
+	Usage: python src/feed_handler.py [--config config.yaml]
+		[--path /dev/shm/kollider_feed] [--depth 10]
+
+	Strategies read the feed by setting feed_path in their config.
+
+	The handler reconnects like the market maker does (see reconnect.py). While
+	it is down every book of the feed is flagged out of sync, and the slots of
+	the books it holds are refreshed every second so readers notice when it
+	stops.
+"""
+import argparse
+from time import sleep, time, time_ns
+
+from kollider_api_client.ws import *
+from dtypes import ExchangeState
+from journal import JOURNAL
+from markets import load_markets
+from reconnect import ReconnectingClient
+from shm_feed import FeedPublisher, DEFAULT_DEPTH, DEFAULT_PATH
+from ws_msg_parser import parse_msg, BOOK_INVALID
+
+STATS_INTERVAL = 60
+
+class FeedHandler(ReconnectingClient, KolliderWsClient):
+
+	def __init__(self, conf, path=DEFAULT_PATH, depth=DEFAULT_DEPTH):
+		super(FeedHandler, self).__init__()
+		self.conf = conf
+		markets = load_markets(conf)
+		self.symbols = [market.symbol for market in markets]
+		self.index_symbols = sorted({market.index_symbol for market in markets})
+		self.exchange_state = ExchangeState("kollider")
+		self.exchange_state.book_symbols.update(self.symbols)
+		self.publisher = FeedPublisher(path, self.symbols + self.index_symbols, depth)
+		self.published = 0
+		self.init_reconnect(conf)
+
+		# Every applied update is published, not only those moving the top.
+		for symbol in self.symbols:
+			self.exchange_state.book_listeners[symbol] = [
+				lambda exchange_state, symbol=symbol: self.publish_book(symbol)]
+		for symbol in self.index_symbols:
+			self.exchange_state.index_listeners[symbol] = [
+				lambda exchange_state, symbol=symbol: self.publish_index(symbol)]
+
+	def publish_book(self, symbol):
+		self.publisher.publish_book(symbol, self.exchange_state.orderbooks[symbol], time_ns())
+		self.published += 1
+		return False
+
+	def publish_index(self, symbol):
+		self.publisher.publish_index(symbol, self.exchange_state.index_values[symbol].value, time_ns())
+		self.published += 1
+		return False
+
+	def publish_heartbeats(self):
+		""" Refreshes the slot of every book we hold in sync. """
+		now = time_ns()
+		for symbol in self.symbols:
+			orderbook = self.exchange_state.orderbooks.get(symbol)
+			if orderbook is not None and orderbook.is_synced:
+				self.publisher.publish_heartbeat(symbol, now)
+
+	def on_message(self, _, msg):
+		self.connection.on_frame()
+		if parse_msg(self.exchange_state, msg) == BOOK_INVALID:
+			for symbol in self.exchange_state.resync_symbols:
+				self.publisher.publish_invalid(symbol, time_ns())
+			self.resync_books()
+
+	def subscribe(self):
+		self.sub_index_price(self.index_symbols)
+		for symbol in self.symbols:
+			self.sub_orderbook_l2(symbol)
+
+	def is_ready(self):
+		""" Returns True once we hold a synced snapshot of every orderbook. """
+		for symbol in self.symbols:
+			orderbook = self.exchange_state.orderbooks.get(symbol)
+			if orderbook is None or not orderbook.is_synced:
+				return False
+		return True
+
+	def on_ready(self):
+		JOURNAL.info("system", f"Publishing {self.symbols} and {self.index_symbols} to {self.publisher.path}.")
+
+	def reset_books(self):
+		""" Flags every book of the feed out of sync until the snapshots of the
+			next connection arrive.
+		"""
+		super(FeedHandler, self).reset_books()
+		now = time_ns()
+		for symbol in self.symbols:
+			self.publisher.publish_invalid(symbol, now)
+
+	def run(self):
+		self.connect_until_ready()
+
+		last_stats = time()
+		while True:
+			self.reconnect_if_down()
+			sleep(1)
+			self.resync_books()
+			self.publish_heartbeats()
+			if time() - last_stats >= STATS_INTERVAL:
+				integrity = {symbol: orderbook.integrity_stats()
+					for symbol, orderbook in self.exchange_state.orderbooks.items()}
+				JOURNAL.info("stats", f"Published {self.published} updates. Orderbook integrity: {integrity}",
+					published=self.published, integrity=integrity, connection=self.connection.stats())
+				last_stats = time()
+
+def main():
+	import yaml
+	parser = argparse.ArgumentParser(description="Publish market data to a shared memory feed.")
+	parser.add_argument("--config", default="config.yaml")
+	parser.add_argument("--path", default=DEFAULT_PATH)
+	parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH, help="levels published per side")
+	args = parser.parse_args()
+
+	with open(args.config) as f:
+		conf = yaml.load(f, Loader=yaml.FullLoader)
+	FeedHandler(conf, args.path, args.depth).run()
+
+if __name__ == "__main__":
+	main()
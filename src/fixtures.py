@@ -0,0 +1,128 @@
+""" Deterministic synthetic market data, symbols and orders shared by the
+	benchmarks, the mock exchange and the tests.
+"""
+import json
+import random
+from itertools import islice
+
+from dtypes import OpenOrder, parse_tradable_symbols
+
+def synthetic_deltas(num_deltas, depth=50, tick=5, mid=400000, seed=42):
+	""" Returns a deterministic (snapshot, deltas) pair shaped like Kollider's
+		level2state frames: {raw_price (str): size} per side. The mid drifts in
+		a random walk, levels inside the book get resized and levels at the top
+		get added and removed as it moves.
+	"""
+	rng = random.Random(seed)
+	bids = {mid - tick * (i + 1): rng.randint(1, 500) for i in range(depth)}
+	asks = {mid + tick * (i + 1): rng.randint(1, 500) for i in range(depth)}
+	snapshot = (
+		{str(p): s for p, s in bids.items()},
+		{str(p): s for p, s in asks.items()})
+	deltas = list(islice(walk_deltas(rng, bids, asks, mid, depth, tick), num_deltas))
+	return snapshot, deltas
+
+def walk_deltas(rng, bids, asks, mid, depth, tick):
+	""" Yields (bids, asks) deltas of a random walk of the book forever, keeping
+		the {raw_price: size} bids and asks it starts from up to date.
+	"""
+	while True:
+		delta_bids, delta_asks = {}, {}
+		move = rng.choice((-1, 0, 0, 1))
+		if move:
+			mid += move * tick
+			# Levels crossed by the move leave one side and open on the other,
+			# while the far end of the book is topped up to keep the depth.
+			taken, given = (asks, bids) if move > 0 else (bids, asks)
+			taken_delta, given_delta = (delta_asks, delta_bids) if move > 0 else (delta_bids, delta_asks)
+			for p in [p for p in taken if (p <= mid if move > 0 else p >= mid)]:
+				del taken[p]
+				taken_delta[str(p)] = 0
+			p = mid - move * tick
+			given[p] = rng.randint(1, 500)
+			given_delta[str(p)] = given[p]
+			far = max(taken) + tick if move > 0 else min(taken) - tick
+			taken[far] = rng.randint(1, 500)
+			taken_delta[str(far)] = taken[far]
+			for p in sorted(given, reverse=move < 0)[:max(len(given) - depth, 0)]:
+				del given[p]
+				given_delta[str(p)] = 0
+		for side, delta in ((bids, delta_bids), (asks, delta_asks)):
+			for p in rng.sample(sorted(side), min(2, len(side))):
+				side[p] = rng.randint(1, 500)
+				delta[str(p)] = side[p]
+		yield delta_bids, delta_asks
+
+def synthetic_frames(num_frames, symbol="BTCUSD.PERP", index_symbol=".BTCUSD", seed=42):
+	""" Returns (setup frames, frames) as raw JSON strings in the mix we see at
+		peak: mostly L2 deltas, plus tickers, deltas for a symbol we don't quote,
+		index values and account updates.
+	"""
+	rng = random.Random(seed)
+	snapshot, deltas = synthetic_deltas(num_frames, seed=seed)
+	def frame(t, data):
+		return json.dumps({"type": t, "data": data})
+	setup = [frame("level2state", {
+		"symbol": symbol, "update_type": "snapshot", "seq_number": 0,
+		"bids": snapshot[0], "asks": snapshot[1]})]
+	frames = []
+	deltas = iter(deltas)
+	# Sequence numbers run per symbol.
+	seq = other_seq = 0
+	for _ in range(num_frames):
+		roll = rng.random()
+		if roll < 0.6:
+			bids, asks = next(deltas)
+			seq += 1
+			frames.append(frame("level2state", {
+				"symbol": symbol, "update_type": "delta", "seq_number": seq,
+				"bids": bids, "asks": asks}))
+		elif roll < 0.75:
+			frames.append(frame("ticker", {
+				"symbol": symbol, "best_bid": "39995.0", "best_ask": "40005.0",
+				"last_price": "40000.0", "last_quantity": rng.randint(1, 100)}))
+		elif roll < 0.85:
+			other_seq += 1
+			frames.append(frame("level2state", {
+				"symbol": "ETHUSD.PERP", "update_type": "delta", "seq_number": other_seq,
+				"bids": {"30000": rng.randint(1, 500)}, "asks": {}}))
+		elif roll < 0.95:
+			frames.append(frame("index_values", {
+				"symbol": index_symbol, "denom": "USD",
+				"value": 40000 + rng.uniform(-10, 10)}))
+		else:
+			frames.append(frame("user_accounts", {
+				"accounts": {"cash": {"balance": str(rng.randint(0, 10**8))}}}))
+	return setup, frames
+
+def synthetic_ladder(num_levels, side, start_price, step, quantity=2, order_id=0):
+	""" Returns num_levels orders stepping away from start_price, best first. """
+	direction = -1 if side == "Bid" else 1
+	orders = []
+	for i in range(num_levels):
+		order = OpenOrder()
+		order.side = side
+		order.price = start_price + direction * i * step
+		order.quantity = quantity + i
+		order.order_id = order_id + i
+		orders.append(order)
+	return orders
+
+def synthetic_symbol_info(symbol="BTCUSD.PERP", underlying_symbol=".BTCUSD"):
+	""" Returns the tradable_symbols entry of an inverse contract quoted in half
+		dollar ticks.
+	"""
+	return {
+		"base_margin": "0.01", "contract_size": 1, "is_inverse_priced": True, "last_price": "40000",
+		"maintenance_margin": "0.005", "max_leverage": "100", "price_dp": 1,
+		"symbol": symbol, "underlying_symbol": underlying_symbol, "tick_size": "0.5"}
+
+def synthetic_tradable_symbol(symbol="BTCUSD.PERP"):
+	return parse_tradable_symbols(synthetic_symbol_info(symbol))
+
+def synthetic_trading_params(num_levels):
+	return {
+		"reference_price_type": "mid", "leverage": 100, "min_spread": 0.0005, "offset_pct": 0.0001,
+		"stack_pct": 0.0001, "relist_tolerance": 0.00005, "is_random_order_size": False,
+		"start_order_size": 2, "order_step_size": 10, "num_levels": num_levels,
+		"max_long_pos_btc": 100, "max_short_pos_btc": 100}
@@ -0,0 +1,71 @@
+""" Compact append-only log of raw websocket frames.
+
+	Each record is a little-endian header of the receive time in nanoseconds
+	since the epoch (int64) and the payload length (uint32), followed by the
+	UTF-8 encoded frame.
+"""
+import mmap
+import os
+import struct
+from time import time_ns
+
+RECORD_HEADER = struct.Struct("<qI")
+
+class FrameRecorder(object):
+	""" Appends every frame it is given to a log file. Writes are buffered; call
+		flush() or close() to make sure everything hit the disk.
+	"""
+
+	def __init__(self, path, buffer_size=1 << 16):
+		self.path = path
+		self.file = open(path, "ab", buffering=buffer_size)
+		self.count = 0
+
+	def record(self, frame, timestamp_ns=None):
+		if timestamp_ns is None:
+			timestamp_ns = time_ns()
+		if isinstance(frame, str):
+			frame = frame.encode()
+		self.file.write(RECORD_HEADER.pack(timestamp_ns, len(frame)))
+		self.file.write(frame)
+		self.count += 1
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+def iter_frames(buffer):
+	""" Yields (timestamp_ns, frame) from a buffer holding a frame log. A
+		truncated last record, e.g. from a crash mid-write, is ignored.
+	"""
+	offset = 0
+	size = len(buffer)
+	header_size = RECORD_HEADER.size
+	unpack_from = RECORD_HEADER.unpack_from
+	while offset + header_size <= size:
+		timestamp_ns, length = unpack_from(buffer, offset)
+		offset += header_size
+		if offset + length > size:
+			break
+		yield timestamp_ns, str(buffer[offset:offset + length], "utf-8")
+		offset += length
+
+def open_frame_log(path):
+	""" Memory-maps a frame log read-only. The mapping can be shared by every
+		reader of the file and is passed to iter_frames.
+	"""
+	with open(path, "rb") as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return b""
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_frames(path):
+	""" Yields (timestamp_ns, frame) for every frame recorded in the log file. """
+	buffer = open_frame_log(path)
+	try:
+		yield from iter_frames(buffer)
+	finally:
+		if isinstance(buffer, mmap.mmap):
+			buffer.close()
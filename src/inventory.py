@@ -0,0 +1,96 @@
+""" Our position in each market as a running exposure in BTC.
+
+	Position messages set the exposure and fills move it in between, each in
+	constant time, so requotes read it instead of recomputing it. The share of
+	the position limit we use skews the ladder continuously (see build_ladder)
+	rather than turning a whole side off once the limit is hit.
+"""
+from ladder import contract_qty_to_btc
+
+class Inventory(object):
+	""" The signed position of one symbol: positive long, negative short. """
+	__slots__ = ("symbol", "contracts", "btc", "is_stale")
+
+	def __init__(self, symbol):
+		self.symbol = symbol
+		self.contracts = 0
+		self.btc = 0.0
+		# Set while we hold a position of a contract we know nothing about yet.
+		self.is_stale = False
+
+class InventoryManager(object):
+	""" Keeps the Inventory of every symbol up to date from the position and
+		fill events of the exchange state.
+	"""
+
+	def __init__(self, exchange_state, symbols):
+		self.exchange_state = exchange_state
+		self.inventories = {}
+		for symbol in symbols:
+			self.inventories[symbol] = Inventory(symbol)
+			exchange_state.position_listeners.setdefault(symbol, []).append(
+				lambda exchange_state, position, symbol=symbol: self.on_position(symbol, position))
+			exchange_state.fill_listeners.setdefault(symbol, []).append(
+				lambda exchange_state, order, quantity, symbol=symbol: self.on_fill(symbol, order, quantity))
+
+	def on_position(self, symbol, position):
+		""" Replaces the exposure with the exchange's view of the position. """
+		inventory = self.inventories[symbol]
+		contract = self.exchange_state.tradable_symbols.get(symbol)
+		inventory.contracts = 0
+		inventory.btc = 0.0
+		inventory.is_stale = False
+		if position is None or position.quantity == 0:
+			return
+		sign = 1 if position.side == "Bid" else -1
+		inventory.contracts = sign * position.quantity
+		if contract is None:
+			inventory.is_stale = True
+		elif position.entry_price != 0:
+			inventory.btc = sign * contract_qty_to_btc(position.quantity, position.entry_price,
+				contract.is_inverse_priced, contract.contract_size)
+
+	def on_fill(self, symbol, order, quantity):
+		""" Moves the exposure by a fill of one of our orders, until the next
+			position message sets it again.
+		"""
+		inventory = self.inventories[symbol]
+		contract = self.exchange_state.tradable_symbols.get(symbol)
+		sign = 1 if order.side == "Bid" else -1
+		inventory.contracts += sign * quantity
+		if contract is None:
+			inventory.is_stale = True
+			return
+		inventory.btc += sign * contract_qty_to_btc(quantity, contract.from_raw(order.price),
+			contract.is_inverse_priced, contract.contract_size)
+
+	def exposure_btc(self, symbol):
+		""" Returns the signed exposure of the symbol in BTC. """
+		inventory = self.inventories[symbol]
+		if inventory.is_stale and symbol in self.exchange_state.tradable_symbols:
+			self.on_position(symbol, self.exchange_state.positions.get(symbol))
+		return inventory.btc
+
+	def long_btc_remaining(self, symbol, max_long_pos_btc):
+		""" Returns how much more BTC we may buy. """
+		return max_long_pos_btc - self.exposure_btc(symbol)
+
+	def short_btc_remaining(self, symbol, max_short_pos_btc):
+		""" Returns how much more BTC we may sell. """
+		return max_short_pos_btc + self.exposure_btc(symbol)
+
+	def ratio(self, symbol, max_long_pos_btc, max_short_pos_btc):
+		""" Returns the exposure as a share of the limit on its side, from -1 at
+			the short limit to 1 at the long limit.
+		"""
+		btc = self.exposure_btc(symbol)
+		if btc == 0:
+			return 0.0
+		limit = max_long_pos_btc if btc > 0 else max_short_pos_btc
+		if limit <= 0:
+			return 1.0 if btc > 0 else -1.0
+		return max(-1.0, min(1.0, btc / limit))
+
+	def stats(self):
+		return {symbol: {"contracts": inventory.contracts, "btc": inventory.btc}
+			for symbol, inventory in self.inventories.items()}
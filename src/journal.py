@@ -0,0 +1,253 @@
+""" Structured event journal.
+
+	Events are tuples appended to a deque by the thread producing them and
+	written out by a background thread in batches: one JSON object per line
+	to the journal file, and a plain line to stdout for the categories we
+	echo. Producers never format, serialise or touch a file, so logging costs
+	the tick path an append.
+
+	Levels and sampling are checked before anything is built: an event below
+	the level of its category, or not picked by the 1 in n sampling of its
+	category, costs a comparison.
+
+	Usage: python src/journal.py journal.ndjson [--category order]
+		[--level warning] [--grep text] [--follow] [--summary]
+"""
+import argparse
+import atexit
+import json
+import os
+import sys
+import threading
+from collections import Counter, deque
+from time import sleep, strftime, localtime, time_ns
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+# Categories echoed to stdout whatever their level. Anything at WARNING or
+# above is echoed too.
+ECHO_CATEGORIES = frozenset(("system", "stats", "dry_run"))
+
+# Events queued before producers start dropping them.
+MAX_QUEUED = 1 << 16
+
+class Journal(object):
+
+	def __init__(self):
+		self.path = None
+		self.file = None
+		self.levels = {}
+		self.default_level = INFO
+		# The lowest level of any category, checked first.
+		self.level = INFO
+		self.sample = {}
+		self.sampled = Counter()
+		self.echo = ECHO_CATEGORIES
+		self.flush_interval = 0.1
+		self.queue = deque()
+		self.dropped = 0
+		self.written = 0
+		self.thread = None
+		self.wake = threading.Event()
+		self.stopped = False
+		self.lock = threading.Lock()
+		os.register_at_fork(after_in_child=self._after_fork)
+
+	def configure(self, path=None, level="info", levels=None, sample=None, echo=None, flush_ms=100):
+		""" path: NDJSON file to append to, or None to only echo.
+			level: lowest level recorded; levels: per category overrides.
+			sample: {category: n} records one in n events of the category.
+			echo: categories echoed to stdout besides warnings and errors.
+		"""
+		self.flush()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		self.path = path or None
+		if self.path:
+			self.file = open(self.path, "a", buffering=1 << 16)
+		self.default_level = LEVELS[level] if isinstance(level, str) else level
+		self.levels = {category: LEVELS[value] if isinstance(value, str) else value
+			for category, value in (levels or {}).items()}
+		self.level = min([self.default_level] + list(self.levels.values()))
+		self.sample = {category: int(n) for category, n in (sample or {}).items() if int(n) > 1}
+		self.echo = frozenset(echo) if echo is not None else ECHO_CATEGORIES
+		self.flush_interval = flush_ms / 1000.0
+
+	def event(self, category, level, message=None, **fields):
+		""" Records an event. message is the text echoed to stdout, or a
+			function returning it, called on the writer thread. fields go into
+			the journal as they are (anything json can't encode as str).
+		"""
+		if level < self.level or level < self.levels.get(category, self.default_level):
+			return
+		if self.sample:
+			n = self.sample.get(category)
+			if n is not None:
+				seen = self.sampled[category]
+				self.sampled[category] = seen + 1
+				if seen % n:
+					return
+		if len(self.queue) >= MAX_QUEUED:
+			self.dropped += 1
+			return
+		self.queue.append((time_ns(), category, level, message, fields))
+		if self.thread is None:
+			self._start()
+		elif level >= ERROR:
+			self.wake.set()
+
+	def debug(self, category, message=None, **fields):
+		self.event(category, DEBUG, message, **fields)
+
+	def info(self, category, message=None, **fields):
+		self.event(category, INFO, message, **fields)
+
+	def warning(self, category, message=None, **fields):
+		self.event(category, WARNING, message, **fields)
+
+	def error(self, category, message=None, **fields):
+		self.event(category, ERROR, message, **fields)
+
+	def _start(self):
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.stopped = False
+			self.thread = threading.Thread(target=self._writer, name="journal", daemon=True)
+			self.thread.start()
+			atexit.register(self.close)
+
+	def _writer(self):
+		while not self.stopped:
+			self.wake.wait(self.flush_interval)
+			self.wake.clear()
+			self.flush()
+
+	def flush(self):
+		""" Writes out everything queued so far. """
+		with self.lock:
+			queue = self.queue
+			lines = []
+			echoed = []
+			echo = self.echo
+			while queue:
+				timestamp_ns, category, level, message, fields = queue.popleft()
+				if callable(message):
+					message = message()
+				record = {"ts": timestamp_ns, "level": LEVEL_NAMES.get(level, level), "cat": category}
+				if message is not None:
+					record["msg"] = message
+				if fields:
+					record["data"] = fields
+				if self.file is not None:
+					lines.append(json.dumps(record, default=str))
+				if level >= WARNING or category in echo:
+					echoed.append(message if message is not None else f"{category}: {json.dumps(fields, default=str)}")
+			if lines:
+				self.file.write("\n".join(lines))
+				self.file.write("\n")
+				self.file.flush()
+				self.written += len(lines)
+			if echoed:
+				sys.stdout.write("\n".join(echoed))
+				sys.stdout.write("\n")
+				sys.stdout.flush()
+
+	def close(self):
+		self.stopped = True
+		self.wake.set()
+		thread = self.thread
+		if thread is not None and thread is not threading.current_thread():
+			thread.join(timeout=1)
+		self.thread = None
+		self.flush()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def stats(self):
+		return {"queued": len(self.queue), "written": self.written, "dropped": self.dropped}
+
+	def _after_fork(self):
+		# The writer thread doesn't survive a fork. The child starts its own
+		# on its first event.
+		self.thread = None
+		self.lock = threading.Lock()
+		self.wake = threading.Event()
+		self.queue = deque()
+
+# The journal shared by every module of the process.
+JOURNAL = Journal()
+
+def read_journal(path, follow=False):
+	""" Yields the records of a journal file, waiting for more at the end if
+		follow is set.
+	"""
+	with open(path, "rb") as f:
+		while True:
+			line = f.readline()
+			if not line:
+				if not follow:
+					return
+				sleep(0.2)
+				continue
+			if not line.endswith(b"\n"):
+				# A line still being written.
+				f.seek(-len(line), os.SEEK_CUR)
+				sleep(0.05)
+				continue
+			yield json.loads(line)
+
+def format_record(record):
+	ts = record["ts"]
+	when = strftime("%Y-%m-%d %H:%M:%S", localtime(ts // 1_000_000_000)) + f".{ts % 1_000_000_000 // 1000:06d}"
+	text = f"{when} {record['level']:<7} {record['cat']:<10}"
+	if "msg" in record:
+		text += " " + record["msg"].replace("\n", "\n" + " " * 46)
+	if "data" in record:
+		text += " " + json.dumps(record["data"])
+	return text
+
+def main():
+	parser = argparse.ArgumentParser(description="Print the events of a journal.")
+	parser.add_argument("path")
+	parser.add_argument("--category", action="append", help="only these categories (repeatable)")
+	parser.add_argument("--level", default="debug", choices=sorted(LEVELS, key=LEVELS.get))
+	parser.add_argument("--grep", help="only events whose line contains this text")
+	parser.add_argument("--follow", "-f", action="store_true", help="keep printing new events")
+	parser.add_argument("--summary", action="store_true", help="count events per category and level instead")
+	args = parser.parse_args()
+
+	min_level = LEVELS[args.level]
+	counts = Counter()
+	first = last = None
+	for record in read_journal(args.path, args.follow and not args.summary):
+		if args.category and record["cat"] not in args.category:
+			continue
+		if LEVELS.get(record["level"].lower(), 0) < min_level:
+			continue
+		text = format_record(record)
+		if args.grep and args.grep not in text:
+			continue
+		if args.summary:
+			counts[(record["cat"], record["level"])] += 1
+			first = record["ts"] if first is None else first
+			last = record["ts"]
+			continue
+		print(text)
+
+	if args.summary:
+		if first is not None:
+			print(f"{sum(counts.values())} events over {(last - first) / 1e9:.1f}s")
+		for (category, level), count in sorted(counts.items()):
+			print(f"{category:<12}{level:<9}{count:>10}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,137 @@
+""" Builds the quote ladder of both sides in a handful of numpy operations
+	rather than an order object per level.
+"""
+import numpy as np
+
+_EMPTY = np.zeros(0, dtype=np.int64)
+
+_DIRECTIONS = np.array((-1.0, 1.0))
+
+_rng = np.random.default_rng()
+
+def contract_qty_to_btc(contract_qty, price, is_inverse_priced, contract_size):
+	# for quantos, this assumes that (price * contract_size) == satoshis per contract
+	# Works on scalars as well as numpy arrays of quantities and prices.
+	if is_inverse_priced:
+		return contract_qty / price
+	else:
+		# 100_000_000 == satoshis per BTC
+		return (contract_qty * price * contract_size) / 100_000_000
+
+class Ladder(object):
+	""" The desired quotes of a symbol as int64 arrays of raw prices and
+		quantities per side, best price first.
+	"""
+	__slots__ = ("bid_prices", "bid_quantities", "ask_prices", "ask_quantities")
+
+	def __init__(self, bid_prices=_EMPTY, bid_quantities=_EMPTY, ask_prices=_EMPTY, ask_quantities=_EMPTY):
+		self.bid_prices = bid_prices
+		self.bid_quantities = bid_quantities
+		self.ask_prices = ask_prices
+		self.ask_quantities = ask_quantities
+
+	def __len__(self):
+		return len(self.bid_prices) + len(self.ask_prices)
+
+	def key(self):
+		""" Returns a hashable snapshot of the ladder for change detection. """
+		return (self.bid_prices.tobytes(), self.bid_quantities.tobytes(),
+			self.ask_prices.tobytes(), self.ask_quantities.tobytes())
+
+def level_quantities(trading_params, rng=None):
+	""" Returns the order size of every level, innermost first. Fixed sizes
+		come precomputed with the params.
+	"""
+	if trading_params.is_random_order_size:
+		return (rng or _rng).integers(
+			trading_params.min_order_size, trading_params.max_order_size,
+			size=trading_params.num_levels, endpoint=True, dtype=np.int64)
+	return trading_params.level_sizes
+
+def ladder_prices(start_price_bid, start_price_ask, level_steps, raw_tick_size):
+	""" Returns a (2, num_levels) array of tick-rounded raw prices, bids in the
+		first row and asks in the second, each level_steps (a share of the
+		start price per level) away from its start price, best first.
+	"""
+	starts = np.array((start_price_bid, start_price_ask))
+	raw = starts[:, None] * (1 + _DIRECTIONS[:, None] * level_steps)
+	return np.rint(raw / raw_tick_size).astype(np.int64) * raw_tick_size
+
+def clip_to_inventory(prices, quantities, remaining_btc, tradable_symbol):
+	""" Drops the levels beyond the first remaining_btc of exposure, counted
+		from the best level outwards, and shrinks the level straddling the limit.
+	"""
+	if remaining_btc <= 0 or not len(prices):
+		return _EMPTY, _EMPTY
+	scale = 10.0**-tradable_symbol.price_dp
+	inverse = tradable_symbol.is_inverse_priced
+	contract_size = tradable_symbol.contract_size
+	# Cheap upper bound first: the whole side at its most expensive price.
+	worst_price = min(prices[0], prices[-1]) if inverse else max(prices[0], prices[-1])
+	if contract_qty_to_btc(int(quantities.sum()), worst_price * scale, inverse, contract_size) <= remaining_btc:
+		return prices, quantities
+	exposure = contract_qty_to_btc(quantities, prices * scale, inverse, contract_size)
+	total = np.cumsum(exposure)
+	if total[-1] <= remaining_btc:
+		return prices, quantities
+	keep = int(np.searchsorted(total, remaining_btc, side="right"))
+	left = remaining_btc - (total[keep - 1] if keep else 0)
+	partial = int(quantities[keep] * left / exposure[keep])
+	if partial <= 0:
+		return prices[:keep], quantities[:keep]
+	quantities = quantities[:keep + 1].copy()
+	quantities[keep] = partial
+	return prices[:keep + 1], quantities
+
+def inventory_skew(trading_params, inventory_ratio):
+	""" Returns (price factor, bid size factor, ask size factor) for our
+		position as a share of its limit, from -1 (short) to 1 (long).
+
+		Both start prices move by inventory_skew_pct of the price at the limit,
+		down when long and up when short, and the side adding to the position
+		shrinks by inventory_size_skew of its size at the limit.
+	"""
+	if not inventory_ratio:
+		return 1.0, 1.0, 1.0
+	price_factor = 1 - trading_params.inventory_skew_pct * inventory_ratio
+	size_skew = trading_params.inventory_size_skew * inventory_ratio
+	return price_factor, min(1.0, max(0.0, 1 - size_skew)), min(1.0, max(0.0, 1 + size_skew))
+
+def build_ladder(start_price_bid, start_price_ask, trading_params, tradable_symbol,
+		long_btc_remaining, short_btc_remaining, rng=None, inventory_ratio=0.0):
+	""" Returns the Ladder for raw start prices. Levels with no size are left
+		out and each side is clipped to the position we have room for, unless
+		that is None. The inventory_ratio skews prices and sizes against our
+		position.
+	"""
+	num_levels = trading_params.num_levels
+	if num_levels <= 0:
+		return Ladder()
+	price_factor, bid_factor, ask_factor = inventory_skew(trading_params, inventory_ratio)
+	start_price_bid *= price_factor
+	start_price_ask *= price_factor
+	prices = ladder_prices(start_price_bid, start_price_ask, trading_params.level_steps,
+		tradable_symbol.raw_tick_size)
+	random_size = trading_params.is_random_order_size
+	quantities = None if random_size else trading_params.level_sizes
+
+	sides = []
+	for row, remaining, size_factor in ((0, long_btc_remaining, bid_factor), (1, short_btc_remaining, ask_factor)):
+		if (remaining is not None and remaining <= 0) or size_factor <= 0:
+			sides.append((_EMPTY, _EMPTY))
+			continue
+		side_prices = prices[row]
+		side_quantities = level_quantities(trading_params, rng) if random_size else quantities
+		if size_factor < 1:
+			side_quantities = (side_quantities * size_factor).astype(np.int64)
+		# Sizes are monotonic in the level unless random, so the ends tell
+		# whether any level has nothing to quote.
+		if random_size or side_quantities[0] <= 0 or side_quantities[-1] <= 0:
+			live = side_quantities > 0
+			side_prices, side_quantities = side_prices[live], side_quantities[live]
+		if remaining is not None:
+			side_prices, side_quantities = clip_to_inventory(side_prices, side_quantities, remaining, tradable_symbol)
+		sides.append((side_prices, side_quantities))
+
+	(bid_prices, bid_quantities), (ask_prices, ask_quantities) = sides
+	return Ladder(bid_prices, bid_quantities, ask_prices, ask_quantities)
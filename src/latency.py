@@ -0,0 +1,125 @@
+""" Stage timings for the tick-to-order path.
+
+	Durations are measured with the monotonic perf_counter_ns clock and kept in
+	HDR style histograms: exact up to 2 * SUB_BUCKETS nanoseconds and log-linear
+	above, giving a bounded relative error of 1 / SUB_BUCKETS while recording is
+	a couple of integer operations and a list increment.
+"""
+import signal
+import threading
+from time import perf_counter_ns
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Stages of the tick-to-order path, in the order they happen.
+STAGES = ("decode", "book", "reference_price", "ladder", "diff", "send", "tick_to_order")
+
+class LatencyHistogram(object):
+
+	def __init__(self):
+		self.counts = [0] * (4 * SUB_BUCKETS)
+		self.total = 0
+		self.max = 0
+
+	def record(self, value):
+		if value < 0:
+			value = 0
+		if value < 2 * SUB_BUCKETS:
+			index = value
+		else:
+			shift = value.bit_length() - SUB_BUCKET_BITS - 1
+			index = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+		counts = self.counts
+		if index >= len(counts):
+			counts.extend([0] * (index + 1 - len(counts)))
+		counts[index] += 1
+		self.total += 1
+		if value > self.max:
+			self.max = value
+
+	@staticmethod
+	def bucket_value(index):
+		""" Returns the highest value that falls into the bucket. """
+		if index < 2 * SUB_BUCKETS:
+			return index
+		shift = index // SUB_BUCKETS - 1
+		return (((index % SUB_BUCKETS) + SUB_BUCKETS + 1) << shift) - 1
+
+	def percentile(self, q):
+		""" Returns the value at percentile q (0-100), or 0 if empty. """
+		if not self.total:
+			return 0
+		rank = max(1, int(round(q / 100 * self.total)))
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if seen >= rank:
+				return min(self.bucket_value(index), self.max)
+		return self.max
+
+	def reset(self):
+		self.counts = [0] * (4 * SUB_BUCKETS)
+		self.total = 0
+		self.max = 0
+
+class LatencyRecorder(object):
+	""" A histogram per stage. Instrumented code checks enabled before reading
+		the clock, so a disabled recorder costs one attribute lookup per stage.
+	"""
+
+	def __init__(self, enabled=False):
+		self.enabled = enabled
+		self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+		self.dump_requested = False
+
+	def record(self, stage, start_ns, end_ns=None):
+		""" Records the time from start_ns to end_ns (default: now). """
+		if end_ns is None:
+			end_ns = perf_counter_ns()
+		histogram = self.histograms.get(stage)
+		if histogram is None:
+			histogram = self.histograms[stage] = LatencyHistogram()
+		histogram.record(end_ns - start_ns)
+
+	def report(self):
+		""" Returns a table of count, p50, p99, p99.9 and max per stage in
+			microseconds.
+		"""
+		lines = [f"{'stage':<16}{'count':>10}{'p50 us':>10}{'p99 us':>10}{'p999 us':>10}{'max us':>10}"]
+		for stage, histogram in self.histograms.items():
+			if not histogram.total:
+				continue
+			p50, p99, p999 = (histogram.percentile(q) / 1000 for q in (50, 99, 99.9))
+			lines.append(f"{stage:<16}{histogram.total:>10}{p50:>10.1f}{p99:>10.1f}{p999:>10.1f}{histogram.max / 1000:>10.1f}")
+		return "\n".join(lines)
+
+	def reset(self):
+		for histogram in self.histograms.values():
+			histogram.reset()
+
+	def request_dump(self, signum=None, frame=None):
+		""" Asks for the report on the next poll_dump. Safe to call from a
+			signal handler.
+		"""
+		self.dump_requested = True
+
+	def dump_on_signal(self, signum=getattr(signal, "SIGUSR1", None)):
+		""" Requests a dump whenever the process receives the signal. Only the
+			main thread can install signal handlers; run from another thread
+			there is no dump on signal.
+		"""
+		if signum is not None and threading.current_thread() is threading.main_thread():
+			signal.signal(signum, self.request_dump)
+
+	def poll_dump(self):
+		""" Returns the report if a dump was requested since the last poll,
+			else None.
+		"""
+		if not self.dump_requested:
+			return None
+		self.dump_requested = False
+		return self.report()
+
+# The recorder shared by the parser and the market maker.
+LATENCY = LatencyRecorder()
@@ -1,21 +1,44 @@
-from uuid import uuid4
-from ws_msg_parser import parse_msg
+from ws_msg_parser import parse_msg, BOOK_INVALID, ORDER_REJECTION
 from kollider_api_client.ws import *
 from dtypes import *
-from calculators import *
-import random
+from requote import RequoteTrigger, POLL, EVENT
+from convergence import diff_orders
+from quote_stability import AmendThrottle, is_stability_enabled, relist_tolerances
+from ladder import Ladder, build_ladder
+from markets import load_markets
+from trading_params import ConfigReloader, load_trading_params
+from frame_log import FrameRecorder
+from inventory import InventoryManager
+from reconnect import ReconnectingClient
+from state_cache import StateCache
+from shm_feed import FeedReader
+from order_scheduler import OrderScheduler, PLACE, AMEND, CANCEL, REPLACE
+from journal import JOURNAL
+from latency import LATENCY
+from risk import RiskEngine
+from metrics import MetricsServer, QuoteUptime, COUNTER, GAUGE
 from decimal import Decimal
 
+import atexit
 import json
-from time import sleep, time
-
-def contract_qty_to_btc(contract_qty, price, is_inverse_priced, contract_size):
-	# for quantos, this assumes that (price * contract_size) == satoshis per contract
-	if is_inverse_priced:
-		return contract_qty / price
-	else:
-		# 100_000_000 == satoshis per BTC
-		return (contract_qty * price * contract_size) / 100_000_000
+import signal
+import threading
+from time import perf_counter_ns, sleep, time
+
+REQUOTE_STATS_INTERVAL = 60
+
+def spreads_bps(ladder, book_top):
+	""" Returns the spread of the ladder's best quotes and of the book, both in
+		basis points of the book's mid. None for whichever is one sided.
+	"""
+	if book_top is None or book_top[0] is None or book_top[1] is None:
+		return None, None
+	best_bid, best_ask = book_top
+	mid = (best_bid + best_ask) / 2
+	quoted = None
+	if ladder is not None and len(ladder.bid_prices) and len(ladder.ask_prices):
+		quoted = (int(ladder.ask_prices[0]) - int(ladder.bid_prices[0])) / mid * 1e4
+	return quoted, (best_ask - best_bid) / mid * 1e4
 
 def toNearest(num, tickSize):
     """Given a number, round it to the nearest tick. Very useful for sussing float error
@@ -25,306 +48,664 @@ def toNearest(num, tickSize):
     tickDec = Decimal(str(tickSize))
     return float((Decimal(round(num / tickSize, 0)) * tickDec))
 
-class MarketMaker(KolliderWsClient):
-	def __init__(self, conf):
+class MarketMaker(ReconnectingClient, KolliderWsClient):
+	def __init__(self, conf, config_path=None):
 		super(MarketMaker, self).__init__()
 		self.conf = conf
-		self.target_symbol = conf["symbol"]
-		self.index_symbol = conf["index_symbol"]
+		self.markets = {market.symbol: market for market in load_markets(conf)}
 		self.exchange_state = ExchangeState("kollider")
-		self.exchange_state.symbol = self.target_symbol
-		self.exchange_state.index_symbol = conf["index_symbol"]
-
-		self.start_price_ask = None
-		self.start_price_bid = None
-
-		self.reference_price = None
-		reference_type = conf['trading_params']['reference_price_type']
-		if reference_type == "index":
-			self.reference_price = IndexPriceCalc()
-		elif reference_type == "mid":
-			self.reference_price = MidPriceCalc()
-		else:
-			raise Exception(f'Unrecognized reference_price_type {reference_type} in config. \
-				Options are "index" and "mid".')
+		self.exchange_state.book_symbols.update(self.markets)
+		for market in self.markets.values():
+			market.attach(self.exchange_state)
+		self.inventory = InventoryManager(self.exchange_state, self.markets)
+		# Picks up trading params edited in the config file while we run.
+		self.reloader = None
+		if config_path and conf.get("reload_config", True):
+			self.reloader = ConfigReloader(config_path)
+
+		# What we knew when we last ran, until the exchange tells us again.
+		self.state_cache = None
+		if conf.get("state_cache_path"):
+			self.state_cache = StateCache(conf["state_cache_path"], conf.get("state_cache_max_age_s", 10))
+			loaded = self.state_cache.load(self.exchange_state)
+			if loaded is not None:
+				JOURNAL.info("system", "Loaded {} contracts, {} positions and {} index values from {}.".format(
+					*loaded, self.state_cache.path))
+			atexit.register(self.state_cache.save, self.exchange_state)
+
+		self.init_reconnect(conf)
+
+		self.quote_uptime = QuoteUptime()
+		self.metrics = None
+		if conf.get("metrics_port"):
+			self.metrics = MetricsServer(self.collect_metrics, conf["metrics_port"], conf.get("metrics_host", "127.0.0.1"))
+
+		self.requote_mode = conf.get("requote_mode", POLL)
+		if self.requote_mode not in (POLL, EVENT):
+			raise Exception(f'Unrecognized requote_mode {self.requote_mode} in config. \
+				Options are "{POLL}" and "{EVENT}".')
+		self.requote_trigger = RequoteTrigger(conf.get("requote_debounce_ms", 0))
+
+		self.recorder = None
+		if conf.get("record_frames"):
+			self.recorder = FrameRecorder(conf["record_frames"])
+
+		self.risk = RiskEngine(self.exchange_state, self.markets, conf.get("risk_max_messages_per_s"))
+		self.kill_requested = None
+		self.amend_throttle = AmendThrottle()
+		# The senders look up place_order and friends per message so subclasses
+		# can override them.
+		self.scheduler = OrderScheduler({
+			PLACE: lambda msg: self.send_order_message(PLACE, msg),
+			AMEND: lambda msg: self.send_order_message(AMEND, msg),
+			CANCEL: lambda msg: self.send_order_message(CANCEL, msg),
+			REPLACE: lambda msgs: self.send_replacement(*msgs),
+		}, conf.get("order_rate_limit"), conf.get("order_burst"))
+
+		# Market data from a feed handler process instead of our own socket.
+		self.feed = None
+		self.feed_poll_s = conf.get("feed_poll_ms", 0.5) / 1000.0
+		if conf.get("feed_path"):
+			self.feed = FeedReader(conf["feed_path"], conf.get("feed_max_age_ms", 3000))
+			missing = [name for market in self.markets.values()
+				for name in (market.symbol, market.index_symbol) if name not in self.feed]
+			if missing:
+				raise Exception(f"The feed at {conf['feed_path']} doesn't publish {missing}.")
+		self.index_symbols = sorted({market.index_symbol for market in self.markets.values()})
+
+		if conf.get("journal_path") or conf.get("journal_level") or conf.get("journal_sample"):
+			JOURNAL.configure(conf.get("journal_path"), conf.get("journal_level") or "info",
+				conf.get("journal_levels"), conf.get("journal_sample"), conf.get("journal_echo"))
+
+		if conf.get("latency_stats"):
+			LATENCY.enabled = True
+		# Arrival time of the first frame that changed a quoting input since the
+		# last requote, and of the one the current requote is acting on.
+		self.tick_ns = None
+		self.requote_tick_ns = None
 
 	def on_message(self, _, msg):
-		parse_msg(self.exchange_state, msg)
+		received = perf_counter_ns() if LATENCY.enabled else None
+		self.connection.on_frame()
+		if self.recorder is not None:
+			self.recorder.record(msg)
+		change = parse_msg(self.exchange_state, msg)
+		if change:
+			if change == BOOK_INVALID:
+				self.resync_books()
+			if self.tick_ns is None:
+				self.tick_ns = received
+			self.requote_trigger.notify(change)
+
+	def poll_feed(self):
+		""" Applies whatever changed in the shared memory feed since the last
+			poll. Returns True if a quoting input changed.
+		"""
+		received = perf_counter_ns() if LATENCY.enabled else None
+		changes = self.feed.sync(self.exchange_state, self.markets, self.index_symbols)
+		for change in changes:
+			if change == BOOK_INVALID:
+				JOURNAL.warning("book", "An orderbook of the feed is out of sync or out of date. Pulling its quotes.")
+			if self.tick_ns is None:
+				self.tick_ns = received
+			self.requote_trigger.notify(change)
+		return bool(changes)
+
+	def _poll_feed_forever(self):
+		while True:
+			self.poll_feed()
+			sleep(self.feed_poll_s)
 
-	def update_start_prices(self):
+	def update_start_prices(self, market):
 		# Making our reference price the current index price of the trade contract.
 		# You could change this to your own reference price. 
-		self.reference_price.update_price(self.exchange_state)
+		if LATENCY.enabled:
+			start = perf_counter_ns()
+			market.reference_price.update_price(self.exchange_state)
+			LATENCY.record("reference_price", start)
+		else:
+			market.reference_price.update_price(self.exchange_state)
 
-		if not self.reference_price.is_ready():
-			print("Reference price not yet ready.")
+		if not market.reference_price.is_ready():
+			JOURNAL.info("quote", f"Reference price for {market.symbol} not yet ready.", symbol=market.symbol)
 			return False
 
-		# print(f"Reference price {self.reference_price.get_price()}")
+		# print(f"Reference price {market.reference_price.get_price()}")
 
-		tradable_symbol = self.exchange_state.tradable_symbols.get(self.target_symbol)
+		tradable_symbol = self.exchange_state.tradable_symbols.get(market.symbol)
 
 		if not tradable_symbol:
-			print("Doesn't have tradable symbol.")
+			JOURNAL.warning("quote", f"Doesn't have tradable symbol {market.symbol}.", symbol=market.symbol)
 			return None
 
-		self.start_price_bid = self.reference_price.get_price() * (1 - self.conf['trading_params']['offset_pct'])
-		self.start_price_ask = self.reference_price.get_price() * (1 + self.conf['trading_params']['offset_pct'])
+		# Start prices are kept in raw price units so the ladder can be rounded
+		# to the tick with integer arithmetic.
+		trading_params = market.trading_params
+		reference_price = tradable_symbol.to_raw(market.reference_price.get_price())
+		self.risk.reference_prices[market.symbol] = reference_price
+		market.start_price_bid = reference_price * trading_params.bid_offset
+		market.start_price_ask = reference_price * trading_params.ask_offset
 
-		# print(f"Got start prices of {self.start_price_bid} {self.start_price_ask}")
+		# print(f"Got start prices of {market.start_price_bid} {market.start_price_ask}")
 
 		# Back off if our spread is too small.
-		min_spread = self.conf['trading_params']['min_spread']
-		if self.start_price_bid * (1.00 + min_spread) > self.start_price_ask:
-			self.start_price_bid *= (1.00 - (min_spread / 2))
-			self.start_price_ask *= (1.00 + (min_spread / 2))
+		if market.start_price_bid * (1.00 + trading_params.min_spread) > market.start_price_ask:
+			market.start_price_bid *= trading_params.bid_backoff
+			market.start_price_ask *= trading_params.ask_backoff
 
 		return True
 
-	def get_order_price(self, index, side):
-		"""This creates the order stack from the starting prices given a side and index."""
-
-		start_price = self.start_price_bid if side == "Bid" else self.start_price_ask
-		# First positions (index 1, -1) should start right at start_position, others should branch from there
-		index = index - 1 if side == "Ask" else -(index - 1)
-
-		# If we're attempting to sell, but our sell price is actually lower than the buy,
-		# move over to the sell side.
-		if index > 0 and start_price < self.start_price_bid:
-			start_price = self.start_price_ask
-		# Same for buys.
-		if index < 0 and start_price > self.start_price_ask:
-			start_price = self.start_price_bid
-
-		tradable_symbol = self.exchange_state.tradable_symbols.get(self.target_symbol)
-		if not tradable_symbol:
-			return None
-
-		tick_size = tradable_symbol.tick_size
-
-		order_price = toNearest(start_price + index * start_price * conf["trading_params"]["stack_pct"], tick_size)
-		return order_price
-
-	def build_order(self, index, side):
-		"""Create an order object."""
-		trading_params = conf["trading_params"]
-		if trading_params['is_random_order_size'] is True:
-			quantity = random.randint(trading_params["min_order_size"], trading_params["max_order_size"])
-		else:
-			quantity = trading_params['start_order_size'] + \
-				trading_params['order_step_size'] * (abs(index) - 1)
-
-		price = self.get_order_price(index, side)
+	def build_order(self, market, side, price, quantity):
+		"""Create an order object for a level of the ladder."""
 		order = OpenOrder()
 		order.price = price
 		order.side = side
-		order.symbol = self.target_symbol
+		order.symbol = market.symbol
 		order.margin_type = "Isolated"
 		order.settlement_type = "Delayed"
 		order.order_type = "Limit"
-		order.ext_order_id = str(uuid4())
 		order.timestamp = int(time())
-		order.leverage = self.conf["trading_params"]["leverage"]
+		order.leverage = market.trading_params.leverage
 		order.quantity = quantity # in contract qty (vs "value")
 
 		return order
 
-	def create_orders(self):
-		buy_orders = []
-		sell_orders = []
+	def create_orders(self, market):
+		if self.risk.killed is not None:
+			return self.pull_quotes(market, "by the kill switch")
+		orderbook = self.exchange_state.orderbooks.get(market.symbol)
+		if orderbook is not None and not orderbook.is_synced:
+			return self.suspend_quoting(market)
 
-		if self.update_start_prices() is False:
+		if self.update_start_prices(market) is False:
 			return False
 
-		long_btc_remaining = self.long_btc_remaining()
-		short_btc_remaining = self.short_btc_remaining()
+		tradable_symbol = self.exchange_state.tradable_symbols.get(market.symbol)
+		if not tradable_symbol:
+			return None
 
-		trading_prams = self.conf["trading_params"]
+		if LATENCY.enabled:
+			start = perf_counter_ns()
+		trading_params = market.trading_params
+		inventory_ratio = self.inventory.ratio(
+			market.symbol, trading_params.max_long_pos_btc, trading_params.max_short_pos_btc)
+		ladder = build_ladder(
+			market.start_price_bid, market.start_price_ask, trading_params, tradable_symbol,
+			self.long_btc_remaining(market), self.short_btc_remaining(market),
+			inventory_ratio=inventory_ratio)
+		if LATENCY.enabled:
+			LATENCY.record("ladder", start)
+		market.ladder = ladder
+		if orderbook is not None:
+			market.book_top = (orderbook.best_bid(), orderbook.best_ask())
+
+		# Nothing to do if neither the ladder nor our resting orders changed
+		# since the last requote. Order messages going unanswered count as a
+		# change of our orders.
+		in_flight = self.exchange_state.in_flight_for(market.symbol)
+		if in_flight:
+			in_flight.expire(self.exchange_state.clock())
+		requote_key = (self.exchange_state.orders_version, in_flight.expired, ladder.key())
+		if not self.requote_trigger.should_requote(requote_key, market.symbol):
+			return True
 
-		for i in range(1, trading_prams["num_levels"] + 1):
+		connection = self.connection
+		if connection.down_since is not None and connection.connected:
+			since = "the connection went down" if connection.disconnects else "starting"
+			elapsed = connection.on_quote()
+			JOURNAL.info("system", f"Quoting {elapsed * 1000:.0f}ms after {since}.", time_to_quote_s=elapsed)
 
-			if long_btc_remaining > 0:
-				buy_order = self.build_order(i, 'Bid')
-				buy_order.quantity = int(buy_order.quantity)
-				if buy_order.quantity > 0:
-					buy_orders.append(buy_order)
+		if self.conf["enable_dry_run"]:
+			self.handle_dry_run(market, ladder)
+			return True
+		else:
+			return self.converge_orders(market, ladder)
+
+	def suspend_quoting(self, market):
+		""" Pulls our quotes on a symbol whose orderbook is out of sync. Quoting
+			off a book we can't trust is worse than not quoting at all.
+		"""
+		self.resync_books()
+		return self.pull_quotes(market, "until its orderbook is resynced")
+
+	def pull_quotes(self, market, why):
+		""" Cancels every order of ours on the symbol. """
+		in_flight = self.exchange_state.in_flight_for(market.symbol)
+		if in_flight:
+			in_flight.expire(self.exchange_state.clock())
+		requote_key = (self.exchange_state.orders_version, in_flight.expired, None)
+		if not self.requote_trigger.should_requote(requote_key, market.symbol):
+			return False
+		if self.conf["enable_dry_run"]:
+			JOURNAL.warning("quote", f"Quoting on {market.symbol} suspended {why}.", symbol=market.symbol)
+		else:
+			self.converge_orders(market, Ladder())
+		return False
+
+	def kill(self, reason):
+		""" The kill switch: from now on no order goes out and every requote
+			cancels whatever of ours still rests, until the process restarts.
+		"""
+		if self.risk.killed is None:
+			self.risk.kill(reason)
+			JOURNAL.error("system", f"Kill switch ({reason}): cancelling every order and quoting no more.",
+				reason=reason)
+		self.requote_trigger.reset()
+
+	def request_kill(self, signum, frame=None):
+		""" Asks the requote loop to pull the kill switch. Safe to call from a
+			signal handler.
+		"""
+		self.kill_requested = signal.Signals(signum).name
+
+	def kill_on_signal(self, signum=getattr(signal, "SIGUSR2", None)):
+		""" Only the main thread can install signal handlers. A market maker
+			run from another thread goes without.
+		"""
+		if signum is not None and threading.current_thread() is threading.main_thread():
+			signal.signal(signum, self.request_kill)
+
+	def poll_latency_dump(self):
+		""" Journals the latency report if a signal asked for it. """
+		report = LATENCY.poll_dump()
+		if report is not None:
+			JOURNAL.info("stats", report)
+
+	def poll_kill_switch(self):
+		""" Pulls the kill switch if a signal asked for it. Returns True if it did. """
+		if self.kill_requested is None or self.risk.killed is not None:
+			return False
+		self.kill(self.kill_requested)
+		return True
 
-			if short_btc_remaining > 0:
-				sell_order = self.build_order(i, 'Ask')
-				sell_order.quantity = int(sell_order.quantity)
-				if sell_order.quantity > 0:
-					sell_orders.append(sell_order)	
+	def reload_params(self):
+		""" Swaps in the trading params of the config file if it changed. Runs
+			between requotes on the thread that requotes, so a requote never
+			sees a mix of old and new params. Returns True if any changed.
+		"""
+		if self.reloader is None:
+			return False
+		try:
+			conf = self.reloader.poll()
+			if conf is None:
+				return False
+			markets = load_trading_params(conf)
+		except Exception as e:
+			JOURNAL.error("system", f"Config reload failed, keeping the current trading params: {e}")
+			return False
 
-		buy_orders = list(reversed(buy_orders))
-		sell_orders = list(reversed(sell_orders))
+		changed = []
+		for symbol, (_, trading_params) in markets.items():
+			market = self.markets.get(symbol)
+			if market is None:
+				JOURNAL.warning("system", f"Ignoring {symbol} added to the config, markets need a restart.")
+			elif trading_params != market.trading_params:
+				market.set_trading_params(trading_params, self.exchange_state)
+				self.requote_trigger.reset(symbol)
+				changed.append(symbol)
+		JOURNAL.info("system", f"Reloaded the config, new trading params for {changed}." if changed
+			else "Reloaded the config, trading params unchanged.", changed=changed)
+		return bool(changed)
+
+	def requote(self):
+		""" Requotes every market whose reference price is ready. """
+		self.requote_tick_ns, self.tick_ns = self.tick_ns, None
+		for market in self.markets.values():
+			self.create_orders(market)
+			open_orders = self.exchange_state.open_orders.get(market.symbol)
+			if open_orders is None:
+				self.quote_uptime.sample(market.symbol, False, False)
+			else:
+				self.quote_uptime.sample(market.symbol, bool(open_orders.bids()), bool(open_orders.asks()))
+
+	def start_metrics(self):
+		if self.metrics is not None:
+			self.metrics.start()
+			JOURNAL.info("system", f"Serving metrics on http://{self.metrics.host}:{self.metrics.port}/metrics.")
+
+	def collect_metrics(self):
+		""" Returns the metric families of the metrics endpoint. Runs on the
+			endpoint's thread, so it only reads.
+		"""
+		exchange_state = self.exchange_state
+		messages = dict(exchange_state.message_counts)
+		requotes = self.requote_trigger.stats()
+		scheduler = self.scheduler.stats()
+		connection = self.connection.stats()
+		book_updates, quoted_spreads, market_spreads, positions, inventory = [], [], [], [], []
+		for market in self.markets.values():
+			labels = {"symbol": market.symbol}
+			orderbook = exchange_state.orderbooks.get(market.symbol)
+			if orderbook is not None:
+				book_updates.append((labels, orderbook.updates))
+			quoted_spread, market_spread = spreads_bps(market.ladder, market.book_top)
+			quoted_spreads.append((labels, quoted_spread))
+			market_spreads.append((labels, market_spread))
+			position = exchange_state.positions.get(market.symbol)
+			contracts = 0
+			if position is not None:
+				contracts = position.quantity if position.side == "Bid" else -position.quantity
+			positions.append((labels, contracts))
+			inventory.append((labels, self.inventory.inventories[market.symbol].btc))
+
+		return [
+			("messages_total", COUNTER, "Websocket messages received by type.",
+				[({"type": t}, count) for t, count in messages.items()]),
+			("order_rejections_total", COUNTER, "Orders the exchange rejected.",
+				[({}, messages.get(ORDER_REJECTION, 0))]),
+			("book_updates_total", COUNTER, "Orderbook snapshots and deltas applied.", book_updates),
+			("requote_wakeups_total", COUNTER, "Times the requote loop woke up to a change.",
+				[({}, requotes["wakeups"])]),
+			("requotes_total", COUNTER, "Requotes of a symbol, by whether the quotes changed.",
+				[({"result": "triggered"}, requotes["triggered"]), ({"result": "suppressed"}, requotes["suppressed"])]),
+			("order_messages_total", COUNTER, "Order messages sent by kind.",
+				[({"kind": kind}, count) for kind, count in scheduler["sent"].items()]),
+			("order_amends_total", COUNTER, "Orders amended, natively or by placing a replacement and cancelling the original.",
+				[({}, scheduler["amends"])]),
+			("amends_throttled_total", COUNTER, "Amends held back by the per level amend cap.",
+				[({}, self.amend_throttle.throttled)]),
+			("reference_volatility", GAUGE, "Standard deviation of the book mid's relative move over a second.",
+				[({"symbol": market.symbol}, market.volatility.stdev()) for market in self.markets.values()]),
+			("order_messages_superseded_total", COUNTER, "Queued order messages replaced before going out.",
+				[({}, scheduler["superseded"])]),
+			("order_queue_depth", GAUGE, "Order messages waiting for the rate limit.", [({}, scheduler["queued"])]),
+			("quoted_spread_bps", GAUGE, "Spread of our best quotes in basis points of the market mid.", quoted_spreads),
+			("market_spread_bps", GAUGE, "Spread of the orderbook in basis points of its mid.", market_spreads),
+			("position_contracts", GAUGE, "Our position as the exchange last reported it, negative if short.", positions),
+			("inventory_btc", GAUGE, "Our exposure in BTC as tracked between position messages.", inventory),
+			("connected", GAUGE, "1 while the websocket is connected.", [({}, connection["connected"])]),
+			("disconnects_total", COUNTER, "Connections lost after quoting on them.", [({}, connection["disconnects"])]),
+			("time_to_quote_seconds", GAUGE, "Seconds from losing the connection (or starting) to quoting again, last time.",
+				[({}, connection["last_time_to_quote_s"])]),
+			("risk_checks_total", COUNTER, "Order messages checked by the risk engine.", [({}, self.risk.checked)]),
+			("risk_rejections_total", COUNTER, "Order messages the risk engine held back, by reason.",
+				[({"reason": reason}, count) for reason, count in dict(self.risk.rejected).items()]),
+			("killed", GAUGE, "1 once the kill switch was pulled.", [({}, self.risk.killed is not None)]),
+			("journal_dropped_total", COUNTER, "Journal events dropped because its queue was full.",
+				[({}, JOURNAL.dropped)]),
+		] + self.quote_uptime.families()
+
+	def print_stats(self):
+		""" Periodic report of the requote counters and, if enabled, the
+			latency of each stage since the last report.
+		"""
+		requotes = self.requote_trigger.stats()
+		scheduler = self.scheduler.stats()
+		inventory = self.inventory.stats()
+		connection = self.connection.stats()
+		risk = self.risk.stats()
+		stability = {"amends_throttled": self.amend_throttle.throttled,
+			"volatility": {market.symbol: market.volatility.stdev() for market in self.markets.values()}}
+		lines = [f"Requote stats: {requotes}", f"Order scheduler: {scheduler}", f"Inventory: {inventory}",
+			f"Connection: {connection}", f"Risk: {risk}", f"Quote stability: {stability}"]
+		integrity = {}
+		reference_prices = {}
+		for market in self.markets.values():
+			orderbook = self.exchange_state.orderbooks.get(market.symbol)
+			if orderbook is not None:
+				integrity[market.symbol] = orderbook.integrity_stats()
+				lines.append(f"Orderbook integrity {market.symbol}: {integrity[market.symbol]}")
+			if len(market.reference_prices) > 1:
+				prices = {name: calc.get_price() for name, calc in market.reference_prices.items()}
+				reference_prices[market.symbol] = prices
+				lines.append(f"Reference prices {market.symbol}: {prices}")
+		if LATENCY.enabled:
+			lines.append(LATENCY.report())
+			LATENCY.reset()
+		JOURNAL.info("stats", "\n".join(lines), requotes=requotes, scheduler=scheduler, inventory=inventory,
+			connection=connection, risk=risk, stability=stability, integrity=integrity, reference_prices=reference_prices, journal=JOURNAL.stats())
+		if self.recorder is not None:
+			self.recorder.flush()
+
+	def handle_dry_run(self, market, ladder):
+		if len(ladder) > 0:
+			tradable_symbol = self.exchange_state.tradable_symbols[market.symbol]
+			display_price = lambda price: toNearest(tradable_symbol.from_raw(price), tradable_symbol.tick_size)
+			asks = list(zip(ladder.ask_prices.tolist(), ladder.ask_quantities.tolist()))
+			bids = list(zip(ladder.bid_prices.tolist(), ladder.bid_quantities.tolist()))
+			def describe():
+				# Formatted on the journal's thread.
+				lines = [f"Dry run. Would place the following orders on {market.symbol}:"]
+				lines += [f"Ask {quantity} @ price {display_price(price)}" for price, quantity in reversed(asks)]
+				lines += [f"Bid {quantity} @ price {display_price(price)}" for price, quantity in bids]
+				return "\n".join(lines)
+			JOURNAL.info("dry_run", describe, symbol=market.symbol, asks=asks, bids=bids)
+
+	def converge_orders(self, market, ladder):
+		""" Brings our resting orders in line with the ladder using the fewest
+			create, amend and cancel actions, and sends them as one burst.
+			Orders we sent that the exchange hasn't acknowledged yet count as
+			resting, or as cancelled.
+		"""
+		open_orders = self.exchange_state.open_orders.get(market.symbol)
+		if open_orders is None:
+			open_orders = OpenOrders()
+		pending_bids = pending_asks = cancelling = ()
+		in_flight = self.exchange_state.in_flight.get(market.symbol)
+		if in_flight:
+			pending_bids, pending_asks = in_flight.pending("Bid"), in_flight.pending("Ask")
+			cancelling = in_flight.cancelling()
+
+		if LATENCY.enabled:
+			start = perf_counter_ns()
+		trading_params = market.trading_params
+		relist_tolerance = trading_params.relist_tolerance
+		if is_stability_enabled(trading_params):
+			relist_tolerance = relist_tolerances(trading_params, market.volatility.stdev())
+		to_create, to_amend, to_cancel = diff_orders(
+			open_orders.bids(), open_orders.asks(), ladder, relist_tolerance,
+			pending_bids, pending_asks, cancelling)
+		if to_amend and trading_params.max_amends_per_level_s is not None:
+			allowed = self.amend_throttle.filter(market.symbol, to_amend, ladder,
+				trading_params.max_amends_per_level_s, self.exchange_state.clock())
+			if len(allowed) < len(to_amend):
+				# Try the held back amends again at the next requote, even if
+				# nothing changes until then.
+				self.requote_trigger.reset(market.symbol)
+				to_amend = allowed
+		if LATENCY.enabled:
+			sending = perf_counter_ns()
+			LATENCY.record("diff", start, sending)
+
+		self.send_order_actions(market, to_create, to_amend, to_cancel)
+		if LATENCY.enabled and (to_create or to_amend or to_cancel):
+			sent = perf_counter_ns()
+			LATENCY.record("send", sending, sent)
+			if self.requote_tick_ns is not None:
+				LATENCY.record("tick_to_order", self.requote_tick_ns, sent)
+		return True
 
-		if self.conf["enable_dry_run"]:
-			self.handle_dry_run(buy_orders, sell_orders)
-			return True
+	def send_order_actions(self, market, to_create, to_amend, to_cancel):
+		""" Hands the result of a diff to the scheduler, which sends cancels
+			first and paces the rest to the rate limit. Amends use the venue's
+			native amend if the client provides one and fall back to placing the
+			replacement and then cancelling the original. Desired levels are
+			(side, price, quantity) tuples.
+		"""
+		has_amend = hasattr(self, "amend_order")
+
+		actions = [(CANCEL, order.to_dict()) for order in to_cancel]
+		for order, (side, price, quantity) in to_amend:
+			open_order = self.build_order(market, side, price, quantity)
+			if has_amend:
+				open_order.order_id = order.order_id
+				actions.append((AMEND, open_order.to_dict()))
+			else:
+				actions.append((REPLACE, (open_order.to_dict(), order.to_dict())))
+
+		for side, price, quantity in to_create:
+			actions.append((PLACE, self.build_order(market, side, price, quantity).to_dict()))
+
+		self.scheduler.submit(market.symbol, actions)
+
+	def send_order_message(self, kind, msg, replaces=None):
+		""" Sends an order message unless the risk engine holds it back, in
+			which case it returns False. The scheduler calls this once the rate
+			limit lets the message go. replaces is the order_id of the order a
+			place replaces.
+		"""
+		reason = self.risk.check(kind, msg, replaces)
+		if reason is not None:
+			JOURNAL.warning("risk", f"Held back {kind} of {msg['quantity']} @ {msg['price']} on {msg['symbol']}: {reason}.",
+				kind=kind, reason=reason, order=msg)
+			# Nothing we track changed, so try again at the next requote even
+			# if the ladder and our orders are the same by then.
+			self.requote_trigger.reset(msg["symbol"])
+			return False
+		self.journal_order(kind, msg)
+		# Recorded before sending, so the answer can't arrive first.
+		if kind == PLACE:
+			order = parse_open_order(msg)
+			order.order_id = None
+			self.exchange_state.in_flight_for(msg["symbol"]).on_place(order, self.exchange_state.clock())
+			self.place_order(msg)
+		elif kind == AMEND:
+			self.amend_order(msg)
 		else:
-			return self.converge_orders(buy_orders, sell_orders)
-
-	def handle_dry_run(self, buy_orders, sell_orders):
-		if len(buy_orders) > 0 or len(sell_orders):
-			print ("Dry run. Would place the following orders:")
-			for sell in sell_orders:
-				print (f"{sell.side} {sell.quantity} @ price {sell.price}")
-			for buy in reversed(buy_orders):
-				print (f"{buy.side} {buy.quantity} @ price {buy.price}")
-
-	def converge_orders(self, buy_orders, sell_orders):
-		# Covering and quoting on price is somewhat independent.
-		to_amend = []
-		to_create = []
-		to_cancel = []
-		buys_matched = 0
-		sells_matched = 0
-		existing_orders = self.exchange_state.open_orders.get(self.target_symbol)
-		if not existing_orders:
-			existing_orders = []
-
-		tradable_symbol = self.exchange_state.tradable_symbols.get(self.target_symbol)
-		if not tradable_symbol:
-			return None 
-
-		bid_orders = sorted(existing_orders, key=lambda order: order.price)
-		ask_orders = sorted(
-			existing_orders, key=lambda order: order.price, reverse=True)
-
-		bid_orders = [order for order in bid_orders if order.side == "Bid"]
-		ask_orders = [order for order in ask_orders if order.side == "Ask"]
-		existing_orders = bid_orders + ask_orders
-
-		# Check all existing orders and match them up with what we want to place.
-		# If there's an open one, we might be able to amend it to fit what we want.
-
-		trading_params = conf["trading_params"]
-		# Bid orders should be order from lowest to highest and ask orders should be from highest to lowest.
-		level_indices = 2 * list(range(0, trading_params["num_levels"]))[::-1]
-
-		for index, order in enumerate(existing_orders):
-			# logger.info("Existing Orders found.")
-			try:
-				if order.side == 'Bid':
-					desired_order = buy_orders[buys_matched]
-					buys_matched += 1
-				else:
-					desired_order = sell_orders[sells_matched]
-					sells_matched += 1
-
-				# Found an existing order. Do we need to amend it?
-				remaining_quantity = order.quantity - order.filled
-				level_index = level_indices[index]
-				if desired_order.quantity != remaining_quantity or (
-						# If price has changed, and the change is more than our relist_tolerance, amend.
-						desired_order.price != order.price and
-						abs((desired_order.price / order.price) - 1) > trading_params["relist_tolerance"]):
-					open_order = OpenOrder()
-					open_order.price = desired_order.price
-					open_order.quantity = desired_order.quantity
-					open_order.side = order.side
-					open_order.order_id = order.order_id
-					open_order.symbol = order.symbol
-					open_order.order_type = "Limit"
-					open_order.margin_type = "Isolated"
-					open_order.settlement_type = "Delayed"
-					open_order.timestamp = int(time())
-					to_amend.append(open_order)
-			except IndexError:
-				# Will throw if there isn't a desired order to match. In that case, cancel it.
-				to_cancel.append(order)
-			
-		while buys_matched < len(buy_orders):
-			to_create.append(buy_orders[buys_matched])
-			buys_matched += 1
-
-		while sells_matched < len(sell_orders):
-			to_create.append(sell_orders[sells_matched])
-			sells_matched += 1
-
-		if len(to_amend) > 0:
-			for order in to_amend:
-				dp = tradable_symbol.price_dp
-				order.price = int(order.price * (10**dp))
-				self.cancel_order(order.to_dict())
-				self.place_order(order.to_dict())
-
-		if len(to_create) > 0:
-			for order in reversed(to_create):
-				dp = tradable_symbol.price_dp
-				order.price = int(order.price * (10**dp))
-				self.place_order(order.to_dict())
-
-		if len(to_cancel) > 0:
-			for order in reversed(to_cancel):
-				dp = tradable_symbol.price_dp
-				order.price = int(order.price * (10**dp))
-				self.cancel_order(order.to_dict())
-	
-	def short_btc_remaining(self):
-		# Returns unsigned value in BTC
-		max_short_pos_btc = self.conf["trading_params"]["max_short_pos_btc"]
-		if not self.conf["check_position_limits"]:
-			return max_short_pos_btc
-		position = self.exchange_state.positions.get(self.target_symbol)
-		contract = self.exchange_state.tradable_symbols.get(self.target_symbol)
-		if position:
-			if position.entry_price != 0:
-				position_btc = contract_qty_to_btc(position.quantity,
-					position.entry_price, contract.is_inverse_priced,
-					contract.contract_size)
-				if position.side == "Bid":
-					return max_short_pos_btc + position_btc
-				else:
-					return max_short_pos_btc - position_btc
-		return max_short_pos_btc
-
-	def long_btc_remaining(self):
-		# Returns unsigned value in BTC
-		max_long_pos_btc = self.conf["trading_params"]["max_long_pos_btc"]
+			self.exchange_state.in_flight_for(msg["symbol"]).on_cancel(msg["order_id"], self.exchange_state.clock())
+			self.cancel_order(msg)
+
+	def send_replacement(self, place, cancel):
+		""" Places an order and then cancels the one it replaces. If the place
+			is held back the cancel is too, leaving the original resting.
+		"""
+		if self.send_order_message(PLACE, place, cancel["order_id"]) is False:
+			return False
+		self.send_order_message(CANCEL, cancel)
+
+	@staticmethod
+	def journal_order(kind, msg):
+		""" Records an order message on its way out. Returns the message. """
+		JOURNAL.info("order", sent=kind, order=msg)
+		return msg
+
+	def short_btc_remaining(self, market):
+		# Returns unsigned value in BTC, or None without position limits
 		if not self.conf["check_position_limits"]:
-			return max_long_pos_btc
-		position = self.exchange_state.positions.get(self.target_symbol)
-		contract = self.exchange_state.tradable_symbols.get(self.target_symbol)
-		if position:
-			if position.entry_price != 0:
-				position_btc = contract_qty_to_btc(position.quantity,
-					position.entry_price, contract.is_inverse_priced,
-					contract.contract_size)
-				if position.side == "Ask":
-					return max_long_pos_btc + position_btc
-				else:
-					return max_long_pos_btc - position_btc
-		return max_long_pos_btc
+			return None
+		return self.inventory.short_btc_remaining(market.symbol, market.trading_params.max_short_pos_btc)
 
-	def run(self):
-		# Connecting to the Kollider sockets.
-		self.connect(self.conf["ws_url"], self.conf["api_key"], self.conf["api_secret"], self.conf["api_passphrase"])
-		# Give the sockets some time to connect.
-		sleep(2)
-		# Subscribing to index prices.
-		self.sub_index_price([self.conf["index_symbol"]])
-		self.sub_position_states()
-		self.sub_orderbook_l2(self.conf["symbol"])
+	def long_btc_remaining(self, market):
+		# Returns unsigned value in BTC, or None without position limits
+		if not self.conf["check_position_limits"]:
+			return None
+		return self.inventory.long_btc_remaining(market.symbol, market.trading_params.max_long_pos_btc)
+
+	def subscribe_market_data(self):
+		""" Requests everything that doesn't need us authenticated. None of
+			these wait for an answer, so they all go out back to back.
+		"""
+		# Market data comes from the feed handler if we read a shared feed.
+		if self.feed is None:
+			# Subscribing to index prices.
+			self.sub_index_price(self.index_symbols)
+			for symbol in self.markets:
+				self.sub_orderbook_l2(symbol)
 		# Fetching symbols that are available to trade.
 		self.fetch_tradable_symbols()
+		self.fetch_symbols()
+
+	def subscribe_account(self):
+		""" Requests our own orders and positions. """
+		self.sub_position_states()
 		self.fetch_positions()
 		self.fetch_open_orders()
-		self.fetch_symbols()
 		self.who_am_i()
 
-		while True:
-			sleep(1)
-			success = self.update_start_prices()
-			if not success:
-				continue
-			self.create_orders()
+	def subscribe(self):
+		self.subscribe_market_data()
+		self.subscribe_account()
+
+	def is_ready(self):
+		""" Returns True once we know the contracts we quote and hold a synced
+			snapshot of each of their orderbooks.
+		"""
+		for symbol in self.markets:
+			orderbook = self.exchange_state.orderbooks.get(symbol)
+			if orderbook is None or not orderbook.is_synced or symbol not in self.exchange_state.tradable_symbols:
+				return False
+		return True
 
-if __name__ in "__main__":
+	def on_ready(self):
+		JOURNAL.info("system", "Received tradable symbols and orderbook snapshot. Quoting.")
+
+	def on_disconnect(self, reason):
+		""" Forgets what the lost connection leaves stale: the orderbooks, until
+			the snapshots of the next connection arrive, and any order messages
+			still queued for it. Positions, open orders and index values are
+			kept until the next connection's answers replace them.
+		"""
+		super(MarketMaker, self).on_disconnect(reason)
+		self.scheduler.clear()
+		# Whatever reached the exchange is in the open orders we fetch again.
+		for in_flight in self.exchange_state.in_flight.values():
+			in_flight.clear()
+		# The first requote on the new connection always goes through.
+		self.requote_trigger.reset()
+		if self.state_cache is not None:
+			self.state_cache.save(self.exchange_state)
+
+	def reset_books(self):
+		# The feed handler keeps the books of a shared feed.
+		if self.feed is None:
+			super(MarketMaker, self).reset_books()
+
+	def run(self):
+		if LATENCY.enabled:
+			LATENCY.dump_on_signal()
+		if self.feed is not None:
+			threading.Thread(target=self._poll_feed_forever, daemon=True).start()
+		if self.reloader is not None:
+			self.reloader.reload_on_signal()
+		self.kill_on_signal()
+		self.start_metrics()
+		# Connecting to the Kollider sockets.
+		self.connect_until_ready()
+
+		last_stats = time()
+		last_requote = time()
+		while True:
+			self.reconnect_if_down()
+
+			# Wake up early when queued orders can go out.
+			timeout = 1
+			backlog_wait = self.scheduler.wait_time()
+			if backlog_wait is not None:
+				timeout = min(timeout, backlog_wait)
+
+			if self.requote_mode == EVENT:
+				changed = self.requote_trigger.wait(timeout=timeout)
+			else:
+				sleep(timeout)
+				changed = time() - last_requote >= 1
+			self.scheduler.drain()
+			if self.reload_params():
+				changed = True
+			if self.poll_kill_switch():
+				changed = True
+			self.poll_latency_dump()
+			if self.state_cache is not None:
+				self.state_cache.save_if_due(self.exchange_state)
+
+			if time() - last_stats >= REQUOTE_STATS_INTERVAL:
+				self.print_stats()
+				last_stats = time()
+
+			if changed:
+				self.requote()
+				last_requote = time()
+
+if __name__ == "__main__":
 	import yaml
 	conf = None
 	with open("config.yaml",) as f:
 		conf = yaml.load(f, Loader=yaml.FullLoader)
 	print(conf)
-	mm = MarketMaker(conf)
-	mm.run()
+	if conf.get("runtime", "thread") == "asyncio":
+		import asyncio
+		from async_runtime import AsyncMarketMaker
+		asyncio.run(AsyncMarketMaker(conf, "config.yaml").run())
+	else:
+		mm = MarketMaker(conf, "config.yaml")
+		mm.run()
+
@@ -0,0 +1,94 @@
+from calculators import *
+from quote_stability import VOLATILITY_HALFLIFE_S, Volatility
+from trading_params import TradingParams, load_trading_params
+
+class Market(object):
+	""" The quoting state of one symbol: its trading params, its reference price
+		calculator and the start prices of the current ladder.
+
+		Calculators listed in track_reference_prices run side by side with the
+		one we quote off, on the same events, for comparison.
+	"""
+
+	def __init__(self, symbol, index_symbol, trading_params):
+		self.symbol = symbol
+		self.index_symbol = index_symbol
+		if not isinstance(trading_params, TradingParams):
+			trading_params = TradingParams(trading_params)
+		self.trading_params = trading_params
+		self.start_price_bid = None
+		self.start_price_ask = None
+		# The last ladder built and the (best bid, best ask) it was built
+		# against, for the metrics.
+		self.ladder = None
+		self.book_top = None
+		# Of the book's mid, for relist tolerances that follow it.
+		self.volatility = Volatility(trading_params.get("volatility_halflife_s", VOLATILITY_HALFLIFE_S))
+		self._create_calcs()
+
+	def _create_calcs(self):
+		symbol, index_symbol, trading_params = self.symbol, self.index_symbol, self.trading_params
+		reference_type = trading_params.reference_price_type
+		reference_price = create_reference_price(reference_type, symbol, index_symbol, trading_params)
+		reference_prices = {reference_type: reference_price}
+		for name in trading_params.track_reference_prices:
+			if name not in reference_prices:
+				reference_prices[name] = create_reference_price(name, symbol, index_symbol, trading_params)
+		self.book_calcs = [calc for calc in reference_prices.values() if calc.book_events]
+		self.index_calcs = [calc for calc in reference_prices.values() if calc.index_events]
+		self.reference_prices = reference_prices
+		self.reference_price = reference_price
+
+	def attach(self, exchange_state):
+		""" Feeds the market's calculators, and its volatility if quote
+			stability follows it, the updates of its book and index.
+		"""
+		book_listeners = exchange_state.book_listeners.setdefault(self.symbol, [])
+		if (self.book_calcs or self.trading_params.relist_volatility_mult) and self.on_book not in book_listeners:
+			book_listeners.append(self.on_book)
+		index_listeners = exchange_state.index_listeners.setdefault(self.index_symbol, [])
+		if self.index_calcs and self.on_index not in index_listeners:
+			index_listeners.append(self.on_index)
+
+	def set_trading_params(self, trading_params, exchange_state):
+		""" Swaps in new trading params. Calculators are rebuilt, losing their
+			state, only if a param they depend on changed.
+		"""
+		previous = self.trading_params
+		self.trading_params = trading_params
+		self.volatility.halflife = trading_params.get("volatility_halflife_s", VOLATILITY_HALFLIFE_S)
+		if trading_params.calc_key() != previous.calc_key():
+			self._create_calcs()
+			self.attach(exchange_state)
+			self.reference_price.update_price(exchange_state)
+		else:
+			self.attach(exchange_state)
+
+	def on_book(self, exchange_state):
+		""" Returns True if the price we quote off changed. """
+		if self.trading_params.relist_volatility_mult:
+			orderbook = exchange_state.orderbooks[self.symbol]
+			best_bid, best_ask = orderbook.best_bid(), orderbook.best_ask()
+			if best_bid is not None and best_ask is not None:
+				self.volatility.update((best_bid + best_ask) / 2, exchange_state.clock())
+		changed = False
+		for calc in self.book_calcs:
+			if calc.on_book(exchange_state) and calc is self.reference_price:
+				changed = True
+		return changed
+
+	def on_index(self, exchange_state):
+		changed = False
+		for calc in self.index_calcs:
+			if calc.on_index(exchange_state) and calc is self.reference_price:
+				changed = True
+		return changed
+
+def load_markets(conf):
+	""" Returns the markets to quote, one per entry of the "markets" list in the
+		config. Each entry's trading_params override the top-level ones. Without
+		a "markets" list the top-level symbol, index_symbol and trading_params
+		describe a single market.
+	"""
+	return [Market(symbol, index_symbol, trading_params)
+		for symbol, (index_symbol, trading_params) in load_trading_params(conf).items()]
@@ -0,0 +1,124 @@
+""" Metrics in the Prometheus text exposition format, served over HTTP.
+
+	Scrapes are answered on a thread of their own, which collects the counters
+	the market maker keeps anyway at scrape time. The message and requote path
+	only pays for the few counters that exist for the metrics alone.
+
+	Scrape http://127.0.0.1:<metrics_port>/metrics.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import monotonic
+
+PREFIX = "kollider_mm_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value):
+	if value is None:
+		return "NaN"
+	if value is True or value is False:
+		return "1" if value else "0"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(families):
+	""" Returns the exposition of (name, type, help, samples) families, samples
+		being (labels dict, value) pairs. A value of None is exported as NaN.
+	"""
+	lines = []
+	for name, kind, help_text, samples in families:
+		name = PREFIX + name
+		lines.append(f"# HELP {name} {help_text}")
+		lines.append(f"# TYPE {name} {kind}")
+		for labels, value in samples:
+			if labels:
+				label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+				lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+			else:
+				lines.append(f"{name} {_format_value(value)}")
+	lines.append("")
+	return "\n".join(lines)
+
+class QuoteUptime(object):
+	""" Seconds each side of a symbol had at least one order resting, from
+		samples taken at every requote. Time between two samples counts
+		towards the state of the first.
+	"""
+
+	def __init__(self, clock=monotonic):
+		self.clock = clock
+		self.quoted = {}
+		self.tracked = {}
+		self.last = {}
+
+	def sample(self, symbol, has_bid, has_ask):
+		now = self.clock()
+		last = self.last.get(symbol)
+		if last is not None:
+			then, had_bid, had_ask = last
+			elapsed = now - then
+			self.tracked[symbol] = self.tracked.get(symbol, 0.0) + elapsed
+			if had_bid:
+				self.quoted[(symbol, "bid")] = self.quoted.get((symbol, "bid"), 0.0) + elapsed
+			if had_ask:
+				self.quoted[(symbol, "ask")] = self.quoted.get((symbol, "ask"), 0.0) + elapsed
+		self.last[symbol] = (now, has_bid, has_ask)
+
+	def families(self):
+		quoted = dict(self.quoted)
+		last = dict(self.last)
+		return [
+			("quote_seconds_total", COUNTER, "Seconds with at least one order resting on the side.",
+				[({"symbol": symbol, "side": side}, quoted.get((symbol, side), 0.0))
+					for symbol in last for side in ("bid", "ask")]),
+			("quote_tracked_seconds_total", COUNTER, "Seconds the quotes of the symbol were followed for.",
+				[({"symbol": symbol}, seconds) for symbol, seconds in dict(self.tracked).items()]),
+			("quoting", GAUGE, "1 if the side had an order resting at the last requote.",
+				[({"symbol": symbol, "side": side}, state[1 if side == "bid" else 2])
+					for symbol, state in last.items() for side in ("bid", "ask")]),
+		]
+
+class MetricsServer(object):
+	""" Serves render(collect()) on /metrics from a daemon thread. """
+
+	def __init__(self, collect, port, host="127.0.0.1"):
+		self.collect = collect
+		self.host = host
+		self.port = port
+		self.server = None
+		self.scrapes = 0
+
+	def start(self):
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] != "/metrics":
+					self.send_error(404)
+					return
+				body = render(metrics.collect()).encode()
+				metrics.scrapes += 1
+				self.send_response(200)
+				self.send_header("Content-Type", CONTENT_TYPE)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.server = HTTPServer((self.host, self.port), Handler)
+		# The port actually bound, in case 0 asked for any free one.
+		self.port = self.server.server_address[1]
+		threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
@@ -0,0 +1,330 @@
+""" A local stand-in for Kollider's websocket API, to run the market maker
+	against on a machine without access to the exchange.
+
+	Usage: python src/mock_exchange.py [--config config.yaml] [--port 8765]
+		[--rate 1000] [--duration 60] [--latency-ms 0] [--queue-position 1.0]
+
+	Point ws_url of the market maker at ws://localhost:8765. The server makes
+	up a random walk orderbook and index for every market in the config and
+	streams --rate market data messages per second to its subscribers. Orders
+	are matched against those books by the simulated exchange of
+	src/sim_exchange.py, each connection trading on its own account.
+
+	Every --report-interval seconds, and when it stops, the server prints the
+	messages it exchanged with its clients and how long they took to respond
+	to a move of the top of the book with an order or cancel.
+"""
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from time import monotonic, perf_counter_ns
+
+import websockets
+
+from dtypes import ExchangeState, parse_tradable_symbols
+from fixtures import synthetic_symbol_info, walk_deltas
+from latency import LatencyRecorder
+from markets import load_markets
+from sim_exchange import SimulatedExchange
+from ws_msg_parser import parse_msg, peek_type, BOOK_CHANGED
+import ws_protocol
+
+DEFAULT_PORT = 8765
+# Levels per side of the made up books, their tick and starting mid in raw units.
+BOOK_DEPTH = 50
+BOOK_TICK = 5
+BOOK_MID = 400000
+# Share of the market data messages that are index values.
+INDEX_SHARE = 0.1
+# Seconds between two batches of market data.
+STREAM_INTERVAL_S = 0.001
+
+def frame(msg_type, data):
+	return json.dumps({"type": msg_type, "data": data})
+
+class MockMarket(object):
+	""" The random walk orderbook and index of one symbol. """
+
+	def __init__(self, symbol, index_symbol, seed):
+		self.symbol = symbol
+		self.index_symbol = index_symbol
+		self.rng = random.Random(seed)
+		self.info = synthetic_symbol_info(symbol, index_symbol)
+		self.tradable_symbol = parse_tradable_symbols(self.info)
+		self.bids = {BOOK_MID - BOOK_TICK * (i + 1): self.rng.randint(1, 500) for i in range(BOOK_DEPTH)}
+		self.asks = {BOOK_MID + BOOK_TICK * (i + 1): self.rng.randint(1, 500) for i in range(BOOK_DEPTH)}
+		self.deltas = walk_deltas(self.rng, self.bids, self.asks, BOOK_MID, BOOK_DEPTH, BOOK_TICK)
+		self.seq = 0
+
+	def snapshot(self):
+		return frame("level2state", {
+			"symbol": self.symbol, "update_type": "snapshot", "seq_number": self.seq,
+			"bids": {str(p): s for p, s in self.bids.items()},
+			"asks": {str(p): s for p, s in self.asks.items()}})
+
+	def delta(self):
+		bids, asks = next(self.deltas)
+		self.seq += 1
+		return frame("level2state", {
+			"symbol": self.symbol, "update_type": "delta", "seq_number": self.seq,
+			"bids": bids, "asks": asks})
+
+	def index_value(self):
+		""" The index follows the mid with a little noise. """
+		mid = (max(self.bids) + min(self.asks)) / 2
+		value = self.tradable_symbol.from_raw(mid) + self.rng.uniform(-1, 1)
+		return frame("index_values", {"symbol": self.index_symbol, "value": value, "denom": "USD"})
+
+class MockSession(object):
+	""" A connected client and its account at the simulated exchange. """
+
+	def __init__(self, server, websocket):
+		self.server = server
+		self.websocket = websocket
+		self.outbox = asyncio.Queue()
+		self.authenticated = False
+		self.book_symbols = set()
+		self.index_symbols = set()
+		self.exchange = SimulatedExchange(
+			server.market_state, self.send, server.latency_ns, server.queue_position)
+		self.exchange.now = perf_counter_ns()
+		# Symbol -> when its top of book first moved since our last order
+		# message on it.
+		self.unanswered = {}
+
+	def send(self, msg):
+		self.server.sent[peek_type(msg)] += 1
+		self.outbox.put_nowait(msg)
+
+	def reply(self, msg_type, data):
+		self.send(frame(msg_type, data))
+
+	async def sender(self):
+		while True:
+			msg = await self.outbox.get()
+			await self.websocket.send(msg)
+
+class MockExchange(object):
+
+	def __init__(self, markets, port=DEFAULT_PORT, host="localhost", rate=1000,
+			latency_ms=0, queue_position=1.0, report_interval=10, seed=42):
+		self.host = host
+		self.port = port
+		self.rate = rate
+		self.latency_ns = int(latency_ms * 1e6)
+		self.queue_position = queue_position
+		self.report_interval = report_interval
+		self.rng = random.Random(seed)
+		self.markets = {market.symbol: MockMarket(market.symbol, market.index_symbol, seed + i)
+			for i, market in enumerate(markets)}
+		self.market_list = list(self.markets.values())
+
+		# The book as the simulated exchanges see it.
+		self.market_state = ExchangeState("kollider")
+		self.market_state.book_symbols.update(self.markets)
+		for market in self.markets.values():
+			self.market_state.tradable_symbols[market.symbol] = market.tradable_symbol
+			parse_msg(self.market_state, market.snapshot())
+
+		self.sessions = []
+		self.received = Counter()
+		self.sent = Counter()
+		self.market_data = 0
+		self.book_moves = 0
+		self.latency = LatencyRecorder(enabled=True)
+		self.started = None
+
+		self.handlers = {
+			"authenticate": self.on_authenticate,
+			"subscribe": self.on_subscribe,
+			"unsubscribe": self.on_unsubscribe,
+			"fetch_tradable_symbols": self.on_fetch_tradable_symbols,
+			"fetch_positions": self.on_fetch_positions,
+			"fetch_open_orders": self.on_fetch_open_orders,
+			"fetch_symbols": self.on_fetch_symbols,
+			"whoami": self.on_whoami,
+			"order": self.on_order,
+			"cancel_order": self.on_cancel_order,
+		}
+
+	def on_message(self, session, raw):
+		msg = json.loads(raw)
+		msg_type = msg.get("type")
+		self.received[msg_type] += 1
+		handler = self.handlers.get(msg_type)
+		if handler is None:
+			session.reply("error", {"message": f"Unknown message type {msg_type}"})
+			return
+		handler(session, msg)
+		session.exchange.advance(perf_counter_ns())
+
+	def on_authenticate(self, session, msg):
+		# Any credentials will do.
+		session.authenticated = True
+		session.reply("authenticate", {"message": "success"})
+
+	def on_subscribe(self, session, msg):
+		for channel in msg.get("channels", ()):
+			if channel == ws_protocol.ORDERBOOK_L2_CHANNEL:
+				for symbol in msg.get("symbols", ()):
+					market = self.markets.get(symbol)
+					if market is None:
+						session.reply("error", {"message": f"Unknown symbol {symbol}"})
+						continue
+					session.book_symbols.add(symbol)
+					session.send(market.snapshot())
+			elif channel == ws_protocol.INDEX_VALUES_CHANNEL:
+				session.index_symbols.update(msg.get("symbols", ()))
+
+	def on_unsubscribe(self, session, msg):
+		for channel in msg.get("channels", ()):
+			if channel == ws_protocol.ORDERBOOK_L2_CHANNEL:
+				session.book_symbols.difference_update(msg.get("symbols", ()))
+			elif channel == ws_protocol.INDEX_VALUES_CHANNEL:
+				session.index_symbols.difference_update(msg.get("symbols", ()))
+
+	def on_fetch_tradable_symbols(self, session, msg):
+		session.reply("tradable_symbols", {"symbols": {
+			symbol: market.info for symbol, market in self.markets.items()}})
+
+	def on_fetch_positions(self, session, msg):
+		session.reply("positions", session.exchange.positions_data())
+
+	def on_fetch_open_orders(self, session, msg):
+		session.reply("open_orders", session.exchange.open_orders_data())
+
+	def on_fetch_symbols(self, session, msg):
+		# The market maker has no use for the answer.
+		pass
+
+	def on_whoami(self, session, msg):
+		session.reply("whoami", {"user_id": id(session), "username": "mock"})
+
+	def _responded(self, session, symbol):
+		moved = session.unanswered.pop(symbol, None)
+		if moved is not None:
+			self.latency.record("response", moved)
+
+	def on_order(self, session, msg):
+		if not session.authenticated:
+			session.reply("order_rejection", {"symbol": msg.get("symbol"), "reason": "NotAuthenticated",
+				"ext_order_id": msg.get("ext_order_id")})
+			return
+		self._responded(session, msg.get("symbol"))
+		session.exchange.place_order(msg)
+
+	def on_cancel_order(self, session, msg):
+		self._responded(session, msg.get("symbol"))
+		session.exchange.cancel_order(msg)
+
+	def publish(self, now):
+		""" Makes up one market data message and sends it to the subscribers. """
+		market = self.rng.choice(self.market_list)
+		if self.rng.random() < INDEX_SHARE:
+			msg = market.index_value()
+			for session in self.sessions:
+				if market.index_symbol in session.index_symbols:
+					session.send(msg)
+			return
+		msg = market.delta()
+		moved = parse_msg(self.market_state, msg) == BOOK_CHANGED
+		if moved:
+			self.book_moves += 1
+		for session in self.sessions:
+			if market.symbol in session.book_symbols:
+				session.send(msg)
+				if moved:
+					session.unanswered.setdefault(market.symbol, now)
+			session.exchange.on_book(market.symbol)
+
+	async def stream(self):
+		""" Publishes rate messages per second, in batches every
+			STREAM_INTERVAL_S so high rates don't cost a wakeup per message.
+		"""
+		started = perf_counter_ns()
+		last_report = monotonic()
+		while True:
+			await asyncio.sleep(STREAM_INTERVAL_S)
+			now = perf_counter_ns()
+			due = int((now - started) * self.rate / 1e9) - self.market_data
+			for _ in range(due):
+				self.publish(now)
+			self.market_data += max(due, 0)
+			for session in self.sessions:
+				session.exchange.advance(now)
+			if self.report_interval and monotonic() - last_report >= self.report_interval:
+				print(self.report())
+				last_report = monotonic()
+
+	async def serve(self, websocket, path=None):
+		session = MockSession(self, websocket)
+		self.sessions.append(session)
+		sender = asyncio.create_task(session.sender())
+		try:
+			async for raw in websocket:
+				self.on_message(session, raw)
+		except websockets.ConnectionClosed:
+			pass
+		finally:
+			self.sessions.remove(session)
+			sender.cancel()
+
+	def report(self):
+		elapsed = monotonic() - self.started if self.started else 0
+		def rate(count):
+			return count / elapsed if elapsed else 0
+		orders = self.received["order"] + self.received["cancel_order"]
+		lines = [
+			f"Mock exchange after {elapsed:.0f}s, {len(self.sessions)} clients connected:",
+			f"  market data {self.market_data} ({rate(self.market_data):,.0f}/s), top of book moves {self.book_moves}",
+			f"  received {dict(self.received)}",
+			f"  sent {dict(self.sent)}",
+			f"  order messages {orders} ({rate(orders):,.1f}/s)",
+			"Response to top of book moves:",
+			self.latency.report(),
+		]
+		return "\n".join(lines)
+
+	async def run(self, duration=None):
+		async with websockets.serve(self.serve, self.host, self.port):
+			print(f"Mock exchange listening on ws://{self.host}:{self.port}, "
+				f"streaming {self.rate} market data messages/s for {sorted(self.markets)}.")
+			self.started = monotonic()
+			stream = asyncio.create_task(self.stream())
+			try:
+				if duration:
+					await asyncio.sleep(duration)
+				else:
+					await stream
+			finally:
+				stream.cancel()
+				print(self.report())
+
+def main():
+	import yaml
+	parser = argparse.ArgumentParser(description="Serve a mock Kollider websocket API locally.")
+	parser.add_argument("--config", default="config.yaml", help="the markets of this config are made up")
+	parser.add_argument("--host", default="localhost")
+	parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+	parser.add_argument("--rate", type=float, default=1000, help="market data messages per second")
+	parser.add_argument("--duration", type=float, default=None, help="seconds to run for, forever by default")
+	parser.add_argument("--latency-ms", type=float, default=0, help="delay of order acknowledgements")
+	parser.add_argument("--queue-position", type=float, default=1.0,
+		help="where new orders join a price level's queue, 0 (front) to 1 (back)")
+	parser.add_argument("--report-interval", type=float, default=10)
+	parser.add_argument("--seed", type=int, default=42)
+	args = parser.parse_args()
+
+	with open(args.config) as f:
+		conf = yaml.load(f, Loader=yaml.FullLoader)
+	server = MockExchange(load_markets(conf), args.port, args.host, args.rate,
+		args.latency_ms, args.queue_position, args.report_interval, args.seed)
+	try:
+		asyncio.run(server.run(args.duration))
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,174 @@
+""" Paces the order messages we send to the exchange.
+
+	A token bucket keeps us under the exchange's message rate limit. Cancels go
+	out ahead of new orders and amends, and a requote supersedes whatever is
+	still queued from an earlier requote of the same symbol, so a backlog never
+	sends quotes that are already stale.
+
+	Without a native amend an order is amended by placing its replacement and
+	cancelling it. The pair is queued as one REPLACE action, so its cancel
+	stays behind the place instead of jumping the queue with the standalone
+	cancels, and the level is never left without an order.
+"""
+from collections import deque
+from time import monotonic
+
+PLACE = "place"
+AMEND = "amend"
+CANCEL = "cancel"
+# A (place, cancel) pair of messages.
+REPLACE = "replace"
+
+# Seconds during which a repeated cancel of the same order is dropped. The
+# exchange hasn't had time to confirm the first one yet.
+CANCEL_RETRY_S = 1.0
+
+class TokenBucket(object):
+	""" Allows rate messages per second on average and bursts of up to burst
+		messages. A rate of 0 (or None) disables the limit.
+	"""
+
+	def __init__(self, rate, burst=None, clock=monotonic):
+		self.rate = rate or 0
+		self.burst = burst or max(self.rate, 1)
+		self.clock = clock
+		self.tokens = self.burst
+		self.last = None
+
+	def _refill(self):
+		now = self.clock()
+		if self.last is not None:
+			self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	def take(self, tokens=1):
+		""" Takes the tokens if they are available. Never asks for more than a
+			full bucket, so a pair of messages can go out with a burst of 1.
+		"""
+		if not self.rate:
+			return True
+		self._refill()
+		if self.tokens >= min(tokens, self.burst):
+			self.tokens -= tokens
+			return True
+		return False
+
+	def wait_time(self, tokens=1):
+		""" Seconds until the tokens are available. """
+		if not self.rate:
+			return 0.0
+		self._refill()
+		return max(0.0, (min(tokens, self.burst) - self.tokens) / self.rate)
+
+class OrderScheduler(object):
+	""" Queues order actions between the market maker and the socket. senders
+		maps PLACE, AMEND, CANCEL and REPLACE to the functions sending such a
+		message, which return False if they held it back instead. The REPLACE
+		sender is given the (place, cancel) pair.
+	"""
+
+	def __init__(self, senders, rate=None, burst=None, clock=monotonic):
+		self.senders = senders
+		self.bucket = TokenBucket(rate, burst, clock)
+		self.clock = clock
+		self.cancels = deque()
+		self.orders = deque()
+		self.recent_cancels = {}
+		self.sent = {PLACE: 0, AMEND: 0, CANCEL: 0}
+		# Orders amended, whether by an AMEND or a REPLACE.
+		self.amends = 0
+		self.superseded = 0
+		self.duplicate_cancels = 0
+		self.throttled = 0
+		self.max_queue_depth = 0
+
+	def __len__(self):
+		return len(self.cancels) + len(self.orders)
+
+	def submit(self, symbol, actions):
+		""" Queues the (kind, message) actions of a requote of symbol, replacing
+			anything still queued for the symbol, and sends what the rate limit
+			allows right away.
+		"""
+		self._supersede(symbol)
+		now = self.clock()
+		for kind, msg in actions:
+			if kind == CANCEL:
+				sent_at = self.recent_cancels.get(msg["order_id"])
+				if sent_at is not None and now - sent_at < CANCEL_RETRY_S:
+					self.duplicate_cancels += 1
+					continue
+				self.cancels.append((symbol, kind, msg))
+			else:
+				self.orders.append((symbol, kind, msg))
+		self.max_queue_depth = max(self.max_queue_depth, len(self))
+		self.drain()
+
+	def _supersede(self, symbol):
+		for queue in (self.cancels, self.orders):
+			if not queue:
+				continue
+			kept = [action for action in queue if action[0] != symbol]
+			if len(kept) != len(queue):
+				self.superseded += len(queue) - len(kept)
+				queue.clear()
+				queue.extend(kept)
+
+	def drain(self):
+		""" Sends queued actions, cancels first, while the rate limit allows.
+			Returns the number of actions still queued.
+		"""
+		while self.cancels or self.orders:
+			queue = self.cancels if self.cancels else self.orders
+			kind = queue[0][1]
+			if not self.bucket.take(2 if kind == REPLACE else 1):
+				self.throttled += 1
+				break
+			_, kind, msg = queue.popleft()
+			if kind == CANCEL:
+				self._remember_cancel(msg["order_id"])
+			elif kind == REPLACE:
+				self._remember_cancel(msg[1]["order_id"])
+			if self.senders[kind](msg) is not False:
+				if kind == REPLACE:
+					self.sent[PLACE] += 1
+					self.sent[CANCEL] += 1
+				else:
+					self.sent[kind] += 1
+				if kind == AMEND or kind == REPLACE:
+					self.amends += 1
+		return len(self)
+
+	def clear(self):
+		""" Drops everything queued, counting it as superseded. For order
+			messages meant for a connection that went away.
+		"""
+		self.superseded += len(self)
+		self.cancels.clear()
+		self.orders.clear()
+
+	def _remember_cancel(self, order_id):
+		now = self.clock()
+		recent = self.recent_cancels
+		recent[order_id] = now
+		if len(recent) > 1024:
+			for stale in [i for i, sent_at in recent.items() if now - sent_at >= CANCEL_RETRY_S]:
+				del recent[stale]
+
+	def wait_time(self):
+		""" Seconds until queued actions can go out, or None if nothing is queued. """
+		if not len(self):
+			return None
+		queue = self.cancels if self.cancels else self.orders
+		return self.bucket.wait_time(2 if queue[0][1] == REPLACE else 1)
+
+	def stats(self):
+		return {
+			"queued": len(self),
+			"max_queued": self.max_queue_depth,
+			"sent": dict(self.sent),
+			"amends": self.amends,
+			"superseded": self.superseded,
+			"duplicate_cancels": self.duplicate_cancels,
+			"throttled": self.throttled,
+		}
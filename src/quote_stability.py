@@ -0,0 +1,86 @@
+""" Quote stability: relist tolerances that widen away from the inside of the
+	ladder and with the volatility of the reference price, and a cap on how
+	often each level of the ladder is amended. Together they stop a fast
+	market from churning every level on every requote.
+"""
+import math
+
+# Seconds for the volatility estimate to forget half of its past.
+VOLATILITY_HALFLIFE_S = 30.0
+
+class Volatility(object):
+	""" Running estimate of the variance per second of the log returns of a
+		price, updated with every new price. Each return counts for the time it
+		took, so a burst of ticks weighs no more than a quiet second.
+	"""
+
+	def __init__(self, halflife_s=VOLATILITY_HALFLIFE_S):
+		self.halflife = halflife_s
+		self.variance = 0.0
+		self.last_price = None
+		self.last_time = None
+
+	def update(self, price, now):
+		if self.last_price is None:
+			self.last_price, self.last_time = price, now
+			return
+		elapsed = now - self.last_time
+		# Returns of prices seen at the same instant land in the next update.
+		if elapsed <= 0:
+			return
+		log_return = math.log(price / self.last_price)
+		decay = 0.5 ** (elapsed / self.halflife)
+		self.variance = decay * self.variance + (1 - decay) * log_return * log_return / elapsed
+		self.last_price, self.last_time = price, now
+
+	def stdev(self):
+		""" Returns the standard deviation of the relative move over a second. """
+		return math.sqrt(self.variance)
+
+def relist_tolerances(trading_params, stdev):
+	""" Returns the relist tolerance of each level, innermost first. The inner
+		level keeps relist_tolerance; every level further out adds
+		relist_level_widening times that, plus relist_volatility_mult standard
+		deviations of the reference price's move over a second.
+	"""
+	tolerance = trading_params.relist_tolerance
+	step = trading_params.relist_level_widening * tolerance + trading_params.relist_volatility_mult * stdev
+	return [tolerance + step * level for level in range(trading_params.num_levels)]
+
+def is_stability_enabled(trading_params):
+	return bool(trading_params.relist_level_widening or trading_params.relist_volatility_mult)
+
+class AmendThrottle(object):
+	""" Lets each level of a symbol's ladder be amended at most max_per_s times
+		a second. Amends that pull an order back from the inside are never held
+		back, so throttling can't leave us quoting a stale, too aggressive price.
+	"""
+
+	def __init__(self):
+		# (symbol, side, level) -> when that level was last amended.
+		self.last_amends = {}
+		self.throttled = 0
+
+	def filter(self, symbol, to_amend, ladder, max_per_s, now):
+		""" Returns the amends of a diff that may go out now. to_amend pairs
+			resting orders with the (side, price, quantity) levels they should
+			become.
+		"""
+		interval = 1.0 / max_per_s if max_per_s else math.inf
+		levels = {}
+		for side, prices in (("Bid", ladder.bid_prices), ("Ask", ladder.ask_prices)):
+			for level, price in enumerate(prices.tolist()):
+				levels[(side, price)] = level
+		allowed = []
+		for order, desired in to_amend:
+			side, price = desired[0], desired[1]
+			pulls_back = price < order.price if side == "Bid" else price > order.price
+			key = (symbol, side, levels.get((side, price)))
+			if not pulls_back:
+				last = self.last_amends.get(key)
+				if last is not None and now - last < interval:
+					self.throttled += 1
+					continue
+			self.last_amends[key] = now
+			allowed.append((order, desired))
+		return allowed
@@ -0,0 +1,235 @@
+""" Reconnecting after the websocket dropped: the delays between attempts, how
+	long quoting took to resume after each connect and the connection handling
+	the market maker and the feed handler share.
+"""
+import random
+import threading
+from time import monotonic, sleep
+
+from journal import JOURNAL
+
+# Seconds to wait for authentication and for the first snapshots respectively
+# before giving up on a connection.
+AUTH_TIMEOUT = 10
+READY_TIMEOUT = 30
+# Seconds to wait for the snapshot of a resync before asking again.
+RESYNC_RETRY_S = 5
+
+class Backoff(object):
+	""" Exponentially growing delays between reconnect attempts, with jitter so
+		many processes dropped at once don't come back in lockstep.
+	"""
+
+	def __init__(self, initial_s=0.1, max_s=10.0, factor=2.0, jitter=0.2, rng=None):
+		self.initial = initial_s
+		self.max = max_s
+		self.factor = factor
+		self.jitter = jitter
+		self.rng = rng or random.Random()
+		self.attempts = 0
+
+	def next(self):
+		""" Returns the seconds to wait before the next attempt. The first
+			attempt after a reset goes out immediately.
+		"""
+		attempts = self.attempts
+		self.attempts += 1
+		if attempts == 0:
+			return 0.0
+		delay = min(self.max, self.initial * self.factor ** (attempts - 1))
+		return delay * (1 + self.jitter * (2 * self.rng.random() - 1))
+
+	def reset(self):
+		self.attempts = 0
+
+class ConnectionMonitor(object):
+	""" Follows the connection and times how long each (re)connect took to get
+		back to quoting, from the moment we lost the previous connection (or
+		started) to the first requote that went through after it.
+	"""
+
+	def __init__(self, idle_timeout_s=None, clock=monotonic):
+		self.clock = clock
+		# A connection silent for this long is considered dropped.
+		self.idle_timeout = idle_timeout_s
+		# Socket open, and ready to quote on it.
+		self.connected = False
+		self.ready = False
+		self.attempts = 0
+		self.connects = 0
+		self.disconnects = 0
+		self.last_frame = None
+		self.down_since = clock()
+		self.last_time_to_quote = None
+		self.max_time_to_quote = None
+
+	def on_connect(self):
+		self.connected = True
+		self.attempts += 1
+		self.last_frame = self.clock()
+
+	def on_ready(self):
+		self.ready = True
+		self.connects += 1
+
+	def on_frame(self):
+		self.last_frame = self.clock()
+
+	def on_disconnect(self):
+		if self.ready:
+			self.disconnects += 1
+		if self.down_since is None:
+			self.down_since = self.clock()
+		self.connected = False
+		self.ready = False
+
+	def is_idle(self):
+		""" Returns True if nothing arrived on the connection for longer than
+			the idle timeout.
+		"""
+		return self.connected and self.idle_timeout is not None \
+			and self.clock() - self.last_frame > self.idle_timeout
+
+	def on_quote(self):
+		""" Called by the first requote that goes through after a connect. """
+		elapsed = self.clock() - self.down_since
+		self.down_since = None
+		self.last_time_to_quote = elapsed
+		if self.max_time_to_quote is None or elapsed > self.max_time_to_quote:
+			self.max_time_to_quote = elapsed
+		return elapsed
+
+	def stats(self):
+		return {
+			"connected": self.connected,
+			"attempts": self.attempts,
+			"connects": self.connects,
+			"disconnects": self.disconnects,
+			"last_time_to_quote_s": self.last_time_to_quote,
+			"max_time_to_quote_s": self.max_time_to_quote,
+		}
+
+class ReconnectingClient(object):
+	""" Keeps a websocket client connected: connects with backoff until the
+		client is ready, notices a dropped or silent connection and resyncs
+		orderbooks that went out of sync. Mixed into a KolliderWsClient with
+		conf and exchange_state; the client provides subscribe(), is_ready()
+		and on_ready().
+	"""
+
+	def init_reconnect(self, conf):
+		self.backoff = Backoff(conf.get("reconnect_backoff_ms", 100) / 1000.0,
+			conf.get("reconnect_backoff_max_ms", 10000) / 1000.0)
+		self.connection = ConnectionMonitor(conf.get("reconnect_idle_s", 10) or None)
+		# Resyncs are asked for from the socket thread, on a broken delta, and
+		# from the requote thread, so checking and resubscribing is locked.
+		self.resync_lock = threading.Lock()
+
+	def on_close(self, *args):
+		""" Called by the websocket client when the socket closed. The run loop
+			reconnects.
+		"""
+		on_close = getattr(super(ReconnectingClient, self), "on_close", None)
+		if on_close is not None:
+			on_close(*args)
+		# Ignore a late close of a socket we already replaced.
+		closed = args[0] if args else None
+		if closed is not None and closed is not getattr(self, "ws", closed):
+			return
+		self.connection.on_disconnect()
+
+	def on_disconnect(self, reason):
+		""" Forgets the orderbooks of the lost connection until the snapshots of
+			the next one arrive.
+		"""
+		self.connection.on_disconnect()
+		self.exchange_state.is_authenticated = False
+		self.reset_books()
+		JOURNAL.warning("system", f"Disconnected: {reason}. Reconnecting.", reason=str(reason))
+
+	def reset_books(self):
+		with self.resync_lock:
+			for orderbook in self.exchange_state.orderbooks.values():
+				orderbook.is_synced = False
+				orderbook.resync_requested = None
+			self.exchange_state.resync_symbols.clear()
+
+	def resync_books(self):
+		""" Asks for a fresh snapshot of every orderbook that went out of sync,
+			unless we did so less than RESYNC_RETRY_S ago.
+		"""
+		with self.resync_lock:
+			now = monotonic()
+			for symbol in list(self.exchange_state.resync_symbols):
+				orderbook = self.exchange_state.orderbooks.get(symbol)
+				if orderbook is not None and orderbook.resync_requested is not None \
+						and now - orderbook.resync_requested < RESYNC_RETRY_S:
+					continue
+				if orderbook is not None:
+					orderbook.resync_requested = now
+				self.resync_book(symbol)
+
+	def resync_book(self, symbol):
+		""" Resubscribes to the orderbook of the symbol, which starts over with
+			a snapshot.
+		"""
+		unsub_orderbook_l2 = getattr(self, "unsub_orderbook_l2", None)
+		if unsub_orderbook_l2 is not None:
+			unsub_orderbook_l2(symbol)
+		self.sub_orderbook_l2(symbol)
+
+	def wait_until(self, predicate, timeout):
+		""" Waits until predicate() holds, returning False after timeout
+			seconds or once the connection closed.
+		"""
+		deadline = monotonic() + timeout
+		while not predicate():
+			if not self.connection.connected or monotonic() >= deadline:
+				return False
+			sleep(0.005)
+		return True
+
+	def close_socket(self):
+		ws = getattr(self, "ws", None)
+		if ws is not None:
+			try:
+				ws.close()
+			except Exception:
+				pass
+
+	def connect_until_ready(self):
+		""" Connects, backing off between failed attempts, until we are
+			authenticated and is_ready() holds. Subscriptions go out as soon as
+			the exchange accepted our credentials instead of after a fixed wait.
+		"""
+		while True:
+			sleep(self.backoff.next())
+			self.exchange_state.is_authenticated = False
+			self.connection.on_connect()
+			try:
+				self.connect(self.conf["ws_url"], self.conf["api_key"], self.conf["api_secret"], self.conf["api_passphrase"])
+			except Exception as e:
+				self.on_disconnect(e)
+				continue
+			if not self.wait_until(lambda: self.exchange_state.is_authenticated, AUTH_TIMEOUT):
+				reason = "not authenticated"
+			else:
+				self.subscribe()
+				if self.wait_until(self.is_ready, READY_TIMEOUT):
+					self.backoff.reset()
+					self.connection.on_ready()
+					self.on_ready()
+					return
+				reason = "no orderbook snapshot"
+			self.close_socket()
+			self.on_disconnect(reason)
+
+	def reconnect_if_down(self):
+		""" Reconnects if the socket closed or went silent. """
+		if self.connection.connected and not self.connection.is_idle():
+			return
+		reason = "connection closed" if not self.connection.connected \
+			else f"nothing received for {self.connection.idle_timeout}s"
+		self.close_socket()
+		self.on_disconnect(reason)
+		self.connect_until_ready()
@@ -0,0 +1,199 @@
+""" Replays a recorded frame log through the market maker against the simulated
+	exchange, as fast as the CPU allows.
+
+	Usage: python src/replay.py frames.log [--config config.yaml]
+		[--latency-ms 25] [--queue-position 1.0]
+
+	Record a log by setting record_frames in the config of a live (or dry run)
+	market maker.
+"""
+import argparse
+from time import perf_counter, perf_counter_ns
+
+from frame_log import read_frames
+from latency import LATENCY
+from main import MarketMaker
+from requote import EVENT
+from sim_exchange import SimulatedExchange
+from ws_msg_parser import *
+
+# Our own order and account messages of the recording session. The simulated
+# exchange produces these for the replayed market maker instead.
+PRIVATE_TYPES = frozenset((
+	OPEN, DONE, FILL, RECEIVED, POSITION_STATE, USER_POSITIONS, OPEN_ORDERS,
+	ORDER_REJECTION, USER_ACCOUNTS, AUTHENTICATE, WHOAMI))
+
+class ReplayMarketMaker(MarketMaker):
+	""" The market maker with its orders routed to a simulated exchange. Quotes
+		are recomputed after every message that changes one of their inputs.
+	"""
+
+	def __init__(self, conf, latency_ns=0, queue_position=1.0):
+		conf = dict(conf, enable_dry_run=False, requote_mode=EVENT, record_frames=None, state_cache_path=None)
+		super(ReplayMarketMaker, self).__init__(conf)
+		self.exchange = SimulatedExchange(
+			self.exchange_state, self.on_exchange_message, latency_ns, queue_position)
+		# Time decays and the order rate limit run on the recording's clock.
+		self.exchange_state.clock = lambda: self.exchange.now / 1e9
+		self.scheduler.clock = self.scheduler.bucket.clock = self.exchange_state.clock
+		self.pending_requote = False
+		self.frames = 0
+		self.first_timestamp = None
+		self.last_timestamp = None
+		# Symbol -> (since when, spread in bps) of our resting quotes, and the
+		# bps-nanoseconds and nanoseconds both sides were quoted for.
+		self.spreads = {}
+		self.spread_time = {}
+
+	def place_order(self, order):
+		self.exchange.place_order(order)
+
+	def cancel_order(self, order):
+		self.exchange.cancel_order(order)
+
+	def requote(self):
+		super(ReplayMarketMaker, self).requote()
+		self.sample_spreads()
+
+	def sample_spreads(self):
+		""" Follows the spread between our best resting bid and ask, in basis
+			points of the book's mid, over the recording's time.
+		"""
+		now = self.exchange.now
+		for symbol in self.markets:
+			last = self.spreads.get(symbol)
+			if last is not None and last[1] is not None:
+				weighted, elapsed = self.spread_time.get(symbol, (0.0, 0))
+				self.spread_time[symbol] = (weighted + last[1] * (now - last[0]), elapsed + now - last[0])
+			spread = None
+			open_orders = self.exchange_state.open_orders.get(symbol)
+			orderbook = self.exchange_state.orderbooks.get(symbol)
+			if open_orders is not None and open_orders.bids() and open_orders.asks() and orderbook is not None \
+					and orderbook.best_bid() is not None and orderbook.best_ask() is not None:
+				mid = (orderbook.best_bid() + orderbook.best_ask()) / 2
+				spread = (open_orders.asks()[0].price - open_orders.bids()[0].price) / mid * 10_000
+			self.spreads[symbol] = (now, spread)
+
+	def on_message(self, _, msg):
+		received = perf_counter_ns() if LATENCY.enabled else None
+		if parse_msg(self.exchange_state, msg):
+			if self.tick_ns is None:
+				self.tick_ns = received
+			self.pending_requote = True
+
+	def resync_book(self, symbol):
+		# A recording can't be asked for a snapshot. Quoting on the symbol
+		# resumes at the next snapshot in the log.
+		pass
+
+	def on_exchange_message(self, msg):
+		self.on_message(None, msg)
+
+	def replay(self, frames):
+		""" Runs the (timestamp_ns, frame) pairs through the market maker. """
+		exchange = self.exchange
+		for timestamp_ns, frame in frames:
+			if self.first_timestamp is None:
+				self.first_timestamp = timestamp_ns
+			self.last_timestamp = timestamp_ns
+			self.frames += 1
+
+			exchange.advance(timestamp_ns)
+			if len(self.scheduler):
+				self.scheduler.drain()
+			t = peek_type(frame)
+			if t in PRIVATE_TYPES:
+				continue
+			self.on_message(None, frame)
+			if t == ORDERBOOK_L2_STATE:
+				for symbol in self.markets:
+					exchange.on_book(symbol)
+			self.requote_if_pending()
+
+		exchange.flush()
+		self.requote_if_pending()
+
+	def requote_if_pending(self):
+		# Orders sent by a requote reach the exchange after the latency, so
+		# acknowledgements can't cascade within a single frame.
+		if self.pending_requote:
+			self.pending_requote = False
+			self.requote()
+
+	def results(self):
+		""" Returns per-symbol results: PnL in BTC marked to the final mid,
+			fills, traded and peak absolute position in contracts, the most
+			orders we had resting at once and the time weighted spread of our
+			quotes in basis points.
+		"""
+		results = {}
+		for symbol in self.markets:
+			account = self.exchange.account(symbol)
+			orderbook = self.exchange_state.orderbooks.get(symbol)
+			mark = None
+			if orderbook is not None and orderbook.best_bid() is not None and orderbook.best_ask() is not None:
+				mark = (orderbook.best_bid() + orderbook.best_ask()) / 2
+			results[symbol] = {
+				"pnl": account.pnl(mark) if mark is not None and account.tradable_symbol else None,
+				"fills": account.fills,
+				"filled_quantity": account.filled_quantity,
+				"position": account.position,
+				"max_abs_position": account.max_abs_position,
+				"max_resting_orders": account.max_resting,
+				"quoted_spread_bps": None,
+			}
+			weighted, elapsed = self.spread_time.get(symbol, (0.0, 0))
+			if elapsed:
+				results[symbol]["quoted_spread_bps"] = round(weighted / elapsed, 2)
+		return results
+
+def run_replay(conf, frames, latency_ms=0, queue_position=1.0):
+	""" Replays the frames and returns (market maker, stats). """
+	market_maker = ReplayMarketMaker(conf, int(latency_ms * 1e6), queue_position)
+	started = perf_counter()
+	market_maker.replay(frames)
+	elapsed = perf_counter() - started
+
+	market_seconds = 0
+	if market_maker.first_timestamp is not None:
+		market_seconds = (market_maker.last_timestamp - market_maker.first_timestamp) / 1e9
+	stats = {
+		"frames": market_maker.frames,
+		"wall_seconds": elapsed,
+		"market_seconds": market_seconds,
+		"speedup": market_seconds / elapsed if elapsed else None,
+		"orders_sent": market_maker.exchange.orders_received,
+		"cancels_sent": market_maker.exchange.cancels_received,
+		"requotes": market_maker.requote_trigger.stats(),
+		"scheduler": market_maker.scheduler.stats(),
+	}
+	return market_maker, stats
+
+def main():
+	import yaml
+	parser = argparse.ArgumentParser(description="Replay recorded frames against a simulated exchange.")
+	parser.add_argument("frame_log")
+	parser.add_argument("--config", default="config.yaml")
+	parser.add_argument("--latency-ms", type=float, default=0, help="one way latency to the exchange")
+	parser.add_argument("--queue-position", type=float, default=1.0,
+		help="where new orders join a price level's queue, 0 (front) to 1 (back)")
+	parser.add_argument("--latency-stats", action="store_true", help="print the latency of each stage")
+	args = parser.parse_args()
+
+	with open(args.config) as f:
+		conf = yaml.load(f, Loader=yaml.FullLoader)
+	if args.latency_stats:
+		conf["latency_stats"] = True
+	market_maker, stats = run_replay(conf, read_frames(args.frame_log), args.latency_ms, args.queue_position)
+
+	print(f"Replayed {stats['frames']} frames ({stats['market_seconds']:.1f}s of market data) "
+		f"in {stats['wall_seconds']:.2f}s, {stats['speedup'] or 0:.0f}x real time.")
+	print(f"Orders sent {stats['orders_sent']}, cancels sent {stats['cancels_sent']}, requotes {stats['requotes']}")
+	print(f"Order scheduler: {stats['scheduler']}")
+	for symbol, result in market_maker.results().items():
+		print(f"{symbol}: {result}")
+	if LATENCY.enabled:
+		print(LATENCY.report())
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,66 @@
+import threading
+from time import sleep
+
+POLL = "poll"
+EVENT = "event"
+
+class RequoteTrigger(object):
+	""" Wakes the strategy when one of its quoting inputs changed. Signals that
+		arrive while a requote is already pending are coalesced into one wake up.
+	"""
+
+	def __init__(self, debounce_ms=0):
+		self.debounce = debounce_ms / 1000.0
+		self.event = threading.Event()
+		self.last_keys = {}
+		self.signals = 0
+		self.wakeups = 0
+		self.triggered = 0
+		self.suppressed = 0
+
+	def notify(self, reason=None):
+		""" Called from the message thread whenever parse_msg reports a change.
+		"""
+		self.signals += 1
+		self.event.set()
+
+	def wait(self, timeout=None):
+		""" Blocks until a change was signalled or the timeout expired. Returns
+			True if woken by a change. With a debounce set, we linger briefly so
+			that a burst of deltas results in a single requote.
+		"""
+		if not self.event.wait(timeout):
+			return False
+		if self.debounce:
+			sleep(self.debounce)
+		self.event.clear()
+		self.wakeups += 1
+		return True
+
+	def should_requote(self, key, symbol=None):
+		""" Returns False (and counts a suppressed requote) if the inputs to the
+			quotes of the symbol are identical to its last requote.
+		"""
+		if self.last_keys.get(symbol) == key:
+			self.suppressed += 1
+			return False
+		self.last_keys[symbol] = key
+		self.triggered += 1
+		return True
+
+	def reset(self, symbol=None):
+		""" Forgets the last key of the symbol, or of all symbols, so the next
+			requote always goes through.
+		"""
+		if symbol is None:
+			self.last_keys.clear()
+		else:
+			self.last_keys.pop(symbol, None)
+
+	def stats(self):
+		return {
+			"signals": self.signals,
+			"wakeups": self.wakeups,
+			"triggered": self.triggered,
+			"suppressed": self.suppressed,
+		}
@@ -0,0 +1,144 @@
+""" Pre-trade checks on every order message on its way to the socket.
+
+	Each check reads totals kept up to date as orders come and go (see
+	OpenOrders) instead of walking our orders, so an order pays a few
+	dictionary lookups and some arithmetic, plus a walk over the few order
+	messages in flight. Cancels are never held back: they only take risk off.
+"""
+from collections import Counter
+
+from ladder import contract_qty_to_btc
+from order_scheduler import AMEND, CANCEL
+
+# Reasons an order message was held back.
+KILLED = "kill_switch"
+MESSAGE_RATE = "message_rate"
+ORDER_SIZE = "order_size"
+NO_REFERENCE_PRICE = "no_reference_price"
+PRICE_BAND = "price_band"
+OPEN_VALUE = "open_value"
+
+def order_btc(order, tradable_symbol):
+	""" Returns the value in BTC of the unfilled quantity of an order. """
+	return contract_qty_to_btc(max(order.quantity - order.filled, 0), tradable_symbol.from_raw(order.price),
+		tradable_symbol.is_inverse_priced, tradable_symbol.contract_size)
+
+def resting_btc(open_orders, side, tradable_symbol):
+	""" Returns the value in BTC of the unfilled quantity resting on a side. """
+	if side == "Bid":
+		inverse_value, value = open_orders.bid_inverse_value, open_orders.bid_value
+	else:
+		inverse_value, value = open_orders.ask_inverse_value, open_orders.ask_value
+	# The totals are over raw prices: shift them back to decimal prices.
+	scale = 10 ** tradable_symbol.price_dp
+	if tradable_symbol.is_inverse_priced:
+		return inverse_value * scale
+	return value / scale * tradable_symbol.contract_size / 100_000_000
+
+class RiskEngine(object):
+	""" Decides whether an order message may go out. Per symbol limits are
+		trading params (risk_max_order_qty, risk_price_band_pct,
+		risk_max_open_btc), so they reload with the config; the message rate
+		limit and the kill switch hold for the whole process.
+	"""
+
+	def __init__(self, exchange_state, markets, max_messages_per_s=None):
+		self.exchange_state = exchange_state
+		self.markets = markets
+		self.max_messages = max_messages_per_s or None
+		# Symbol -> the raw reference price of the last requote.
+		self.reference_prices = {}
+		self.window_start = None
+		self.window_messages = 0
+		# Why we stopped quoting, None while we quote.
+		self.killed = None
+		self.checked = 0
+		self.rejected = Counter()
+
+	def kill(self, reason):
+		""" Holds back every new order from now on. The market maker cancels
+			what rests. There is no undoing it short of a restart.
+		"""
+		if self.killed is None:
+			self.killed = reason
+
+	def _count_message(self, now):
+		if self.window_start is None or now - self.window_start >= 1.0:
+			self.window_start = now
+			self.window_messages = 0
+		self.window_messages += 1
+		return self.window_messages <= self.max_messages
+
+	def check(self, kind, msg, replaces=None):
+		""" Returns None if the order message may go out, or the reason it may
+			not. replaces is the order_id of the order a place replaces, whose
+			cancel follows it.
+		"""
+		self.checked += 1
+		now = self.exchange_state.clock()
+		if kind == CANCEL:
+			if self.max_messages is not None:
+				self._count_message(now)
+			return None
+		if self.killed is not None:
+			return self._reject(KILLED)
+		if self.max_messages is not None and not self._count_message(now):
+			return self._reject(MESSAGE_RATE)
+
+		symbol = msg["symbol"]
+		trading_params = self.markets[symbol].trading_params
+		quantity = msg["quantity"]
+		price = msg["price"]
+		if trading_params.risk_max_order_qty is not None and quantity > trading_params.risk_max_order_qty:
+			return self._reject(ORDER_SIZE)
+		if trading_params.risk_price_band_pct is not None:
+			reference_price = self.reference_prices.get(symbol)
+			if reference_price is None:
+				return self._reject(NO_REFERENCE_PRICE)
+			if abs(price - reference_price) > trading_params.risk_price_band_pct * reference_price:
+				return self._reject(PRICE_BAND)
+		if trading_params.risk_max_open_btc is not None:
+			if kind == AMEND:
+				replaces = msg.get("order_id")
+			return self._check_open_value(msg, symbol, trading_params.risk_max_open_btc, replaces)
+		return None
+
+	def _check_open_value(self, msg, symbol, max_open_btc, replaces):
+		""" Holds back an order that would take the value on its side past
+			max_open_btc. That is the value resting, less the orders being
+			cancelled or replaced, plus the places in flight (see
+			InFlightOrders).
+		"""
+		tradable_symbol = self.exchange_state.tradable_symbols.get(symbol)
+		if tradable_symbol is None:
+			return self._reject(OPEN_VALUE)
+		side = msg["side"]
+		btc = contract_qty_to_btc(msg["quantity"], tradable_symbol.from_raw(msg["price"]),
+			tradable_symbol.is_inverse_priced, tradable_symbol.contract_size)
+		open_btc = 0.0
+		open_orders = self.exchange_state.open_orders.get(symbol)
+		in_flight = self.exchange_state.in_flight.get(symbol)
+		cancelling = ()
+		if in_flight:
+			for order in in_flight.pending(side):
+				open_btc += order_btc(order, tradable_symbol)
+			cancelling = in_flight.cancelling()
+		if open_orders is not None:
+			open_btc += resting_btc(open_orders, side, tradable_symbol)
+			going = set(cancelling)
+			if replaces is not None:
+				going.add(replaces)
+			for order_id in going:
+				order = open_orders.get(order_id)
+				if order is not None and order.side == side:
+					open_btc -= order_btc(order, tradable_symbol)
+		if open_btc + btc > max_open_btc:
+			return self._reject(OPEN_VALUE)
+		return None
+
+	def _reject(self, reason):
+		self.rejected[reason] += 1
+		return reason
+
+	def stats(self):
+		return {"checked": self.checked, "rejected": dict(self.rejected), "killed": self.killed}
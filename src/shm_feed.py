@@ -0,0 +1,300 @@
+""" Market data shared between processes through a memory-mapped file.
+
+	A feed handler process (src/feed_handler.py) owns the exchange connection
+	and publishes the top depth levels of each orderbook and each index value
+	into a fixed slot of the file. Any number of strategy processes map the
+	same file and read the slots straight from the shared pages, instead of
+	each decoding the full websocket feed.
+
+	Every slot is guarded by a seqlock: the writer makes the slot's counter odd
+	before writing and even again afterwards, and readers retry until they saw
+	the same even counter before and after copying. There is a single writer
+	per file. This relies on stores becoming visible in program order, as they
+	do on x86.
+
+	Each slot carries the wall clock time of its last write. The feed handler
+	refreshes it every second for the books it holds in sync, so a reader can
+	tell a quiet market from a feed handler that died or lost the exchange.
+"""
+import mmap
+import os
+from time import time_ns
+
+import numpy as np
+
+from dtypes import Orderbook, parse_index_value
+from ws_msg_parser import BOOK_CHANGED, BOOK_INVALID, INDEX_CHANGED
+
+MAGIC = b"KMMFEED1"
+VERSION = 1
+NAME_SIZE = 32
+CACHE_LINE = 64
+DEFAULT_DEPTH = 10
+DEFAULT_PATH = "/dev/shm/kollider_feed"
+
+HEADER_DTYPE = np.dtype([
+	("magic", "S8"), ("version", "<u4"), ("depth", "<u4"), ("num_slots", "<u4"), ("slot_size", "<u4")])
+
+def slot_dtype(depth):
+	""" The layout of one slot, padded to whole cache lines so that writers of
+		neighbouring slots never share a line.
+	"""
+	fields = [
+		("seq", "<u8"),
+		("timestamp_ns", "<i8"),
+		("book_sequence", "<i8"),
+		("index_value", "<f8"),
+		("is_synced", "<u8"),
+		("bid_count", "<u8"),
+		("ask_count", "<u8"),
+		("bid_prices", "<i8", (depth,)),
+		("bid_sizes", "<i8", (depth,)),
+		("ask_prices", "<i8", (depth,)),
+		("ask_sizes", "<i8", (depth,)),
+	]
+	size = np.dtype(fields).itemsize
+	padding = -size % CACHE_LINE
+	if padding:
+		fields.append(("padding", "u1", (padding,)))
+	return np.dtype(fields)
+
+def _layout(depth, num_slots):
+	""" Returns (names offset, slots offset, file size). """
+	names_offset = HEADER_DTYPE.itemsize
+	slots_offset = names_offset + NAME_SIZE * num_slots
+	slots_offset += -slots_offset % CACHE_LINE
+	return names_offset, slots_offset, slots_offset + slot_dtype(depth).itemsize * num_slots
+
+class FeedPublisher(object):
+	""" Writes market data into a feed file with a slot per orderbook symbol
+		and per index symbol. Creates (or truncates) the file.
+	"""
+
+	def __init__(self, path, names, depth=DEFAULT_DEPTH):
+		self.path = path
+		self.depth = depth
+		self.names = list(names)
+		names_offset, slots_offset, size = _layout(depth, len(self.names))
+		with open(path, "wb+") as f:
+			f.truncate(size)
+			self.map = mmap.mmap(f.fileno(), size)
+		header = np.ndarray((), HEADER_DTYPE, self.map, 0)
+		header["version"] = VERSION
+		header["depth"] = depth
+		header["num_slots"] = len(self.names)
+		header["slot_size"] = slot_dtype(depth).itemsize
+		np.ndarray((len(self.names),), "S%d" % NAME_SIZE, self.map, names_offset)[:] = \
+			[name.encode() for name in self.names]
+		self.slots = np.ndarray((len(self.names),), slot_dtype(depth), self.map, slots_offset)
+		# Views of each field across the slots, for cheap element writes.
+		self.fields = {name: self.slots[name] for name in self.slots.dtype.names}
+		self.index = {name: i for i, name in enumerate(self.names)}
+		# Readers treat the file as valid once the magic is in place.
+		header["magic"] = MAGIC
+
+	def publish_book(self, symbol, orderbook, timestamp_ns):
+		""" Copies the best depth levels of each side of the orderbook. """
+		i = self.index[symbol]
+		fields = self.fields
+		seq = fields["seq"]
+		depth = self.depth
+		bids, asks = orderbook.bids, orderbook.asks
+		bid_count = min(len(bids), depth)
+		ask_count = min(len(asks), depth)
+
+		seq[i] += 1
+		fields["timestamp_ns"][i] = timestamp_ns
+		fields["book_sequence"][i] = orderbook.sequence if orderbook.sequence is not None else -1
+		fields["is_synced"][i] = orderbook.is_synced
+		fields["bid_count"][i] = bid_count
+		fields["ask_count"][i] = ask_count
+		if bid_count:
+			# Bids are kept in ascending price order, the best last.
+			fields["bid_prices"][i, :bid_count] = np.frombuffer(bids.prices[-bid_count:], dtype=np.int64)[::-1]
+			fields["bid_sizes"][i, :bid_count] = np.frombuffer(bids.sizes[-bid_count:], dtype=np.int64)[::-1]
+		if ask_count:
+			fields["ask_prices"][i, :ask_count] = np.frombuffer(asks.prices[:ask_count], dtype=np.int64)
+			fields["ask_sizes"][i, :ask_count] = np.frombuffer(asks.sizes[:ask_count], dtype=np.int64)
+		seq[i] += 1
+
+	def publish_invalid(self, symbol, timestamp_ns):
+		""" Flags the book of the symbol as out of sync. """
+		i = self.index[symbol]
+		fields = self.fields
+		fields["seq"][i] += 1
+		fields["timestamp_ns"][i] = timestamp_ns
+		fields["is_synced"][i] = 0
+		fields["seq"][i] += 1
+
+	def publish_heartbeat(self, symbol, timestamp_ns):
+		""" Marks the slot of the symbol as current without changing it. """
+		i = self.index[symbol]
+		fields = self.fields
+		fields["seq"][i] += 1
+		fields["timestamp_ns"][i] = timestamp_ns
+		fields["seq"][i] += 1
+
+	def publish_index(self, symbol, value, timestamp_ns):
+		i = self.index[symbol]
+		fields = self.fields
+		fields["seq"][i] += 1
+		fields["timestamp_ns"][i] = timestamp_ns
+		fields["index_value"][i] = value
+		fields["is_synced"][i] = 1
+		fields["seq"][i] += 1
+
+	def close(self):
+		self.slots = None
+		self.fields = None
+		self.map.close()
+
+class FeedReader(object):
+	""" Maps a feed file read-only. Reads never block the publisher. With
+		max_age_ms set, a book whose slot wasn't written for longer counts as
+		out of sync.
+	"""
+
+	def __init__(self, path, max_age_ms=None):
+		self.path = path
+		self.max_age_ns = int(max_age_ms * 1e6) if max_age_ms else None
+		# Books found out of date.
+		self.stale = 0
+		with open(path, "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+		header = np.ndarray((), HEADER_DTYPE, self.map, 0)
+		if header["magic"] != MAGIC or header["version"] != VERSION:
+			raise Exception(f"{path} is not a market data feed of version {VERSION}.")
+		self.depth = int(header["depth"])
+		num_slots = int(header["num_slots"])
+		names_offset, slots_offset, _ = _layout(self.depth, num_slots)
+		names = np.ndarray((num_slots,), "S%d" % NAME_SIZE, self.map, names_offset)
+		self.index = {name.decode(): i for i, name in enumerate(names)}
+		self.slots = np.ndarray((num_slots,), slot_dtype(self.depth), self.map, slots_offset)
+		self.fields = {name: self.slots[name] for name in self.slots.dtype.names}
+		self.seqs = self.fields["seq"]
+		# Counter of each slot as of the last sync().
+		self.seen = {}
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def read(self, name):
+		""" Returns a consistent copy of the slot of name. """
+		i = self.index[name]
+		seqs = self.seqs
+		slots = self.slots
+		while True:
+			before = seqs[i]
+			if before & 1:
+				continue
+			slot = slots[i].copy()
+			if seqs[i] == before:
+				return slot
+
+	def top(self, symbol):
+		""" Returns (best bid, bid size, best ask, ask size) of the symbol in raw
+			units without copying the slot. A missing side is returned as None.
+		"""
+		i = self.index[symbol]
+		fields = self.fields
+		seqs = self.seqs
+		while True:
+			before = seqs[i]
+			if before & 1:
+				continue
+			has_bid = fields["bid_count"][i] > 0
+			has_ask = fields["ask_count"][i] > 0
+			top = (
+				int(fields["bid_prices"][i, 0]) if has_bid else None,
+				int(fields["bid_sizes"][i, 0]) if has_bid else None,
+				int(fields["ask_prices"][i, 0]) if has_ask else None,
+				int(fields["ask_sizes"][i, 0]) if has_ask else None)
+			if seqs[i] == before:
+				return top
+
+	def sync(self, exchange_state, book_symbols=(), index_symbols=()):
+		""" Copies every slot that changed since the last sync into the exchange
+			state, as if the updates had come from the websocket. Returns the
+			change kinds parse_msg would have reported.
+		"""
+		changes = []
+		now_ns = time_ns() if self.max_age_ns is not None else None
+		for symbol in book_symbols:
+			change = self._sync_book(exchange_state, symbol, now_ns)
+			if change:
+				changes.append(change)
+		for symbol in index_symbols:
+			change = self._sync_index(exchange_state, symbol)
+			if change:
+				changes.append(change)
+		return changes
+
+	def _changed(self, name):
+		i = self.index.get(name)
+		if i is None:
+			return None
+		seq = int(self.seqs[i])
+		if seq & 1 or self.seen.get(name) == seq:
+			return None
+		slot = self.read(name)
+		self.seen[name] = int(slot["seq"])
+		return slot
+
+	def _is_stale(self, symbol, now_ns):
+		return now_ns is not None and now_ns - int(self.fields["timestamp_ns"][self.index[symbol]]) > self.max_age_ns
+
+	def _sync_book(self, exchange_state, symbol, now_ns=None):
+		slot = self._changed(symbol)
+		if slot is None:
+			orderbook = exchange_state.orderbooks.get(symbol)
+			if orderbook is not None and orderbook.is_synced and symbol in self.index and self._is_stale(symbol, now_ns):
+				self.stale += 1
+				orderbook.is_synced = False
+				return BOOK_INVALID
+			return None
+		orderbook = exchange_state.orderbooks.get(symbol)
+		if orderbook is None:
+			orderbook = exchange_state.orderbooks[symbol] = Orderbook("kollider")
+		is_stale = now_ns is not None and now_ns - int(slot["timestamp_ns"]) > self.max_age_ns
+		if not slot["is_synced"] or is_stale:
+			# Reported once, when the book goes out of sync.
+			if not orderbook.is_synced:
+				return None
+			if is_stale:
+				self.stale += 1
+			orderbook.is_synced = False
+			return BOOK_INVALID
+		top_before = (orderbook.best_bid(), orderbook.best_ask())
+		bid_count = int(slot["bid_count"])
+		ask_count = int(slot["ask_count"])
+		orderbook.bids.load(slot["bid_prices"][:bid_count][::-1], slot["bid_sizes"][:bid_count][::-1])
+		orderbook.asks.load(slot["ask_prices"][:ask_count], slot["ask_sizes"][:ask_count])
+		book_sequence = int(slot["book_sequence"])
+		orderbook.sequence = book_sequence if book_sequence >= 0 else None
+		orderbook.is_synced = True
+		changed = False
+		for listener in exchange_state.book_listeners.get(symbol, ()):
+			if listener(exchange_state):
+				changed = True
+		if changed or (orderbook.best_bid(), orderbook.best_ask()) != top_before:
+			return BOOK_CHANGED
+
+	def _sync_index(self, exchange_state, symbol):
+		slot = self._changed(symbol)
+		if slot is None or not slot["is_synced"]:
+			return None
+		value = float(slot["index_value"])
+		previous = exchange_state.index_values.get(symbol)
+		if previous is not None and previous.value == value:
+			return None
+		exchange_state.index_values[symbol] = parse_index_value({"value": value, "symbol": symbol, "denom": ""})
+		for listener in exchange_state.index_listeners.get(symbol, ()):
+			listener(exchange_state)
+		return INDEX_CHANGED
+
+	def close(self):
+		self.slots = None
+		self.fields = None
+		self.seqs = None
+		self.map.close()
@@ -0,0 +1,265 @@
+""" A simulated matching engine for our own orders, driven by the market's
+	orderbook as we see it.
+
+	Without a trade feed fills are inferred from the book: an order that
+	crosses the opposite side fills straight away, a resting order fills once
+	the market trades through its price, and at its own price it first waits
+	for the size queued ahead of it to disappear from the level.
+"""
+import heapq
+import json
+from itertools import count
+
+class SimOrder(object):
+	__slots__ = ("order_id", "ext_order_id", "symbol", "side", "price", "quantity",
+		"filled", "leverage", "queue_ahead", "level_size")
+
+	def remaining(self):
+		return self.quantity - self.filled
+
+class SimAccount(object):
+	""" Position and PnL bookkeeping of one symbol. Prices are raw, cash and
+		PnL are in BTC: an inverse contract is worth contract_size / price,
+		a linear one price * contract_size satoshis.
+	"""
+
+	def __init__(self, tradable_symbol):
+		self.tradable_symbol = tradable_symbol
+		self.position = 0
+		self.cash = 0.0
+		self.entry_price = 0.0
+		self.max_abs_position = 0
+		self.fills = 0
+		self.filled_quantity = 0
+		# Our orders resting on the symbol, now and at most.
+		self.resting = 0
+		self.max_resting = 0
+
+	def on_rest(self, change):
+		self.resting += change
+		self.max_resting = max(self.max_resting, self.resting)
+
+	def fill(self, side, price, quantity):
+		signed = quantity if side == "Bid" else -quantity
+		if self.position == 0 or (self.position > 0) == (signed > 0):
+			total = abs(self.position) + quantity
+			self.entry_price = (self.entry_price * abs(self.position) + price * quantity) / total
+		elif abs(signed) > abs(self.position):
+			self.entry_price = price
+		self.position += signed
+		if self.position == 0:
+			self.entry_price = 0.0
+		self.cash -= signed * self.contract_value(price)
+		self.max_abs_position = max(self.max_abs_position, abs(self.position))
+		self.fills += 1
+		self.filled_quantity += quantity
+
+	def contract_value(self, raw_price):
+		""" Returns what a long contract at the raw price is worth in BTC, up
+			to a constant that cancels out of PnL.
+		"""
+		tradable_symbol = self.tradable_symbol
+		price = tradable_symbol.from_raw(raw_price)
+		if tradable_symbol.is_inverse_priced:
+			return -tradable_symbol.contract_size / price
+		return price * tradable_symbol.contract_size / 100_000_000
+
+	def pnl(self, mark_price):
+		""" Returns the PnL in BTC with the position marked to the raw price. """
+		return self.cash + self.position * self.contract_value(mark_price)
+
+class SimulatedExchange(object):
+	""" Matches our orders against the replayed market. Orders take latency_ns
+		to reach the exchange and its responses take latency_ns to come back.
+		queue_position is where in the queue of a price level a new order joins:
+		1.0 at the back, 0.0 at the front.
+
+		The market is read from the orderbooks and tradable_symbols of
+		market_state, an ExchangeState fed with the market data. Responses are
+		handed to deliver(frame) as Kollider websocket frames.
+	"""
+
+	def __init__(self, market_state, deliver, latency_ns=0, queue_position=1.0):
+		self.market_state = market_state
+		self.deliver = deliver
+		self.latency_ns = latency_ns
+		self.queue_position = queue_position
+		self.now = 0
+		self.orders = {}
+		self.accounts = {}
+		self.order_ids = count(1)
+		self.events = []
+		self.sequence = count()
+		self.orders_received = 0
+		self.cancels_received = 0
+		self.rejections = 0
+
+	def account(self, symbol):
+		account = self.accounts.get(symbol)
+		if account is None:
+			account = self.accounts[symbol] = SimAccount(self.market_state.tradable_symbols.get(symbol))
+		return account
+
+	def _schedule(self, at, fn, *args):
+		heapq.heappush(self.events, (at, next(self.sequence), fn, args))
+
+	def _respond(self, msg_type, data):
+		self._schedule(self.now + self.latency_ns, self.deliver, json.dumps({"type": msg_type, "data": data}))
+
+	def advance(self, now):
+		""" Runs every order arrival and response due by now. """
+		self.now = max(self.now, now)
+		while self.events and self.events[0][0] <= self.now:
+			at, _, fn, args = heapq.heappop(self.events)
+			fn(*args)
+
+	def flush(self):
+		""" Runs every pending event regardless of its time. """
+		while self.events:
+			at, _, fn, args = heapq.heappop(self.events)
+			self.now = max(self.now, at)
+			fn(*args)
+
+	def place_order(self, order):
+		self.orders_received += 1
+		self._schedule(self.now + self.latency_ns, self._on_order, dict(order))
+
+	def cancel_order(self, order):
+		self.cancels_received += 1
+		self._schedule(self.now + self.latency_ns, self._on_cancel, order["order_id"])
+
+	def _on_order(self, msg):
+		symbol = msg["symbol"]
+		orderbook = self.market_state.orderbooks.get(symbol)
+		if orderbook is None or msg["quantity"] <= 0:
+			self.rejections += 1
+			self._respond("order_rejection", {"symbol": symbol, "reason": "InvalidOrder",
+				"ext_order_id": msg.get("ext_order_id")})
+			return
+
+		order = SimOrder()
+		order.order_id = next(self.order_ids)
+		order.ext_order_id = msg.get("ext_order_id")
+		order.symbol = symbol
+		order.side = msg["side"]
+		order.price = int(msg["price"])
+		order.quantity = int(msg["quantity"])
+		order.filled = 0
+		order.leverage = msg.get("leverage", 100)
+		level_size = self._same(orderbook, order.side).get(order.price, 0)
+		order.level_size = level_size
+		order.queue_ahead = int(level_size * self.queue_position)
+
+		self._respond("received", {"order_id": order.order_id, "ext_order_id": order.ext_order_id,
+			"symbol": symbol})
+		self.orders[order.order_id] = order
+		self.account(symbol).on_rest(1)
+		self._respond("open", self._open_msg(order))
+		# An order crossing the book takes liquidity straight away.
+		self._match_crossing(order, orderbook)
+
+	def _on_cancel(self, order_id):
+		order = self.orders.pop(int(order_id), None)
+		if order is not None:
+			self.account(order.symbol).on_rest(-1)
+			self._respond("done", {"order_id": order.order_id, "symbol": order.symbol, "reason": "Cancel"})
+
+	def on_book(self, symbol):
+		""" Checks our resting orders of the symbol against its updated book. """
+		orderbook = self.market_state.orderbooks.get(symbol)
+		if orderbook is None:
+			return
+		for order in list(self.orders.values()):
+			if order.symbol != symbol:
+				continue
+			if self._match_crossing(order, orderbook):
+				continue
+			# Size leaving our level is assumed to have traded, first eating
+			# the queue ahead of us and then our order.
+			level_size = self._same(orderbook, order.side).get(order.price, 0)
+			traded = order.level_size - level_size
+			order.level_size = level_size
+			if traded <= 0:
+				continue
+			if traded <= order.queue_ahead:
+				order.queue_ahead -= traded
+				continue
+			traded -= order.queue_ahead
+			order.queue_ahead = 0
+			self._fill(order, order.price, min(traded, order.remaining()), is_maker=True)
+
+	def _match_crossing(self, order, orderbook):
+		""" Fills the order if the opposite side trades at or through its price.
+			Returns True if the order is done.
+		"""
+		best = orderbook.best_ask() if order.side == "Bid" else orderbook.best_bid()
+		if best is None:
+			return False
+		crosses = best <= order.price if order.side == "Bid" else best >= order.price
+		if not crosses:
+			return False
+		self._fill(order, order.price, order.remaining(), is_maker=False)
+		return True
+
+	def _fill(self, order, price, quantity, is_maker):
+		if quantity <= 0:
+			return
+		order.filled += quantity
+		account = self.account(order.symbol)
+		account.fill(order.side, price, quantity)
+		self._respond("fill", {"order_id": order.order_id, "symbol": order.symbol, "side": order.side,
+			"price": price, "quantity": quantity, "is_maker": is_maker})
+		if order.remaining() <= 0:
+			if self.orders.pop(order.order_id, None) is not None:
+				account.on_rest(-1)
+			self._respond("done", {"order_id": order.order_id, "symbol": order.symbol, "reason": "Fill"})
+		self._respond("position_states", self._position_msg(order.symbol, account, order.leverage))
+
+	@staticmethod
+	def _same(orderbook, side):
+		return orderbook.bids if side == "Bid" else orderbook.asks
+
+	def _open_msg(self, order):
+		return {
+			"quantity": order.quantity,
+			"order_id": order.order_id,
+			"price": order.price,
+			"timestamp": str(self.now),
+			"filled": order.filled,
+			"ext_order_id": order.ext_order_id,
+			"order_type": "Limit",
+			"side": order.side,
+			"symbol": order.symbol,
+			"leverage": order.leverage,
+			"margin_type": "Isolated",
+			"settlement_type": "Delayed",
+		}
+
+	def _position_msg(self, symbol, account, leverage):
+		tradable_symbol = self.market_state.tradable_symbols.get(symbol)
+		entry_price = tradable_symbol.from_raw(account.entry_price) if tradable_symbol else account.entry_price
+		return {
+			"symbol": symbol,
+			"quantity": abs(account.position),
+			"entry_price": entry_price,
+			"leverage": leverage,
+			"liq_price": 0,
+			"open_order_ids": [o.order_id for o in self.orders.values() if o.symbol == symbol],
+			"side": "Bid" if account.position >= 0 else "Ask",
+			"timestamp": str(self.now),
+			"upnl": 0,
+			"rpnl": 0,
+		}
+
+	def open_orders_data(self):
+		""" Returns the data of an open_orders message listing our resting orders. """
+		open_orders = {}
+		for order in self.orders.values():
+			open_orders.setdefault(order.symbol, []).append(self._open_msg(order))
+		return {"open_orders": open_orders}
+
+	def positions_data(self, leverage=100):
+		""" Returns the data of a positions message listing our open positions. """
+		return {"positions": {
+			symbol: self._position_msg(symbol, account, leverage)
+			for symbol, account in self.accounts.items() if account.position}}
@@ -0,0 +1,77 @@
+""" A snapshot of the exchange state kept on disk, so a restarted market maker
+	knows its contracts, position and index prices before the exchange
+	answered a single request, and quotes as soon as the orderbook snapshots
+	are in.
+"""
+import json
+import os
+from time import monotonic, time
+
+from dtypes import parse_index_value, parse_position, parse_tradable_symbols
+
+# Seconds between two saves while running.
+SAVE_INTERVAL_S = 5.0
+
+class StateCache(object):
+	""" Contracts are loaded however old the cache is: they rarely change and
+		the exchange's answer replaces them moments later. Positions and index
+		values go stale quickly and are only loaded from a cache younger than
+		max_age_s.
+	"""
+
+	def __init__(self, path, max_age_s=10.0, save_interval_s=SAVE_INTERVAL_S):
+		self.path = path
+		self.max_age = max_age_s
+		self.save_interval = save_interval_s
+		self.last_save = monotonic()
+		self.saves = 0
+
+	def save(self, exchange_state):
+		""" Writes the state to a temporary file and moves it over the cache,
+			so a crash mid-write never leaves a truncated cache behind.
+		"""
+		state = {
+			"saved_at": time(),
+			"tradable_symbols": [s.to_dict() for s in list(exchange_state.tradable_symbols.values())],
+			"positions": [p.to_dict() for p in list(exchange_state.positions.values())],
+			"index_values": [i.to_dict() for i in list(exchange_state.index_values.values())],
+		}
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(state, f)
+		os.replace(tmp_path, self.path)
+		self.last_save = monotonic()
+		self.saves += 1
+
+	def save_if_due(self, exchange_state):
+		if monotonic() - self.last_save >= self.save_interval:
+			self.save(exchange_state)
+
+	def load(self, exchange_state):
+		""" Fills the exchange state from the cache and tells the position and
+			index listeners. Returns the number of (contracts, positions, index
+			values) loaded, or None without a usable cache.
+		"""
+		try:
+			with open(self.path) as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			return None
+
+		tradable_symbols = [parse_tradable_symbols(info) for info in state.get("tradable_symbols", ())]
+		for tradable_symbol in tradable_symbols:
+			exchange_state.tradable_symbols.setdefault(tradable_symbol.symbol, tradable_symbol)
+		if time() - state.get("saved_at", 0) > self.max_age:
+			return len(tradable_symbols), 0, 0
+
+		positions = [parse_position(position) for position in state.get("positions", ())]
+		for position in positions:
+			exchange_state.positions[position.symbol] = position
+			for listener in exchange_state.position_listeners.get(position.symbol, ()):
+				listener(exchange_state, position)
+		index_values = [parse_index_value(value) for value in state.get("index_values", ())]
+		for index_value in index_values:
+			exchange_state.index_values[index_value.symbol] = index_value
+			for listener in exchange_state.index_listeners.get(index_value.symbol, ()):
+				listener(exchange_state)
+		return len(tradable_symbols), len(positions), len(index_values)
@@ -0,0 +1,141 @@
+""" Sweeps trading params over a recorded frame log, running one replay per
+	parameter set across a pool of processes.
+
+	Usage: python src/sweep.py frames.log grid.yaml [--config config.yaml]
+		[--samples 100] [--workers 8] [--latency-ms 25] [--queue-position 1.0]
+		[--csv results.csv]
+
+	The grid is a YAML mapping of trading param to the list of values to try:
+
+		offset_pct: [0.0001, 0.0005, 0.001]
+		stack_pct: [0.0005, 0.001]
+		num_levels: [2, 5, 10]
+
+	Every combination is run unless --samples picks a random subset of them.
+"""
+import argparse
+import csv
+import itertools
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from frame_log import iter_frames, open_frame_log
+from replay import run_replay
+
+SWEEPABLE_PARAMS = (
+	"offset_pct", "stack_pct", "min_spread", "relist_tolerance", "num_levels",
+	"start_order_size", "order_step_size", "relist_level_widening", "relist_volatility_mult",
+	"volatility_halflife_s", "max_amends_per_level_s")
+
+RESULT_COLUMNS = ("pnl", "fills", "filled_quantity", "max_abs_position", "order_messages", "quoted_spread_bps")
+
+# Set up once per worker process by _init_worker.
+_frames = None
+_conf = None
+_replay_args = None
+
+def _init_worker(frame_log_path, conf, latency_ms, queue_position):
+	""" Maps the frame log once per worker. The pages are shared with every
+		other worker through the page cache rather than copied.
+	"""
+	global _frames, _conf, _replay_args
+	_frames = open_frame_log(frame_log_path)
+	_conf = conf
+	_replay_args = (latency_ms, queue_position)
+	# Quotes printed by the replays are of no use in a sweep.
+	sys.stdout = open(os.devnull, "w")
+
+def with_params(conf, params):
+	""" Returns a copy of the config with params overriding the trading params
+		of every market.
+	"""
+	conf = dict(conf)
+	conf["trading_params"] = dict(conf.get("trading_params") or {}, **params)
+	if conf.get("markets"):
+		markets = []
+		for entry in conf["markets"]:
+			entry = dict(entry)
+			entry["trading_params"] = dict(entry.get("trading_params") or {}, **params)
+			markets.append(entry)
+		conf["markets"] = markets
+	return conf
+
+def _run(params):
+	market_maker, stats = run_replay(with_params(_conf, params), iter_frames(_frames), *_replay_args)
+	results = market_maker.results().values()
+	pnls = [result["pnl"] for result in results if result["pnl"] is not None]
+	return dict(params,
+		pnl=sum(pnls) if pnls else None,
+		fills=sum(result["fills"] for result in results),
+		filled_quantity=sum(result["filled_quantity"] for result in results),
+		max_abs_position=max((result["max_abs_position"] for result in results), default=0),
+		quoted_spread_bps=max((result["quoted_spread_bps"] for result in results
+			if result["quoted_spread_bps"] is not None), default=None),
+		order_messages=stats["orders_sent"] + stats["cancels_sent"])
+
+def parameter_sets(grid, samples=None, seed=None):
+	""" Returns the combinations of the grid, or a random sample of them. """
+	unknown = set(grid) - set(SWEEPABLE_PARAMS)
+	if unknown:
+		raise Exception(f"Can't sweep {sorted(unknown)}. Options are {SWEEPABLE_PARAMS}.")
+	names = sorted(grid)
+	combinations = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+	if samples is not None and samples < len(combinations):
+		combinations = random.Random(seed).sample(combinations, samples)
+	return combinations
+
+def sweep(frame_log_path, conf, param_sets, workers=None, latency_ms=0, queue_position=1.0):
+	""" Runs a replay per parameter set and returns a result row for each. """
+	with ProcessPoolExecutor(
+			max_workers=workers, initializer=_init_worker,
+			initargs=(frame_log_path, conf, latency_ms, queue_position)) as pool:
+		return list(pool.map(_run, param_sets))
+
+def print_table(rows, columns):
+	cells = [[_format(row[column]) for column in columns] for row in rows]
+	widths = [max([len(column)] + [len(line[i]) for line in cells]) for i, column in enumerate(columns)]
+	print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+	for line in cells:
+		print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+def _format(value):
+	if isinstance(value, float):
+		return f"{value:.6g}"
+	return str(value)
+
+def main():
+	import yaml
+	parser = argparse.ArgumentParser(description="Sweep trading params over a recorded frame log.")
+	parser.add_argument("frame_log")
+	parser.add_argument("grid")
+	parser.add_argument("--config", default="config.yaml")
+	parser.add_argument("--samples", type=int, help="run a random sample of this many combinations")
+	parser.add_argument("--seed", type=int)
+	parser.add_argument("--workers", type=int, help="defaults to the number of cores")
+	parser.add_argument("--latency-ms", type=float, default=0)
+	parser.add_argument("--queue-position", type=float, default=1.0)
+	parser.add_argument("--csv", help="also write the results to this file")
+	args = parser.parse_args()
+
+	with open(args.config) as f:
+		conf = yaml.load(f, Loader=yaml.FullLoader)
+	with open(args.grid) as f:
+		grid = yaml.load(f, Loader=yaml.FullLoader)
+
+	param_sets = parameter_sets(grid, args.samples, args.seed)
+	print(f"Running {len(param_sets)} parameter sets.")
+	rows = sweep(args.frame_log, conf, param_sets, args.workers, args.latency_ms, args.queue_position)
+	rows.sort(key=lambda row: row["pnl"] if row["pnl"] is not None else float("-inf"), reverse=True)
+
+	columns = sorted(grid) + list(RESULT_COLUMNS)
+	print_table(rows, columns)
+	if args.csv:
+		with open(args.csv, "w", newline="") as f:
+			writer = csv.DictWriter(f, fieldnames=columns)
+			writer.writeheader()
+			writer.writerows(rows)
+
+if __name__ == "__main__":
+	main()
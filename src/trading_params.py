@@ -0,0 +1,235 @@
+""" The trading params of a market, parsed and checked once when the config is
+	loaded, and the watcher that reloads them while the market maker runs.
+"""
+import signal
+import os
+import threading
+from time import monotonic
+
+import numpy as np
+import yaml
+
+REQUIRED = object()
+
+def _number(value):
+	""" Keeps ints as ints (leverage goes on the wire as given) and turns
+		anything else into a float.
+	"""
+	if isinstance(value, bool):
+		raise ValueError(f"expected a number, got {value}")
+	return value if isinstance(value, int) else float(value)
+
+def _flag(value):
+	if not isinstance(value, bool):
+		raise ValueError(f"expected true or false, got {value}")
+	return value
+
+def _names(value):
+	return tuple(value or ())
+
+def _optional(convert):
+	return lambda value: None if value is None else convert(value)
+
+# name -> (conversion, default). Params defaulting to REQUIRED must be set.
+# Calculator params default to None so each calculator applies its own default.
+PARAMS = {
+	"reference_price_type": (str, REQUIRED),
+	"track_reference_prices": (_names, ()),
+	"depth_levels": (_optional(int), None),
+	"ewma_halflife_s": (_optional(float), None),
+	"basis_halflife_s": (_optional(float), None),
+	"leverage": (_number, REQUIRED),
+	"min_spread": (float, REQUIRED),
+	"offset_pct": (float, REQUIRED),
+	"stack_pct": (float, REQUIRED),
+	"relist_tolerance": (float, REQUIRED),
+	# Quote stability (see quote_stability.py), off at their defaults.
+	"relist_level_widening": (float, 0.0),
+	"relist_volatility_mult": (float, 0.0),
+	"volatility_halflife_s": (_optional(float), None),
+	"max_amends_per_level_s": (_optional(float), None),
+	"is_random_order_size": (_flag, REQUIRED),
+	"start_order_size": (int, REQUIRED),
+	"order_step_size": (int, REQUIRED),
+	"min_order_size": (_optional(int), None),
+	"max_order_size": (_optional(int), None),
+	"num_levels": (int, REQUIRED),
+	"max_long_pos_btc": (float, REQUIRED),
+	"max_short_pos_btc": (float, REQUIRED),
+	"inventory_skew_pct": (float, 0.0),
+	"inventory_size_skew": (float, 0.0),
+	# Pre-trade risk limits (see risk.py), None to not check.
+	"risk_max_order_qty": (_optional(int), None),
+	"risk_price_band_pct": (_optional(float), None),
+	"risk_max_open_btc": (_optional(float), None),
+}
+
+# Params whose change needs new reference price calculators.
+CALC_PARAMS = ("reference_price_type", "track_reference_prices", "depth_levels",
+	"ewma_halflife_s", "basis_halflife_s")
+
+NON_NEGATIVE = ("min_spread", "offset_pct", "stack_pct", "relist_tolerance", "relist_level_widening",
+	"relist_volatility_mult", "max_amends_per_level_s", "num_levels",
+	"max_long_pos_btc", "max_short_pos_btc", "inventory_skew_pct", "inventory_size_skew",
+	"risk_max_order_qty", "risk_price_band_pct", "risk_max_open_btc")
+
+def _frozen(array):
+	array.setflags(write=False)
+	return array
+
+class TradingParams(object):
+	""" Immutable trading params with the constants the ladder derives from
+		them computed up front. Params read as attributes; item access and get
+		are kept for code treating them as the config dict.
+	"""
+	__slots__ = tuple(PARAMS) + ("level_steps", "level_sizes", "bid_offset", "ask_offset",
+		"bid_backoff", "ask_backoff", "_values")
+
+	def __init__(self, params):
+		unknown = sorted(set(params) - set(PARAMS))
+		if unknown:
+			raise Exception(f"Unknown trading params {unknown} in config. Options are {sorted(PARAMS)}.")
+		values = []
+		for name, (convert, default) in PARAMS.items():
+			value = params.get(name, default)
+			if value is REQUIRED:
+				raise Exception(f"Trading param {name} missing from config.")
+			try:
+				value = convert(value)
+			except (TypeError, ValueError) as e:
+				raise Exception(f"Invalid trading param {name}: {e}")
+			object.__setattr__(self, name, value)
+			values.append(value)
+		object.__setattr__(self, "_values", tuple(values))
+		self._validate()
+
+		steps = np.arange(self.num_levels)
+		object.__setattr__(self, "level_steps", _frozen(self.stack_pct * steps))
+		level_sizes = None
+		if not self.is_random_order_size:
+			level_sizes = _frozen(self.start_order_size + self.order_step_size * steps.astype(np.int64))
+		object.__setattr__(self, "level_sizes", level_sizes)
+		object.__setattr__(self, "bid_offset", 1 - self.offset_pct)
+		object.__setattr__(self, "ask_offset", 1 + self.offset_pct)
+		object.__setattr__(self, "bid_backoff", 1.00 - (self.min_spread / 2))
+		object.__setattr__(self, "ask_backoff", 1.00 + (self.min_spread / 2))
+
+	def _validate(self):
+		for name in NON_NEGATIVE:
+			value = getattr(self, name)
+			if value is not None and value < 0:
+				raise Exception(f"Trading param {name} can't be negative.")
+		if self.leverage <= 0:
+			raise Exception("Trading param leverage must be positive.")
+		if self.volatility_halflife_s is not None and self.volatility_halflife_s <= 0:
+			raise Exception("Trading param volatility_halflife_s must be positive.")
+		if self.is_random_order_size:
+			if self.min_order_size is None or self.max_order_size is None:
+				raise Exception("Random order sizes need min_order_size and max_order_size.")
+			if self.min_order_size > self.max_order_size:
+				raise Exception("min_order_size is larger than max_order_size.")
+
+	def __setattr__(self, name, value):
+		raise AttributeError("TradingParams are immutable, use replace() for changed params.")
+
+	def __getitem__(self, name):
+		if name not in PARAMS:
+			raise KeyError(name)
+		return getattr(self, name)
+
+	def get(self, name, default=None):
+		if name not in PARAMS:
+			return default
+		value = getattr(self, name)
+		return default if value is None else value
+
+	def __eq__(self, other):
+		return isinstance(other, TradingParams) and self._values == other._values
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self._values)
+
+	def to_dict(self):
+		return dict(zip(PARAMS, self._values))
+
+	def replace(self, **changes):
+		""" Returns a copy with some params changed. """
+		return TradingParams(dict(self.to_dict(), **changes))
+
+	def calc_key(self):
+		""" The params the reference price calculators are built from. """
+		return tuple(getattr(self, name) for name in CALC_PARAMS)
+
+def load_trading_params(conf):
+	""" Returns {symbol: (index symbol, TradingParams)} for the markets of the
+		config. Each entry's trading_params override the top-level ones.
+		Without a "markets" list the top-level symbol and index_symbol describe
+		a single market.
+	"""
+	entries = conf.get("markets") or [{
+		"symbol": conf["symbol"],
+		"index_symbol": conf["index_symbol"],
+	}]
+	markets = {}
+	for entry in entries:
+		params = dict(conf.get("trading_params") or {})
+		params.update(entry.get("trading_params") or {})
+		try:
+			markets[entry["symbol"]] = (entry["index_symbol"], TradingParams(params))
+		except Exception as e:
+			raise Exception(f"{entry['symbol']}: {e}")
+	return markets
+
+# Seconds between two looks at the config file's modification time.
+RELOAD_CHECK_S = 1.0
+
+class ConfigReloader(object):
+	""" Notices when the config file changes, or when we get SIGHUP, so the
+		market maker can pick up new trading params between requotes.
+	"""
+
+	def __init__(self, path, check_interval=RELOAD_CHECK_S):
+		self.path = path
+		self.check_interval = check_interval
+		self.mtime = self._mtime()
+		self.requested = False
+		self.last_check = monotonic()
+
+	def _mtime(self):
+		try:
+			return os.stat(self.path).st_mtime_ns
+		except OSError:
+			return None
+
+	def request(self, *_):
+		""" Asks for a reload on the next poll. Safe to call from a signal handler. """
+		self.requested = True
+
+	def reload_on_signal(self, signum=getattr(signal, "SIGHUP", None)):
+		""" Only the main thread can install signal handlers. Run from another
+			thread, the config is still reloaded when the file changes.
+		"""
+		if signum is not None and threading.current_thread() is threading.main_thread():
+			signal.signal(signum, self.request)
+
+	def poll(self):
+		""" Returns the parsed config if it changed or a reload was requested
+			since the last poll, else None.
+		"""
+		if not self.requested:
+			now = monotonic()
+			if now - self.last_check < self.check_interval:
+				return None
+			self.last_check = now
+			mtime = self._mtime()
+			if mtime == self.mtime:
+				return None
+			self.mtime = mtime
+		else:
+			self.mtime = self._mtime()
+		self.requested = False
+		with open(self.path) as f:
+			return yaml.load(f, Loader=yaml.FullLoader)
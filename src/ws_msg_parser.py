@@ -1,148 +1,346 @@
 from dtypes import *
 from kollider_api_client.ws.ws_client import *
+from journal import JOURNAL, DEBUG
+from latency import LATENCY
 import json
-import copy
+import re
+from time import perf_counter_ns
+
+# Use the fastest JSON decoder that is installed.
+try:
+	import orjson
+	JSON_BACKEND = "orjson"
+	loads = orjson.loads
+except ImportError:
+	try:
+		import ujson
+		JSON_BACKEND = "ujson"
+		loads = ujson.loads
+	except ImportError:
+		JSON_BACKEND = "json"
+		loads = json.loads
+
+def set_json_backend(name):
+	""" Switches the JSON decoder to one of "orjson", "ujson" or "json". """
+	global JSON_BACKEND, loads
+	loads = __import__(name).loads
+	JSON_BACKEND = name
 
 SUCCESS = "success"
 ORDERBOOK_L2_STATE = "level2state"
 ORDERBOOK_L2_UPDATE = "orderbook_level2"
+FILL = "fill"
+
+# Change kinds returned by parse_msg so the strategy knows whether a message
+# touched one of its quoting inputs.
+BOOK_CHANGED = "book"
+INDEX_CHANGED = "index"
+# The orderbook of a symbol can't be trusted until a new snapshot arrived.
+BOOK_INVALID = "book_invalid"
+ORDERS_CHANGED = "orders"
+POSITIONS_CHANGED = "positions"
+
+def top_of_book(ob):
+	""" Returns the (best bid, best ask) raw prices of the orderbook. A missing
+		side is returned as None.
+	"""
+	return ob.bids.best(), ob.asks.best()
+
+def _on_authenticate(exchange_state, data):
+	if data["message"] == "success":
+		JOURNAL.info("system", "Authenticated Successfully!")
+		exchange_state.is_authenticated = True
+	else:
+		JOURNAL.error("system", "Auth Unsuccessful: {}".format(data), response=data)
+		exchange_state.is_authenticated = False
+
+def _on_error(exchange_state, data):
+	JOURNAL.error("error", "Error: {}".format(data), response=data)
+
+def _notify(listeners, exchange_state):
+	""" Calls every listener, returning True if any of them reported a change. """
+	changed = False
+	for listener in listeners:
+		if listener(exchange_state):
+			changed = True
+	return changed
+
+def _on_index_value(exchange_state, data):
+	index_value = parse_index_value(data)
+	previous = exchange_state.index_values.get(index_value.symbol)
+	exchange_state.index_values[index_value.symbol] = index_value
+	if previous is None or previous.value != index_value.value:
+		listeners = exchange_state.index_listeners.get(index_value.symbol)
+		if listeners:
+			_notify(listeners, exchange_state)
+		return INDEX_CHANGED
+
+def _on_user_positions(exchange_state, data):
+	positions = {}
+	for symbol, position in data["positions"].items():
+		pos = parse_position(position)
+		positions[pos.symbol] = pos
+	exchange_state.positions = positions
+	for symbol, listeners in exchange_state.position_listeners.items():
+		for listener in listeners:
+			listener(exchange_state, positions.get(symbol))
+	return POSITIONS_CHANGED
+
+def _on_open_orders(exchange_state, data):
+	oo = data['open_orders']
+	# The answer lists every order we have, so symbols it leaves out have
+	# none left, e.g. after orders were done while we were disconnected.
+	for symbol in exchange_state.open_orders.keys() - oo.keys():
+		exchange_state.open_orders[symbol] = OpenOrders()
+	for symbol in oo.keys():
+		open_orders = OpenOrders()
+		for open_order in oo[symbol]:
+			open_orders.add(parse_open_order(open_order))
+		exchange_state.open_orders[symbol] = open_orders
+	exchange_state.orders_version += 1
+	return ORDERS_CHANGED
+
+def _open_orders_for(exchange_state, data):
+	symbol = data.get("symbol")
+	if not symbol:
+		# Without a symbol, look for the symbol the order rests on.
+		order_id = int(data["order_id"])
+		for open_orders in exchange_state.open_orders.values():
+			if order_id in open_orders:
+				return open_orders
+		return OpenOrders()
+	open_orders = exchange_state.open_orders.get(symbol)
+	if open_orders is None:
+		open_orders = exchange_state.open_orders[symbol] = OpenOrders()
+	return open_orders
+
+def _on_whoami(exchange_state, data):
+	JOURNAL.info("system", "Received WHOAMI: {}".format(data), whoami=data)
+
+def _on_done(exchange_state, data):
+	JOURNAL.info("order", done=data)
+	order = _open_orders_for(exchange_state, data).remove(int(data["order_id"]))
+	if order is None:
+		return None
+	in_flight = exchange_state.in_flight.get(order.symbol)
+	if in_flight is not None:
+		in_flight.acknowledge_cancel(order.order_id)
+	exchange_state.orders_version += 1
+	return ORDERS_CHANGED
+
+def _on_open(exchange_state, data):
+	JOURNAL.info("order", open=data)
+	order = parse_open_order(data)
+	_open_orders_for(exchange_state, data).add(order)
+	in_flight = exchange_state.in_flight.get(order.symbol)
+	if in_flight is not None:
+		in_flight.acknowledge_place(order.ext_order_id)
+	exchange_state.orders_version += 1
+	return ORDERS_CHANGED
+
+def _on_fill(exchange_state, data):
+	JOURNAL.info("fill", fill=data)
+	quantity = int(data["quantity"])
+	order = _open_orders_for(exchange_state, data).fill(int(data["order_id"]), quantity)
+	if order is None:
+		return None
+	for listener in exchange_state.fill_listeners.get(order.symbol, ()):
+		listener(exchange_state, order, quantity)
+	exchange_state.orders_version += 1
+	return ORDERS_CHANGED
+
+def _on_fair_price(exchange_state, data):
+	JOURNAL.info("market", fair_price=data)
+
+def _on_tradable_symbols(exchange_state, data):
+	symbols = data["symbols"]
+	tradable_symbols = {}
+	for symbol in symbols:
+		symbol_info = symbols[symbol]
+		s = parse_tradable_symbols(symbol_info)
+		tradable_symbols[s.symbol] = s
+	exchange_state.tradable_symbols = tradable_symbols
+
+def _on_position_state(exchange_state, data):
+	JOURNAL.info("position", position=data)
+	position = parse_position(data)
+	if data["quantity"] != 0:
+		exchange_state.positions[position.symbol] = position
+	else:
+		exchange_state.positions.pop(position.symbol, None)
+		position = None
+	for listener in exchange_state.position_listeners.get(data["symbol"], ()):
+		listener(exchange_state, position)
+	return POSITIONS_CHANGED
+
+def _desync(exchange_state, symbol, ob, reason):
+	""" Marks the orderbook of the symbol as unusable until a fresh snapshot. """
+	if ob.is_synced:
+		JOURNAL.warning("book", "Orderbook {} out of sync: {}. Resyncing.".format(symbol, reason),
+			symbol=symbol, sequence=ob.sequence)
+	ob.is_synced = False
+	exchange_state.resync_symbols.add(symbol)
+	return BOOK_INVALID
+
+def _on_orderbook_l2_state(exchange_state, data):
+	symbol = data["symbol"]
+	ob = exchange_state.orderbooks.get(symbol)
+	if ob is None:
+		ob = Orderbook("kollider")
+	update_type = data["update_type"]
+	sequence = data.get("seq_number")
+	top_before = top_of_book(ob)
+	listeners = exchange_state.book_listeners.get(symbol)
+	if update_type == "snapshot":
+		ob.bids.replace(data["bids"])
+		ob.asks.replace(data["asks"])
+		ob.sequence = sequence
+		ob.updates += 1
+		exchange_state.orderbooks[symbol] = ob
+		if ob.is_crossed():
+			ob.crossed += 1
+			return _desync(exchange_state, symbol, ob, "crossed snapshot")
+		if ob.resync_requested is not None:
+			ob.resyncs += 1
+			ob.resync_requested = None
+			exchange_state.resync_symbols.discard(symbol)
+		ob.is_synced = True
+		JOURNAL.info("book", symbol=symbol, snapshot=sequence, bids=len(ob.bids), asks=len(ob.asks))
+		if listeners:
+			_notify(listeners, exchange_state)
+		return BOOK_CHANGED
+	elif update_type == "delta":
+		if not ob.is_synced:
+			# Nothing to apply the delta to until the next snapshot.
+			return None
+		if sequence is not None and ob.sequence is not None:
+			if sequence <= ob.sequence:
+				# A duplicate or replayed update.
+				return None
+			if sequence != ob.sequence + 1:
+				ob.gaps += 1
+				return _desync(exchange_state, symbol, ob,
+					"sequence gap {} -> {}".format(ob.sequence, sequence))
+		ob.sequence = sequence
+		if JOURNAL.level <= DEBUG:
+			JOURNAL.debug("book", symbol=symbol, delta=sequence, bids=data["bids"], asks=data["asks"])
+		missing = ob.bids.apply(data["bids"]) + ob.asks.apply(data["asks"])
+		ob.updates += 1
+		if missing:
+			ob.missing_levels += len(missing)
+			return _desync(exchange_state, symbol, ob,
+				"delete of {} missing levels, first {}".format(len(missing), missing[0]))
+		if ob.is_crossed():
+			ob.crossed += 1
+			return _desync(exchange_state, symbol, ob, "crossed book")
+		# Reference prices looking past the top of the book may move without it.
+		changed = listeners is not None and _notify(listeners, exchange_state)
+		if changed or top_of_book(ob) != top_before:
+			return BOOK_CHANGED
+	else:
+		JOURNAL.warning("book", "level 2 update type not known", symbol=symbol, update_type=update_type)
+
+def _on_order_rejection(exchange_state, data):
+	JOURNAL.warning("order", "Received Order Rejection: {}".format(data), rejection=data)
+	in_flight = exchange_state.in_flight.get(data.get("symbol"))
+	ext_order_id = data.get("ext_order_id")
+	if in_flight is None or ext_order_id is None or not in_flight.acknowledge_place(ext_order_id):
+		return None
+	# The level is free to be quoted again.
+	exchange_state.orders_version += 1
+	return ORDERS_CHANGED
+
+# Message type -> handler(exchange_state, data). A handler returns one of the
+# *_CHANGED kinds when it touched an input to the quotes.
+HANDLERS = {
+	ORDERBOOK_L2_STATE: _on_orderbook_l2_state,
+	INDEX_VALUE: _on_index_value,
+	OPEN: _on_open,
+	DONE: _on_done,
+	FILL: _on_fill,
+	POSITION_STATE: _on_position_state,
+	ORDER_REJECTION: _on_order_rejection,
+	OPEN_ORDERS: _on_open_orders,
+	USER_POSITIONS: _on_user_positions,
+	TRADABLE_SYMBOLS: _on_tradable_symbols,
+	AUTHENTICATE: _on_authenticate,
+	ERROR: _on_error,
+	WHOAMI: _on_whoami,
+	FAIR_PRICE: _on_fair_price,
+}
+
+# Types we receive but have no use for. These are dropped before decoding.
+IGNORED_TYPES = frozenset((TICKER, USER_ACCOUNTS, RECEIVED, SUCCESS))
+
+# Set to False to always fully decode frames before dispatching.
+LAZY_FILTER = True
+
+# Only the type key leading the frame is the frame's type; a nested "type"
+# field mustn't route it. Frames putting it elsewhere are decoded in full.
+_TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"]*)"')
+_SYMBOL_PATTERN = re.compile(r'"symbol"\s*:\s*"([^"]*)"')
+
+def peek_type(msg):
+	""" Returns the type of a raw frame, without decoding it if the type
+		leads the frame. None if it has no type.
+	"""
+	match = _TYPE_PATTERN.match(msg)
+	if match is not None:
+		return match.group(1)
+	try:
+		msg = loads(msg)
+	except ValueError:
+		return None
+	return msg.get("type") if isinstance(msg, dict) else None
+
+def _count(exchange_state, t):
+	counts = exchange_state.message_counts
+	counts[t] = counts.get(t, 0) + 1
 
 def parse_msg(exchange_state, msg):
-	msg = json.loads(msg)
-	# print(msg)
+	""" Applies a raw websocket frame to the exchange state. Returns one of the
+		*_CHANGED kinds when the message changed an input to the quotes, or None.
+	"""
+	if LAZY_FILTER and type(msg) is str:
+		# Peek at the type (and for book updates the symbol) before paying for
+		# a full decode of frames we would drop anyway.
+		match = _TYPE_PATTERN.match(msg)
+		if match is not None:
+			t = match.group(1)
+			if t in IGNORED_TYPES:
+				_count(exchange_state, t)
+				return None
+			if t == ORDERBOOK_L2_STATE and exchange_state.book_symbols:
+				match = _SYMBOL_PATTERN.search(msg)
+				if match is not None and match.group(1) not in exchange_state.book_symbols:
+					_count(exchange_state, t)
+					return None
+	if LATENCY.enabled:
+		return _parse_timed(exchange_state, msg)
+	msg = loads(msg)
 	t = msg["type"]
-	data = msg["data"]
-	if t == AUTHENTICATE:
-		if data["message"] == "success":
-			print("Authenticated Successfully!")
-			exchange_state.is_authenticated = True
-		else:
-			print("Auth Unsuccessful: {}".format(data))
-			exchange_state.is_authenticated = False
-
-	elif t == ERROR:
-		print(msg)
-		print("{}".format(data))
-
-	elif t == TICKER:
-		pass
-
-	elif t == INDEX_VALUE:
-		index_value = parse_index_value(data)
-		exchange_state.index_values[exchange_state.index_symbol] = index_value
-
-	elif t == USER_POSITIONS:
-		positions = {}
-		for symbol, position in data["positions"].items():
-			pos = parse_position(position)
-			positions[pos.symbol] = pos
-		exchange_state.positions = positions
-
-	elif t == OPEN_ORDERS:
-		oo = data['open_orders']
-		for symbol in oo.keys():
-			open_orders = []
-			for open_order in oo[symbol]:
-				dp = exchange_state.tradable_symbols[open_order["symbol"]].price_dp
-				open_order_parsed = parse_open_order(open_order, dp)
-				open_orders.append(open_order_parsed)
-			exchange_state.open_orders[symbol] = open_orders
-
-	elif t == USER_ACCOUNTS:
-		pass
-		# print("Received User Accounts")
-		# print(data)
-
-	elif t == WHOAMI:
-		print("Received WHOAMI")
-		print(data)
-
-	elif t == RECEIVED:
-		pass
-		# print("Received Order Received.")
-		# print(data)
-
-	elif t == DONE:
-		open_orders = exchange_state.open_orders[exchange_state.symbol]
-		exchange_state.open_orders[exchange_state.symbol] = [
-			order for order in open_orders if order.order_id != int(data["order_id"])]
-
-	elif t == OPEN:
-		open_order = data
-		symbol = open_order["symbol"]
-		dp = exchange_state.tradable_symbols[symbol].price_dp
-		open_order_parsed = parse_open_order(data, dp)
-		if exchange_state.open_orders.get(symbol) is not None:
-			exchange_state.open_orders[symbol].append(open_order_parsed)
-		else:
-			exchange_state.open_orders[symbol] = [open_order_parsed]
-
-	elif t == FAIR_PRICE:
-		print("Received Fair Price")
-		print(data)
-
-	elif t == TRADABLE_SYMBOLS:
-		symbols = data["symbols"]
-		tradable_symbols = {}
-		for symbol in symbols:
-			symbol_info = symbols[symbol]
-			s = parse_tradable_symbols(symbol_info)
-			tradable_symbols[s.symbol] = s
-		exchange_state.tradable_symbols = tradable_symbols                      
-
-	elif t == POSITION_STATE:
-		position = parse_position(data)
-		if data["quantity"] != 0:
-			exchange_state.positions[position.symbol] = position
-		else:
-			del exchange_state.positions[position.symbol]
-
-	elif t == ORDERBOOK_L2_STATE:
-		ob = copy.copy(Orderbook("kollider"))
-		current_ob = exchange_state.orderbooks.get(data["symbol"])
-		if current_ob:
-			ob = current_ob
-		update_type = data["update_type"]
-		if update_type == "snapshot":
-			for key, value in data["bids"].items():
-				ob.bids[int(key)] = value
-			for key, value in data["asks"].items():
-				ob.asks[int(key)] = value
-			if exchange_state.orderbooks.get(data["symbol"]) is not None:
-				del exchange_state.orderbooks[data["symbol"]]
-			exchange_state.orderbooks[data["symbol"]] = ob
-		elif update_type == "delta":
-			for key, value in data["bids"].items():
-				if value == 0:
-					try:
-						ob.bids.__delitem__(int(key))
-					except Exception as e:
-						print("couldn't delete key. Does not exist!")
-						print("KEY: {}".format(int(key)))
-						print("OB: {}".format([item for item in ob.bids.items()]))
-				else:
-					ob.bids[int(key)] = value
-			for key, value in data["asks"].items():
-				if value == 0:
-					try:
-						ob.asks.__delitem__(int(key))
-					except Exception as e:
-						print("couldn't delete key. Does not exist!")
-						print("KEY: {}".format(int(key)))
-						print("OB: {}".format([item for item in ob.asks.items()]))
-				else:
-					ob.asks[int(key)] = value
-		else:
-			print("level 2 update type not known")
-
-
-	elif t == ORDER_REJECTION:
-		print("Received Order Rejection.")
-		print(data)
-
-	elif t == SUCCESS:
-		# print(data)
-		pass
+	counts = exchange_state.message_counts
+	counts[t] = counts.get(t, 0) + 1
+	handler = HANDLERS.get(t)
+	if handler is not None:
+		return handler(exchange_state, msg["data"])
+	if t not in IGNORED_TYPES:
+		JOURNAL.warning("unhandled", "Unhandled type: {}".format(t), frame=msg)
 
-	else:
-		print("Unhandled type: {}".format(msg))
\ No newline at end of file
+def _parse_timed(exchange_state, msg):
+	""" parse_msg with the decode and book update stages timed. """
+	start = perf_counter_ns()
+	msg = loads(msg)
+	decoded = perf_counter_ns()
+	LATENCY.record("decode", start, decoded)
+	t = msg["type"]
+	counts = exchange_state.message_counts
+	counts[t] = counts.get(t, 0) + 1
+	handler = HANDLERS.get(t)
+	if handler is not None:
+		change = handler(exchange_state, msg["data"])
+		if t == ORDERBOOK_L2_STATE:
+			LATENCY.record("book", decoded)
+		return change
+	if t not in IGNORED_TYPES:
+		JOURNAL.warning("unhandled", "Unhandled type: {}".format(t), frame=msg)
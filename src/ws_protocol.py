@@ -0,0 +1,53 @@
+""" Builders for the outbound messages of Kollider's websocket API. Used by the
+	runtimes that own their socket rather than going through KolliderWsClient.
+"""
+import base64
+import hashlib
+import hmac
+import json
+from time import time
+
+INDEX_VALUES_CHANNEL = "index_values"
+ORDERBOOK_L2_CHANNEL = "orderbook_level2"
+POSITION_STATES_CHANNEL = "position_states"
+
+def auth_msg(api_key, api_secret, api_passphrase, timestamp=None):
+	""" Signs the timestamp with the (base64 encoded) api secret. """
+	if timestamp is None:
+		timestamp = int(time())
+	prehash = f"{timestamp}authentication".encode()
+	signature = hmac.new(base64.b64decode(api_secret), prehash, hashlib.sha256).digest()
+	return {
+		"type": "authenticate",
+		"token": api_key,
+		"passphrase": api_passphrase,
+		"signature": base64.b64encode(signature).decode(),
+		"timestamp": str(timestamp),
+	}
+
+def subscribe_msg(channels, symbols):
+	return {"type": "subscribe", "channels": channels, "symbols": symbols}
+
+def unsubscribe_msg(channels, symbols):
+	return {"type": "unsubscribe", "channels": channels, "symbols": symbols}
+
+def fetch_msg(name):
+	""" Request messages that carry no payload, e.g. "fetch_open_orders". """
+	return {"type": name}
+
+def order_msg(order):
+	""" Takes an order dict as returned by OpenOrder.to_dict. """
+	msg = dict(order)
+	msg["type"] = "order"
+	return msg
+
+def cancel_order_msg(order):
+	return {
+		"type": "cancel_order",
+		"symbol": order["symbol"],
+		"order_id": order["order_id"],
+		"settlement_type": order["settlement_type"],
+	}
+
+def encode(msg):
+	return json.dumps(msg)
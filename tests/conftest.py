@@ -0,0 +1,7 @@
+""" The modules live flat in src/ and import each other by name, as they do
+	when run as scripts.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,76 @@
+import numpy as np
+
+from convergence import diff_orders
+from dtypes import OpenOrder
+from ladder import Ladder
+
+TOLERANCE = 0.00005
+
+def make_order(side, price, quantity, order_id):
+	order = OpenOrder()
+	order.side = side
+	order.price = price
+	order.quantity = quantity
+	order.order_id = order_id
+	return order
+
+def make_ladder(best_bid, best_ask, num_levels=2, step=40, quantity=2):
+	steps = np.arange(num_levels, dtype=np.int64)
+	quantities = np.full(num_levels, quantity, dtype=np.int64)
+	return Ladder(best_bid - step * steps, quantities, best_ask + step * steps, quantities)
+
+def pending_from(to_create):
+	""" The orders of to_create as they are while in flight: no order_id yet. """
+	bids = [make_order(side, price, quantity, None) for side, price, quantity in to_create if side == "Bid"]
+	asks = [make_order(side, price, quantity, None) for side, price, quantity in to_create if side == "Ask"]
+	return bids, asks
+
+def test_matching_orders_are_left_alone():
+	ladder = make_ladder(399960, 400040)
+	bids = [make_order("Bid", 399960, 2, 1), make_order("Bid", 399920, 2, 2)]
+	asks = [make_order("Ask", 400040, 2, 3), make_order("Ask", 400080, 2, 4)]
+	assert diff_orders(bids, asks, ladder, TOLERANCE) == ([], [], [])
+
+def test_moved_orders_are_amended():
+	ladder = make_ladder(399860, 400140)
+	bids = [make_order("Bid", 399960, 2, 1), make_order("Bid", 399920, 2, 2)]
+	to_create, to_amend, to_cancel = diff_orders(bids, [], ladder, TOLERANCE)
+	assert [(order.order_id, level) for order, level in to_amend] == [
+		(1, ("Bid", 399860, 2)), (2, ("Bid", 399820, 2))]
+	assert to_cancel == []
+	assert [level[0] for level in to_create] == ["Ask", "Ask"]
+
+def test_second_requote_without_acks_places_nothing():
+	ladder = make_ladder(399960, 400040)
+	to_create, to_amend, to_cancel = diff_orders([], [], ladder, TOLERANCE)
+	assert len(to_create) == 4
+
+	# The exchange hasn't acknowledged any of them when we requote again.
+	pending_bids, pending_asks = pending_from(to_create)
+	assert diff_orders([], [], ladder, TOLERANCE, pending_bids, pending_asks) == ([], [], [])
+
+def test_pending_orders_are_not_amended_or_cancelled():
+	pending_bids, pending_asks = pending_from(diff_orders([], [], make_ladder(399960, 400040), TOLERANCE)[0])
+	# The market moved before the acknowledgements: the pending orders can't
+	# be touched without an order_id, and no duplicates are placed.
+	moved = make_ladder(399860, 400140)
+	assert diff_orders([], [], moved, TOLERANCE, pending_bids, pending_asks) == ([], [], [])
+	# A shorter ladder leaves the extra pending orders for the next requote.
+	shorter = make_ladder(399960, 400040, num_levels=1)
+	assert diff_orders([], [], shorter, TOLERANCE, pending_bids, pending_asks) == ([], [], [])
+
+def test_orders_being_cancelled_count_as_gone():
+	ladder = make_ladder(399960, 400040, num_levels=1)
+	bids = [make_order("Bid", 399960, 2, 1)]
+	asks = [make_order("Ask", 400040, 2, 2)]
+	to_create, to_amend, to_cancel = diff_orders(bids, asks, ladder, TOLERANCE, cancelling={1})
+	assert to_create == [("Bid", 399960, 2)]
+	assert to_amend == [] and to_cancel == []
+
+def test_per_level_tolerance():
+	ladder = make_ladder(399960, 400040)
+	# The outer bid is 0.75bp off its level: outside the inner tolerance but within
+	# the outer one.
+	bids = [make_order("Bid", 399960, 2, 1), make_order("Bid", 399950, 2, 2)]
+	assert diff_orders(bids, [], ladder, [0.00001, 0.0001])[1] == []
+	assert len(diff_orders(bids, [], ladder, 0.00001)[1]) == 1
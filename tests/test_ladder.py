@@ -0,0 +1,24 @@
+from fixtures import synthetic_tradable_symbol, synthetic_trading_params
+from ladder import build_ladder
+from trading_params import TradingParams
+
+def make_params(num_levels=2, max_pos_btc=0.0001):
+	params = synthetic_trading_params(num_levels)
+	params["max_long_pos_btc"] = params["max_short_pos_btc"] = max_pos_btc
+	return TradingParams(params)
+
+def test_sides_are_clipped_to_the_room_left():
+	# 2 contracts at 40000 are 0.00005 BTC, leaving room for 2 of the 12 at the second level.
+	ladder = build_ladder(399960.0, 400040.0, make_params(), synthetic_tradable_symbol(), 0.000101, 0.000101)
+	assert ladder.bid_quantities.tolist() == [2, 2]
+	assert ladder.ask_quantities.tolist() == [2, 2]
+
+def test_no_room_left_quotes_nothing_on_that_side():
+	ladder = build_ladder(399960.0, 400040.0, make_params(), synthetic_tradable_symbol(), 0.0, 0.0001)
+	assert ladder.bid_quantities.tolist() == []
+	assert ladder.ask_quantities.tolist() == [2, 2]
+
+def test_without_position_limits_the_ladder_is_quoted_in_full():
+	ladder = build_ladder(399960.0, 400040.0, make_params(), synthetic_tradable_symbol(), None, None)
+	assert ladder.bid_quantities.tolist() == [2, 12]
+	assert ladder.ask_quantities.tolist() == [2, 12]
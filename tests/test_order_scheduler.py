@@ -0,0 +1,39 @@
+from order_scheduler import OrderScheduler, PLACE, AMEND, CANCEL, REPLACE
+
+def make_scheduler(rate=None, burst=None):
+	sent = []
+	senders = {
+		PLACE: lambda msg: sent.append((PLACE, msg["order_id"])),
+		AMEND: lambda msg: sent.append((AMEND, msg["order_id"])),
+		CANCEL: lambda msg: sent.append((CANCEL, msg["order_id"])),
+		REPLACE: lambda msgs: sent.extend([(PLACE, msgs[0]["order_id"]), (CANCEL, msgs[1]["order_id"])]),
+	}
+	return OrderScheduler(senders, rate, burst, clock=lambda: 0.0), sent
+
+def test_standalone_cancels_go_first_and_a_replace_keeps_its_order():
+	scheduler, sent = make_scheduler()
+	scheduler.submit("BTCUSD.PERP", [
+		(REPLACE, ({"order_id": "new"}, {"order_id": 1})),
+		(CANCEL, {"order_id": 2}),
+		(PLACE, {"order_id": "other"}),
+	])
+	assert sent == [(CANCEL, 2), (PLACE, "new"), (CANCEL, 1), (PLACE, "other")]
+
+def test_amends_are_counted_once_however_they_are_sent():
+	scheduler, sent = make_scheduler()
+	scheduler.submit("BTCUSD.PERP", [
+		(REPLACE, ({"order_id": "new"}, {"order_id": 1})),
+		(AMEND, {"order_id": 2}),
+		(PLACE, {"order_id": "other"}),
+	])
+	stats = scheduler.stats()
+	assert stats["amends"] == 2
+	assert stats["sent"] == {PLACE: 2, AMEND: 1, CANCEL: 1}
+
+def test_a_replace_waits_for_the_rate_limit():
+	scheduler, sent = make_scheduler(rate=1, burst=1)
+	scheduler.submit("BTCUSD.PERP", [(REPLACE, ({"order_id": "new"}, {"order_id": 1}))])
+	assert sent == [(PLACE, "new"), (CANCEL, 1)]
+	scheduler.submit("BTCUSD.PERP", [(REPLACE, ({"order_id": "newer"}, {"order_id": "new"}))])
+	assert sent == [(PLACE, "new"), (CANCEL, 1)]
+	assert scheduler.stats()["queued"] == 1
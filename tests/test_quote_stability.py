@@ -0,0 +1,36 @@
+from dtypes import ExchangeState, Orderbook
+from fixtures import synthetic_trading_params
+from markets import Market
+
+SYMBOL = "BTCUSD.PERP"
+
+def make_market(**overrides):
+	params = dict(synthetic_trading_params(2), relist_volatility_mult=3.0)
+	params.update(overrides)
+	exchange_state = ExchangeState("kollider")
+	exchange_state.now = 1000.0
+	exchange_state.clock = lambda: exchange_state.now
+	market = Market(SYMBOL, ".BTCUSD", params)
+	market.attach(exchange_state)
+	return market, exchange_state
+
+def update_book(exchange_state, best_bid, best_ask):
+	orderbook = Orderbook("kollider")
+	orderbook.bids.replace({best_bid: 10})
+	orderbook.asks.replace({best_ask: 10})
+	exchange_state.orderbooks[SYMBOL] = orderbook
+	for listener in exchange_state.book_listeners[SYMBOL]:
+		listener(exchange_state)
+
+def test_volatility_follows_every_book_update_without_a_requote():
+	# Quoting off the index, which alone wouldn't listen to the book.
+	market, exchange_state = make_market(reference_price_type="index")
+	update_book(exchange_state, 399990, 400010)
+	assert market.volatility.stdev() == 0
+	exchange_state.now += 1
+	update_book(exchange_state, 400390, 400410)
+	assert market.volatility.stdev() > 0
+
+def test_volatility_is_left_alone_when_quote_stability_ignores_it():
+	market, exchange_state = make_market(reference_price_type="index", relist_volatility_mult=0.0)
+	assert not exchange_state.book_listeners[SYMBOL]
@@ -0,0 +1,46 @@
+""" Replays tests/data/frames.log, six seconds of a market maker session
+	recorded (with record_frames) against src/mock_exchange.py, and checks how
+	many order messages the replayed market maker sends and how many orders it
+	ever has resting.
+"""
+import os
+
+import pytest
+
+pytest.importorskip("kollider_api_client")
+
+from frame_log import read_frames
+from replay import run_replay
+
+FRAMES = os.path.join(os.path.dirname(__file__), "data", "frames.log")
+NUM_LEVELS = 2
+
+CONF = {
+	"api_key": "", "api_secret": "", "api_passphrase": "", "ws_url": "", "rest_url": "",
+	"symbol": "BTCUSD.PERP", "index_symbol": ".BTCUSD", "check_position_limits": False,
+	"enable_dry_run": False, "runtime": "thread", "requote_mode": "event", "requote_debounce_ms": 5,
+	"trading_params": {
+		"reference_price_type": "mid", "leverage": 2000, "min_spread": 0.0005, "offset_pct": 0.0001,
+		"stack_pct": 0.001, "relist_tolerance": 0.0001, "is_random_order_size": False,
+		"start_order_size": 2, "order_step_size": 10, "num_levels": NUM_LEVELS,
+		"max_long_pos_btc": 1, "max_short_pos_btc": 1,
+	},
+}
+
+def replay(latency_ms):
+	market_maker, stats = run_replay(CONF, read_frames(FRAMES), latency_ms)
+	return stats, market_maker.results()["BTCUSD.PERP"]
+
+@pytest.mark.parametrize("latency_ms, orders, cancels", [(0, 28, 16), (25, 26, 16)])
+def test_message_counts(latency_ms, orders, cancels):
+	stats, _ = replay(latency_ms)
+	assert stats["orders_sent"] == orders
+	assert stats["cancels_sent"] == cancels
+	assert stats["scheduler"]["amends"] == cancels
+
+@pytest.mark.parametrize("latency_ms", [0, 25, 100])
+def test_requoting_before_acknowledgements_never_stacks_the_ladder(latency_ms):
+	# An amend places the replacement before cancelling the original, so one
+	# order more than the ladder may rest for a moment.
+	_, results = replay(latency_ms)
+	assert results["max_resting_orders"] <= 2 * NUM_LEVELS + 1
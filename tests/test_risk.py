@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("kollider_api_client")
+
+from dtypes import Orderbook
+from fixtures import synthetic_deltas, synthetic_tradable_symbol, synthetic_trading_params
+from main import MarketMaker
+from risk import MESSAGE_RATE
+
+SYMBOL = "BTCUSD.PERP"
+
+class RecordingMarketMaker(MarketMaker):
+	def place_order(self, order):
+		self.placed.append(order)
+
+	def cancel_order(self, order):
+		pass
+
+def make_market_maker(**conf):
+	conf = dict({
+		"symbol": SYMBOL, "index_symbol": ".BTCUSD", "enable_dry_run": False,
+		"check_position_limits": False, "requote_mode": "event",
+		"trading_params": synthetic_trading_params(2)}, **conf)
+	market_maker = RecordingMarketMaker(conf)
+	market_maker.placed = []
+	market_maker.now = 1000.0
+	market_maker.exchange_state.clock = lambda: market_maker.now
+	market_maker.exchange_state.tradable_symbols[SYMBOL] = synthetic_tradable_symbol()
+	snapshot, _ = synthetic_deltas(0)
+	orderbook = Orderbook("kollider")
+	orderbook.bids.replace(snapshot[0])
+	orderbook.asks.replace(snapshot[1])
+	orderbook.is_synced = True
+	market_maker.exchange_state.orderbooks[SYMBOL] = orderbook
+	market = market_maker.markets[SYMBOL]
+	market.on_book(market_maker.exchange_state)
+	return market_maker, market
+
+def test_a_held_back_order_goes_out_once_the_rate_window_frees_up():
+	market_maker, market = make_market_maker(risk_max_messages_per_s=2)
+	market_maker.create_orders(market)
+	assert len(market_maker.placed) == 2
+	assert market_maker.risk.rejected[MESSAGE_RATE] == 2
+
+	market_maker.now += 1.1
+	market_maker.create_orders(market)
+	assert len(market_maker.placed) == 4
+	assert {(order["side"], order["price"]) for order in market_maker.placed[2:]} \
+		.isdisjoint((order["side"], order["price"]) for order in market_maker.placed[:2])
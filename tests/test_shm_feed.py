@@ -0,0 +1,62 @@
+from time import sleep, time_ns
+
+import pytest
+
+pytest.importorskip("kollider_api_client")
+
+from dtypes import ExchangeState, Orderbook
+from fixtures import synthetic_deltas
+from shm_feed import FeedPublisher, FeedReader
+from ws_msg_parser import BOOK_CHANGED, BOOK_INVALID
+
+SYMBOL = "BTCUSD.PERP"
+
+def make_orderbook(mid=400000):
+	snapshot, _ = synthetic_deltas(0, mid=mid)
+	orderbook = Orderbook("kollider")
+	orderbook.bids.replace(snapshot[0])
+	orderbook.asks.replace(snapshot[1])
+	orderbook.is_synced = True
+	return orderbook
+
+def test_a_book_not_refreshed_in_time_goes_out_of_sync(tmp_path):
+	path = str(tmp_path / "feed")
+	publisher = FeedPublisher(path, [SYMBOL])
+	reader = FeedReader(path, max_age_ms=1000)
+	exchange_state = ExchangeState("kollider")
+
+	publisher.publish_book(SYMBOL, make_orderbook(), time_ns())
+	assert reader.sync(exchange_state, [SYMBOL]) == [BOOK_CHANGED]
+	assert exchange_state.orderbooks[SYMBOL].is_synced
+
+	publisher.publish_heartbeat(SYMBOL, time_ns() - 2 * 10**9)
+	assert reader.sync(exchange_state, [SYMBOL]) == [BOOK_INVALID]
+	assert not exchange_state.orderbooks[SYMBOL].is_synced
+	# Reported once.
+	assert reader.sync(exchange_state, [SYMBOL]) == []
+	assert reader.stale == 1
+
+	publisher.publish_book(SYMBOL, make_orderbook(400005), time_ns())
+	assert reader.sync(exchange_state, [SYMBOL]) == [BOOK_CHANGED]
+	assert exchange_state.orderbooks[SYMBOL].is_synced
+
+def test_a_feed_handler_that_stopped_writing_is_noticed(tmp_path):
+	path = str(tmp_path / "feed")
+	publisher = FeedPublisher(path, [SYMBOL])
+	reader = FeedReader(path, max_age_ms=50)
+	exchange_state = ExchangeState("kollider")
+
+	publisher.publish_book(SYMBOL, make_orderbook(), time_ns())
+	assert reader.sync(exchange_state, [SYMBOL]) == [BOOK_CHANGED]
+	sleep(0.1)
+	assert reader.sync(exchange_state, [SYMBOL]) == [BOOK_INVALID]
+	assert not exchange_state.orderbooks[SYMBOL].is_synced
+	assert reader.stale == 1
+
+def test_an_old_feed_file_is_not_trusted(tmp_path):
+	path = str(tmp_path / "feed")
+	publisher = FeedPublisher(path, [SYMBOL])
+	publisher.publish_book(SYMBOL, make_orderbook(), time_ns() - 2 * 10**9)
+	exchange_state = ExchangeState("kollider")
+	FeedReader(path, max_age_ms=1000).sync(exchange_state, [SYMBOL])
+	assert not exchange_state.orderbooks[SYMBOL].is_synced
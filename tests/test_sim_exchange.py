@@ -0,0 +1,30 @@
+import pytest
+
+from dtypes import parse_tradable_symbols
+from fixtures import synthetic_symbol_info
+from sim_exchange import SimAccount
+
+def make_account(**info):
+	return SimAccount(parse_tradable_symbols(dict(synthetic_symbol_info(), **info)))
+
+def test_an_inverse_round_trip_earns_base_coin():
+	account = make_account(contract_size=10)
+	account.fill("Bid", 400000, 100)
+	account.fill("Ask", 404000, 100)
+	assert account.position == 0
+	# 100 contracts of 10 USD bought at 40000.0 and sold at 40400.0.
+	assert account.pnl(404000) == pytest.approx(100 * 10 * (1 / 40000 - 1 / 40400))
+	assert account.pnl(404000) == pytest.approx(0.00024752475)
+
+def test_an_open_inverse_position_is_marked_to_the_price():
+	account = make_account()
+	account.fill("Ask", 400000, 40)
+	assert account.pnl(400000) == pytest.approx(0)
+	assert account.pnl(500000) == pytest.approx(-40 * (1 / 40000 - 1 / 50000))
+
+def test_a_linear_round_trip_scales_with_the_contract_size():
+	account = make_account(is_inverse_priced=False, contract_size=2)
+	account.fill("Bid", 500000, 3)
+	account.fill("Ask", 501000, 3)
+	# 3 contracts of 2 satoshis per dollar, 100.0 apart.
+	assert account.pnl(501000) == pytest.approx(3 * 2 * 100 / 100_000_000)
@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("kollider_api_client")
+
+from dtypes import ExchangeState
+from ws_msg_parser import parse_msg, peek_type, SUCCESS, WHOAMI
+
+# A nested "type" ahead of the frame's own must not route or drop it.
+NESTED = '{"data": {"type": "success", "user_id": 1, "username": "mm"}, "type": "whoami"}'
+
+def test_a_nested_type_does_not_route_the_frame():
+	exchange_state = ExchangeState("kollider")
+	parse_msg(exchange_state, NESTED)
+	assert exchange_state.message_counts == {WHOAMI: 1}
+
+def test_ignored_types_are_still_dropped_before_decoding():
+	exchange_state = ExchangeState("kollider")
+	assert parse_msg(exchange_state, '{"type": "success", "data": not json}') is None
+	assert exchange_state.message_counts == {SUCCESS: 1}
+
+def test_peek_type_reads_the_top_level_type():
+	assert peek_type('{"type": "fill", "data": {"type": "x"}}') == "fill"
+	assert peek_type(NESTED) == WHOAMI
+	assert peek_type('{"data": {}}') is None